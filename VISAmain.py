@@ -1,13 +1,1776 @@
+import time
+
+STARTUP_T0 = time.perf_counter()  # 启动计时起点
+
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from matplotlib.figure import Figure
-import matplotlib.patches as patches
-from matplotlib.colors import ListedColormap
-import seaborn as sns
 import os
+import json
+import hashlib
+import shutil
+import io
+import asyncio
+import threading
+import argparse
+import re
+import zipfile
+from urllib.parse import urlsplit, parse_qs
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+
+
+# 会话与缓存目录（可通过环境变量VISA_CACHE_DIR覆盖）
+CACHE_DIR = os.environ.get("VISA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".visa_cache"))
+SESSION_FILE = os.path.join(CACHE_DIR, "session.json")
+SESSION_VERSION = 1
+
+# 派生数据缓存的磁盘上限（MB，可通过环境变量VISA_ARTIFACT_LIMIT_MB覆盖），超出时删除最久未用的目录
+ARTIFACT_LIMIT_MB = int(os.environ.get("VISA_ARTIFACT_LIMIT_MB", "20480"))
+
+# 工作区全局内存预算（MB，可通过环境变量VISA_MEMORY_BUDGET_MB覆盖）
+DEFAULT_MEMORY_BUDGET_MB = int(os.environ.get("VISA_MEMORY_BUDGET_MB", "4096"))
+
+# 预处理并行度（VISA_WORKERS），VISA_PROCESS_POOL=1时改用共享内存进程池
+PREPROCESS_WORKERS = int(os.environ.get("VISA_WORKERS", str(os.cpu_count() or 1)))
+PREPROCESS_PROCESSES = os.environ.get("VISA_PROCESS_POOL", "0") == "1"
+
+# VISA_SHARED_MEMORY=1时同一台机器上的多个窗口/进程共享已加载的大数组
+SHARED_MEMORY_ENABLED = os.environ.get("VISA_SHARED_MEMORY", "0") == "1"
+SHARED_MEMORY_MEMBERS = ('x_train', 'heatmap', 'attention')
+SHARED_MEMORY_DIR = os.path.join(CACHE_DIR, "shm")
+
+
+def file_fingerprint(path):
+    """根据绝对路径、文件大小和修改时间生成文件指纹"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+ARTIFACT_SOURCES = {}  # 缓存目录 -> 源文件绝对路径列表
+
+
+def artifact_dir(*paths):
+    """返回一组源文件对应的派生数据缓存目录（由各文件指纹决定）"""
+    directory = os.path.join(CACHE_DIR, "artifacts", "_".join(file_fingerprint(path) for path in paths))
+    ARTIFACT_SOURCES[directory] = [os.path.abspath(path) for path in paths]
+    return directory
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def prepare_artifact_dir(directory):
+    """创建缓存目录并记录其源文件；删除同一组源文件旧版本的目录，总量超出上限时按最久未用删除"""
+    if os.path.isdir(directory):
+        return
+    os.makedirs(directory, exist_ok=True)
+    sources = ARTIFACT_SOURCES.get(directory)
+    if sources is not None:
+        with open(os.path.join(directory, "sources.json"), "w", encoding="utf-8") as f:
+            json.dump(sources, f)
+
+    root = os.path.dirname(directory)
+    entries = []
+    for name in os.listdir(root):
+        other = os.path.join(root, name)
+        if other == directory or not os.path.isdir(other):
+            continue
+        try:
+            with open(os.path.join(other, "sources.json"), encoding="utf-8") as f:
+                stale = sources is not None and json.load(f) == sources
+        except (OSError, ValueError):
+            stale = False
+        if stale:
+            shutil.rmtree(other, ignore_errors=True)  # 源文件已修改，旧指纹的缓存不会再被使用
+        else:
+            entries.append((os.path.getmtime(other), other))
+
+    total = sum(directory_size(other) for _, other in entries)
+    for _, other in sorted(entries):
+        if total <= ARTIFACT_LIMIT_MB * 1024 * 1024:
+            break
+        total -= directory_size(other)
+        shutil.rmtree(other, ignore_errors=True)
+
+
+def load_artifact(directory, name):
+    """以内存映射方式读取缓存的派生数组，不存在或损坏时返回None"""
+    path = os.path.join(directory, name + ".npy")
+    if not os.path.exists(path):
+        return None
+    try:
+        array = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(directory)  # 记录最近使用时间，供超出上限时淘汰
+    except OSError:
+        pass
+    return array
+
+
+def save_artifact(directory, name, array):
+    """原子写入派生数组并返回其内存映射视图"""
+    prepare_artifact_dir(directory)
+    path = os.path.join(directory, name + ".npy")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def cached_arrays(directory, names, compute):
+    """读取缓存的派生数组，缺失时调用compute()计算并写入缓存，返回(数组列表, 是否命中缓存)"""
+    arrays = [load_artifact(directory, name) for name in names]
+    if all(array is not None for array in arrays):
+        return arrays, True
+
+    arrays = compute()
+    try:
+        arrays = [save_artifact(directory, name, array) for name, array in zip(names, arrays)]
+    except OSError:
+        pass  # 缓存目录不可写时直接使用内存中的结果
+    return arrays, False
+
+
+def concat_blocks(results):
+    """按instance轴拼接各块的结果，支持数组、元组/列表和字典"""
+    first = results[0]
+    if isinstance(first, dict):
+        return {key: concat_blocks([result[key] for result in results]) for key in first}
+    if isinstance(first, (tuple, list)):
+        return type(first)(concat_blocks([result[i] for result in results]) for i in range(len(first)))
+    return np.concatenate(results, axis=0)
+
+
+def run_shared_block(func, specs, start, end, args):
+    """在工作进程中挂载共享内存数组，对[start, end)行调用func"""
+    from multiprocessing import shared_memory
+    handles, blocks = [], []
+    for name, shape, dtype in specs:
+        shm = shared_memory.SharedMemory(name=name)  # 与主进程共用resource tracker，由主进程unlink
+        handles.append(shm)
+        blocks.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:end])
+    try:
+        # 结果可能引用共享内存，关闭前复制一份
+        result = concat_blocks([func(*blocks, *args)])
+    finally:
+        del blocks
+        for shm in handles:
+            shm.close()
+    return result
+
+
+class ChunkedExecutor:
+    """沿instance轴分块并行预处理：线程池用于释放GIL的NumPy内核，进程池通过共享内存传递数组"""
+
+    def __init__(self, workers=None, use_processes=False, min_block_rows=64):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.use_processes = use_processes
+        self.min_block_rows = min_block_rows
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        """首次使用时创建线程池或进程池"""
+        with self.lock:
+            if self.pool is None:
+                if self.use_processes:
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def row_blocks(self, row_count):
+        """把instance轴分成[start, end)块，每块至少min_block_rows行"""
+        block_count = min(self.workers * 4, max(1, row_count // self.min_block_rows))
+        edges = np.linspace(0, row_count, block_count + 1).astype(np.int64)
+        return list(zip(edges[:-1], edges[1:]))
+
+    def map_rows(self, func, arrays, args=()):
+        """对每个instance块调用func(*行块, *args)，结果按instance轴拼接"""
+        blocks = self.row_blocks(arrays[0].shape[0])
+        if self.workers == 1 or len(blocks) == 1:
+            return func(*arrays, *args)
+        if self.use_processes:
+            return concat_blocks(self.map_shared(func, arrays, args, blocks))
+        futures = [self.get_pool().submit(func, *[array[start:end] for array in arrays], *args)
+                   for start, end in blocks]
+        return concat_blocks([future.result() for future in futures])
+
+    def map_shared(self, func, arrays, args, blocks):
+        """把输入复制到共享内存一次，各进程只接收共享内存名称和行范围"""
+        from multiprocessing import shared_memory
+        handles, specs = [], []
+        try:
+            for array in arrays:
+                shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+                handles.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                specs.append((shm.name, array.shape, array.dtype.str))
+            futures = [self.get_pool().submit(run_shared_block, func, specs, start, end, args)
+                       for start, end in blocks]
+            return [future.result() for future in futures]
+        finally:
+            for shm in handles:
+                shm.close()
+                shm.unlink()
+
+
+PREPROCESS_EXECUTOR = ChunkedExecutor(PREPROCESS_WORKERS, PREPROCESS_PROCESSES)
+
+
+def rank_attention_block(attention):
+    """计算一块sample中每个shape的平均attention及其从大到小的排序索引"""
+    mean_values = np.mean(attention, axis=2)
+    sorted_indices = np.argsort(mean_values, axis=1)[:, ::-1]
+    return mean_values, sorted_indices
+
+
+def sort_attention_block(attention):
+    """计算一块sample的平均值、排序索引和排序后的attention"""
+    mean_values, sorted_indices = rank_attention_block(attention)
+    sorted_data = np.take_along_axis(np.asarray(attention), sorted_indices[:, :, None], axis=1)
+    return [mean_values, sorted_indices, sorted_data]
+
+
+def rank_attention(attention):
+    """按instance分块并行计算所有sample中每个shape的平均attention及其从大到小的排序索引"""
+    return PREPROCESS_EXECUTOR.map_rows(rank_attention_block, [attention])
+
+
+def load_shapes_npz(npz_path):
+    """读取NPZ中的arr_0/arr_1，并缓存为可内存映射的npy副本"""
+    npz_data = np.load(npz_path)
+    (arr_0, arr_1), _ = cached_arrays(
+        artifact_dir(npz_path), ["arr_0", "arr_1"],
+        lambda: [npz_data['arr_0'],  # (sample, shape_number, shape_length)
+                 npz_data['arr_1']])  # (sample, shape_number, VP)
+    return npz_data, arr_0, arr_1
+
+
+def attention_ranking(attention, path=None):
+    """返回(平均值, 排序索引, 排序后的attention)，有文件路径时按指纹缓存"""
+    def compute():
+        return PREPROCESS_EXECUTOR.map_rows(sort_attention_block, [attention])
+
+    if path is None:
+        return compute()
+    arrays, _ = cached_arrays(artifact_dir(path),
+                              ["attention_mean", "attention_rank", "attention_sorted"], compute)
+    return arrays
+
+
+def average_ranks(values):
+    """按行计算平均秩（并列值取平均秩），对所有sample一次性向量化计算"""
+    values = np.asarray(values)
+    sample_count, item_count = values.shape
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+
+    # 并列组的首尾位置
+    positions = np.broadcast_to(np.arange(item_count), values.shape)
+    group_start = np.ones(values.shape, dtype=bool)
+    group_start[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    group_end = np.ones(values.shape, dtype=bool)
+    group_end[:, :-1] = group_start[:, 1:]
+    first = np.maximum.accumulate(np.where(group_start, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(group_end, positions, item_count - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1.0, axis=1)
+    return ranks
+
+
+def rowwise_pearson(a, b):
+    """按行计算Pearson相关系数，常数行返回nan"""
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    denominator = np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (a * b).sum(axis=1) / denominator
+
+
+def pairwise_signs(block):
+    """每行所有元素对的符号矩阵 sign(x_i - x_j)，直接比较得到int8，不产生浮点临时数组"""
+    greater = np.greater(block[:, :, None], block[:, None, :])
+    less = np.less(block[:, :, None], block[:, None, :])
+    return np.subtract(greater.view(np.int8), less.view(np.int8))
+
+
+def rowwise_kendall_tau(a, b, chunk_bytes=64 * 1024 * 1024):
+    """按行计算Kendall tau-b，按sample分块以限制成对符号矩阵的内存"""
+    sample_count, item_count = a.shape
+    tau = np.empty(sample_count, dtype=np.float64)
+    # 每对元素峰值约4字节：两个int8符号矩阵，加上计算第二个时的两个bool比较结果（或乘积）
+    chunk = max(1, chunk_bytes // max(1, 4 * item_count * item_count))
+    for start in range(0, sample_count, chunk):
+        sign_a = pairwise_signs(a[start:start + chunk])
+        sign_b = pairwise_signs(b[start:start + chunk])
+        # 对称矩阵中每对出现两次，分子分母同时翻倍不影响结果
+        concordance = np.multiply(sign_a, sign_b).sum(axis=(1, 2), dtype=np.int64)
+        pairs_a = np.count_nonzero(sign_a, axis=(1, 2))
+        pairs_b = np.count_nonzero(sign_b, axis=(1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tau[start:start + chunk] = concordance / np.sqrt(pairs_a.astype(np.float64) * pairs_b)
+    return tau
+
+
+def topk_jaccard(order_a, order_b, top_k):
+    """按行计算两个排序前top_k个shape集合的Jaccard重合度"""
+    sample_count, item_count = order_a.shape
+    top_k = min(top_k, item_count)
+    member_a = np.zeros((sample_count, item_count), dtype=bool)
+    member_b = np.zeros((sample_count, item_count), dtype=bool)
+    np.put_along_axis(member_a, order_a[:, :top_k], True, axis=1)
+    np.put_along_axis(member_b, order_b[:, :top_k], True, axis=1)
+    intersection = np.count_nonzero(member_a & member_b, axis=1)
+    return intersection / (2 * top_k - intersection)
+
+
+def run_diff_block(means_a, means_b, order_a, order_b, top_k):
+    """计算一块sample的Spearman、Kendall和top-k Jaccard"""
+    ranks_a = average_ranks(means_a)
+    ranks_b = average_ranks(means_b)
+    return {
+        'spearman': rowwise_pearson(ranks_a, ranks_b),
+        'kendall': rowwise_kendall_tau(np.asarray(means_a), np.asarray(means_b)),
+        'jaccard': topk_jaccard(np.asarray(order_a), np.asarray(order_b), top_k),
+    }
+
+
+def attention_run_diff(means_a, means_b, order_a, order_b, top_k=10):
+    """比较两次运行的attention排序，返回每个sample的Spearman、Kendall和top-k Jaccard"""
+    if means_a.shape != means_b.shape:
+        raise ValueError(f"Attention runs have different shapes: {means_a.shape} vs {means_b.shape}")
+    return PREPROCESS_EXECUTOR.map_rows(run_diff_block, [means_a, means_b, order_a, order_b], (top_k,))
+
+
+# 重排后的数组文件名（与BasicMotions数据包中的reindexed_data.npy一致）
+REINDEXED_FILES = {
+    'arr_0': 'reindexed_data.npy',
+    'arr_1': 'reindexed_vp.npy',
+    'heatmap': 'reindexed_heatmap.npy',
+    'attention': 'reindexed_attention.npy',
+    'attention_mean': 'reindexed_attention_mean.npy',
+    'order': 'reindex_order.npy',
+}
+REINDEX_MANIFEST = 'reindex.json'
+
+
+def full_shape_order(sorted_indices, shape_count):
+    """把attention排序扩展为完整的shape排列，未参与排序的shape按原顺序排在最后"""
+    sample_count, ranked_count = sorted_indices.shape
+    if ranked_count >= shape_count:
+        return np.asarray(sorted_indices)
+    rest = np.broadcast_to(np.arange(ranked_count, shape_count), (sample_count, shape_count - ranked_count))
+    return np.concatenate([sorted_indices, rest], axis=1)
+
+
+def write_reindexed(path, source, order, both_axes=False, chunk_size=64):
+    """按sample分块用take_along_axis重排shape轴，流式写入npy文件"""
+    output = np.lib.format.open_memmap(path, mode='w+', dtype=source.dtype, shape=source.shape)
+    for start in range(0, source.shape[0], chunk_size):
+        block_order = np.asarray(order[start:start + chunk_size])
+        block = np.take_along_axis(np.asarray(source[start:start + chunk_size]), block_order[:, :, None], axis=1)
+        if both_axes:
+            # heatmap的行和列同时重排
+            block = np.take_along_axis(block, block_order[:, None, :], axis=2)
+        output[start:start + chunk_size] = block
+    output.flush()
+    del output
+
+
+def build_reindexed_views(out_dir, sorted_indices, attention, attention_means,
+                          arr_0=None, arr_1=None, heatmap=None, chunk_size=64):
+    """把attention排序应用到arr_0/arr_1/heatmap/attention，写出"重要shape在前"的数组，返回写出的成员"""
+    os.makedirs(out_dir, exist_ok=True)
+    sample_count, ranked_count = sorted_indices.shape
+    written = []
+
+    np.save(os.path.join(out_dir, REINDEXED_FILES['order']), np.asarray(sorted_indices))
+    write_reindexed(os.path.join(out_dir, REINDEXED_FILES['attention']), attention, sorted_indices,
+                    chunk_size=chunk_size)
+    np.save(os.path.join(out_dir, REINDEXED_FILES['attention_mean']),
+            np.take_along_axis(np.asarray(attention_means), np.asarray(sorted_indices), axis=1))
+    written += ['order', 'attention', 'attention_mean']
+
+    for name, source in [('arr_0', arr_0), ('arr_1', arr_1)]:
+        if source is not None and source.shape[0] == sample_count and source.shape[1] >= ranked_count:
+            write_reindexed(os.path.join(out_dir, REINDEXED_FILES[name]), source,
+                            full_shape_order(sorted_indices, source.shape[1]), chunk_size=chunk_size)
+            written.append(name)
+    if heatmap is not None and heatmap.shape[:2] == (sample_count, ranked_count):
+        write_reindexed(os.path.join(out_dir, REINDEXED_FILES['heatmap']), heatmap, sorted_indices,
+                        both_axes=True, chunk_size=chunk_size)
+        written.append('heatmap')
+
+    with open(os.path.join(out_dir, REINDEX_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({'members': written, 'instances': sample_count, 'ranked_shapes': ranked_count}, f, indent=2)
+    return written
+
+
+# 跟随模式：文件夹中每个成员为<name>.bin原始文件（附<name>.bin.json）或存放.npy块的<name>/目录
+FOLLOW_MEMBERS = ('attention', 'heatmap', 'arr_0', 'arr_1')
+FOLLOW_INTERVAL_MS = 1000
+
+
+class GrowableArray:
+    """按行追加的数组，容量按倍数扩展，避免每次追加都复制全部数据"""
+
+    def __init__(self):
+        self.buffer = None
+        self.count = 0
+
+    def extend(self, rows):
+        """追加若干行，返回已写入部分的视图"""
+        rows = np.asarray(rows)
+        if self.buffer is None:
+            self.buffer = np.empty((max(len(rows), 16),) + rows.shape[1:], dtype=rows.dtype)
+        elif self.count + len(rows) > len(self.buffer):
+            grown = np.empty((max(2 * len(self.buffer), self.count + len(rows)),) + self.buffer.shape[1:],
+                             dtype=self.buffer.dtype)
+            grown[:self.count] = self.buffer[:self.count]
+            self.buffer = grown
+        self.buffer[self.count:self.count + len(rows)] = rows
+        self.count += len(rows)
+        return self.buffer[:self.count]
+
+
+class FollowSource:
+    """跟随追加写入的数据：原始文件按大小重新映射，块目录只读取新出现的.npy块"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.data = None
+        if os.path.isdir(path):
+            self.chunks = GrowableArray()
+            self.loaded_chunks = 0
+        else:
+            # 原始文件的dtype和每个instance的形状记录在<文件>.json中
+            with open(path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.chunks = None
+            self.dtype = np.dtype(meta['dtype'])
+            self.instance_shape = tuple(meta['instance_shape'])
+
+    @classmethod
+    def find(cls, folder, name):
+        """在跟随文件夹中查找成员，不存在时返回None"""
+        if os.path.isdir(os.path.join(folder, name)):
+            return cls(os.path.join(folder, name))
+        if os.path.exists(os.path.join(folder, name + '.bin')):
+            return cls(os.path.join(folder, name + '.bin'))
+        return None
+
+    def poll(self):
+        """映射新写入的完整instance，返回新增的instance数"""
+        if self.chunks is None:
+            row_bytes = self.dtype.itemsize * int(np.prod(self.instance_shape))
+            rows = os.path.getsize(self.path) // row_bytes  # 忽略尚未写完的最后一行
+            if rows > self.count:
+                self.data = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(rows,) + self.instance_shape)
+        else:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith('.npy'))
+            for name in names[self.loaded_chunks:]:
+                try:
+                    chunk = np.load(os.path.join(self.path, name))
+                except (ValueError, OSError, EOFError):
+                    break  # 块仍在写入，下次再读
+                self.data = self.chunks.extend(chunk)
+                self.loaded_chunks += 1
+            rows = self.chunks.count
+        added = rows - self.count
+        self.count = rows
+        return added
+
+
+def parse_series_values(text):
+    """解析逗号分隔的数值，缺失值'?'记为nan"""
+    text = text.strip()
+    if not text:
+        return np.empty(0, dtype=np.float32)
+    return np.array(text.replace('?', 'nan').split(','), dtype=np.float32)
+
+
+def iter_ts_records(f):
+    """逐行读取sktime .ts文件，生成(各variable的数组列表, 标签)；回归数据集(@targetLabel)的标签为数值"""
+    has_label = is_target = False
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        lower = line.lower()
+        if lower.startswith('@timestamps') and lower.split()[-1] == 'true':
+            raise ValueError(".ts files with timestamps are not supported")
+        if lower.startswith(('@classlabel', '@targetlabel')):
+            has_label = lower.split()[1] == 'true'
+            is_target = lower.startswith('@targetlabel')
+        elif lower.startswith('@data'):
+            break
+
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split(':')
+        label = parts.pop().strip() if has_label else None
+        if is_target and label is not None:
+            label = float(label)
+        yield [parse_series_values(part) for part in parts], label
+
+
+def iter_arff_records(f):
+    """逐行读取UEA/UCR .arff文件（单变量或relational多变量），生成(各variable的数组列表, 标签)"""
+    relational = False
+    has_label = False
+    for line in f:
+        line = line.strip()
+        lower = line.lower()
+        if lower.startswith('@attribute'):
+            relational = relational or 'relational' in lower
+            has_label = '{' in line  # 最后一个属性为类别时带标签
+        elif lower.startswith('@data'):
+            break
+
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('%'):
+            continue
+        label = None
+        if has_label:
+            line, label = line.rsplit(',', 1)
+            label = label.strip().strip('\'"')
+        if relational:
+            # 多变量：引号内各variable以字面量\n分隔
+            dimensions = line.strip().strip('\'"').split('\\n')
+            yield [parse_series_values(part) for part in dimensions], label
+        else:
+            yield [parse_series_values(line)], label
+
+
+def import_time_series(path, out_dir, progress=None):
+    """把.ts/.arff文件分两遍流式写入 (sample, length, dimension) 的内存映射数组，
+    变长序列以0填充并记录长度，返回输出文件路径"""
+    reader = iter_arff_records if path.lower().endswith('.arff') else iter_ts_records
+
+    # 第一遍：统计instance数、最大长度和variable数
+    sample_count, max_length, dimension_count, labels = 0, 0, None, []
+    with open(path, encoding='utf-8') as f:
+        for dimensions, label in reader(f):
+            if dimension_count is None:
+                dimension_count = len(dimensions)
+            elif len(dimensions) != dimension_count:
+                raise ValueError(f"Instance {sample_count + 1} has {len(dimensions)} variables, "
+                                 f"expected {dimension_count}")
+            max_length = max(max_length, max(len(values) for values in dimensions))
+            labels.append(label)
+            sample_count += 1
+    if sample_count == 0:
+        raise ValueError("No instances found in the file")
+
+    # 第二遍：逐行写入预分配的内存映射数组
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    outputs = {name: os.path.join(out_dir, f"{stem}_{name}.npy") for name in ('X', 'lengths', 'labels')}
+    x_data = np.lib.format.open_memmap(outputs['X'], mode='w+', dtype=np.float32,
+                                       shape=(sample_count, max_length, dimension_count))
+    lengths = np.zeros((sample_count, dimension_count), dtype=np.int32)
+    with open(path, encoding='utf-8') as f:
+        for sample_idx, (dimensions, _) in enumerate(reader(f)):
+            for var_idx, values in enumerate(dimensions):
+                x_data[sample_idx, :len(values), var_idx] = values
+                lengths[sample_idx, var_idx] = len(values)
+            if progress is not None and sample_idx % 1000 == 0:
+                progress(sample_idx, sample_count)
+    x_data.flush()
+    del x_data
+    np.save(outputs['lengths'], lengths)
+    if all(label is not None for label in labels):
+        np.save(outputs['labels'], np.array(labels))
+    else:
+        del outputs['labels']
+    return outputs, (sample_count, max_length, dimension_count)
+
+
+PREFETCH_BYTES = 64 * 1024 * 1024  # 选择文件后预读进页缓存的字节数上限
+
+
+def read_npy_header(f):
+    """从已打开的.npy文件读取(shape, dtype, 数据起始偏移)，不读取数据本身"""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype, f.tell()
+
+
+def inspect_array_file(path):
+    """读取.npy头或NPZ成员目录，返回 {成员名: (shape, dtype)}，.npy文件的成员名为None"""
+    if not zipfile.is_zipfile(path):
+        with open(path, "rb") as f:
+            shape, dtype, _ = read_npy_header(f)
+        return {None: (shape, dtype)}
+    members = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if name.endswith(".npy"):
+                with archive.open(name) as f:
+                    members[name[:-4]] = read_npy_header(f)[:2]
+    return members
+
+
+def file_compatibility_problems(shapes_info, raw_shape):
+    """检查shape文件 (arr_0, arr_1) 与原始数据 (sample, length, dimension) 的维度是否一致"""
+    problems = []
+    if shapes_info is not None:
+        for name in ("arr_0", "arr_1"):
+            if name not in shapes_info:
+                problems.append(f"{name} missing from NPZ")
+            elif len(shapes_info[name][0]) != 3:
+                problems.append(f"{name} should be 3D, got {shapes_info[name][0]}")
+        if not problems:
+            arr_0_shape, arr_1_shape = shapes_info["arr_0"][0], shapes_info["arr_1"][0]
+            if arr_0_shape[:2] != arr_1_shape[:2]:
+                problems.append(f"arr_0 {arr_0_shape} and arr_1 {arr_1_shape} differ in instances/shapes")
+            if arr_1_shape[2] < 4:
+                problems.append(f"arr_1 needs 4 VP fields, got {arr_1_shape[2]}")
+    if raw_shape is not None and len(raw_shape) != 3:
+        problems.append(f"raw data should be 3D, got {raw_shape}")
+    elif raw_shape is not None and shapes_info is not None and not problems:
+        if shapes_info["arr_0"][0][0] != raw_shape[0]:
+            problems.append(f"{shapes_info['arr_0'][0][0]} shape instances vs {raw_shape[0]} raw instances")
+        if shapes_info["arr_0"][0][2] > raw_shape[1]:
+            problems.append(f"shape length {shapes_info['arr_0'][0][2]} exceeds series length {raw_shape[1]}")
+    return problems
+
+
+def prefetch_file(path, offset=0, nbytes=PREFETCH_BYTES):
+    """把文件的一段读入操作系统页缓存，返回读取的字节数"""
+    buffer = bytearray(1024 * 1024)
+    done = 0
+    with open(path, "rb", buffering=0) as f:
+        f.seek(offset)
+        while done < nbytes:
+            count = f.readinto(memoryview(buffer)[:min(len(buffer), nbytes - done)])
+            if not count:
+                break
+            done += count
+    return done
+
+
+def warm_up_files(npz_path, npy_path):
+    """读取文件头并检查兼容性，再把前几个instance预读进页缓存，返回结果字典"""
+    result = {'shapes': None, 'raw': None, 'problems': [], 'prefetched': 0}
+    if npz_path:
+        result['shapes'] = inspect_array_file(npz_path)
+    if npy_path:
+        result['raw'] = inspect_array_file(npy_path)[None]
+    result['problems'] = file_compatibility_problems(
+        result['shapes'], result['raw'][0] if result['raw'] is not None else None)
+
+    if npy_path:
+        with open(npy_path, "rb") as f:
+            shape, dtype, offset = read_npy_header(f)
+        result['prefetched'] += prefetch_file(npy_path, offset)
+    if npz_path:
+        # 已有内存映射缓存时加载会读取缓存，否则读取NPZ本身
+        directory = artifact_dir(npz_path)
+        cached = [os.path.join(directory, name + ".npy") for name in ("arr_0", "arr_1")]
+        for path in cached if all(os.path.exists(path) for path in cached) else [npz_path]:
+            result['prefetched'] += prefetch_file(path, 0, PREFETCH_BYTES // 2)
+    return result
+
+
+def array_nbytes(value):
+    """统计驻留内存的字节数（内存映射数组由操作系统管理，不计入）"""
+    if isinstance(value, (tuple, list)):
+        return sum(array_nbytes(item) for item in value)
+    if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+        return value.nbytes
+    if isinstance(value, SparseHeatmap):
+        return value.nbytes
+    return 0
+
+
+class SharedArrayHost:
+    """按文件指纹把数组放入multiprocessing共享内存段，后续进程零拷贝附加；
+    每个段登记使用它的进程号，最后一个进程释放时删除段"""
+
+    def __init__(self, directory=SHARED_MEMORY_DIR):
+        self.directory = directory
+        self.segments = {}  # 段名 -> (SharedMemory, 数组)
+
+    @staticmethod
+    def segment_name(fingerprint, member):
+        return "visa_" + hashlib.sha1(f"{fingerprint}|{member}".encode("utf-8")).hexdigest()[:20]
+
+    def locked_meta(self, name):
+        """返回段的元数据路径和已加锁的锁文件（元数据的读写都在锁内进行）"""
+        import fcntl
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, name + ".lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return os.path.join(self.directory, name + ".json"), lock
+
+    @staticmethod
+    def read_meta(meta_path):
+        """读取元数据并剔除已退出的进程"""
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        live = []
+        for pid in meta.get('pids', []):
+            try:
+                os.kill(pid, 0)
+                live.append(pid)
+            except PermissionError:
+                live.append(pid)
+            except OSError:
+                pass
+        meta['pids'] = live
+        return meta
+
+    @staticmethod
+    def write_meta(meta_path, meta):
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def open_segment(name, size=None):
+        """创建或附加共享内存段，并从resource tracker注销，避免进程退出时删除其他进程仍在使用的段"""
+        from multiprocessing import shared_memory, resource_tracker
+        if size is None:
+            shm = shared_memory.SharedMemory(name=name)
+        else:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, size))
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    def fetch(self, path, member, loader):
+        """返回共享内存中的数组，首次使用时调用loader()加载并复制进共享段；非稠密数组直接返回"""
+        name = self.segment_name(file_fingerprint(path), member)
+        if name in self.segments:
+            return self.segments[name][1]
+
+        meta_path, lock = self.locked_meta(name)
+        try:
+            meta = self.read_meta(meta_path)
+            shm = None
+            if meta is not None:
+                try:
+                    shm = self.open_segment(name)
+                except FileNotFoundError:
+                    meta = None  # 段已随重启等消失，重新创建
+            if shm is None:
+                value = loader()
+                if not isinstance(value, np.ndarray):
+                    return value
+                shm = self.open_segment(name, value.nbytes)
+                array = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+                np.copyto(array, value)
+                del value
+                meta = {'dtype': array.dtype.str, 'shape': list(array.shape), 'pids': []}
+            array = np.ndarray(tuple(meta['shape']), dtype=np.dtype(meta['dtype']), buffer=shm.buf)
+            array.flags.writeable = False
+            meta['pids'].append(os.getpid())
+            self.write_meta(meta_path, meta)
+            self.segments[name] = (shm, array)
+            return array
+        finally:
+            lock.close()
+
+    def release(self, fingerprint, member):
+        """本进程不再使用该文件成员：解除映射并注销，没有进程再使用时删除共享段"""
+        self.release_segment(self.segment_name(fingerprint, member))
+
+    def release_segment(self, name):
+        if name not in self.segments:
+            return
+        shm, _ = self.segments.pop(name)
+        meta_path, lock = self.locked_meta(name)
+        try:
+            meta = self.read_meta(meta_path) or {'pids': []}
+            meta['pids'] = [pid for pid in meta['pids'] if pid != os.getpid()]
+            if meta['pids']:
+                self.write_meta(meta_path, meta)
+            else:
+                from multiprocessing import resource_tracker
+                resource_tracker.register(shm._name, "shared_memory")  # unlink()会再次注销
+                shm.unlink()
+                os.remove(meta_path)
+        except OSError:
+            pass
+        finally:
+            lock.close()
+        try:
+            shm.close()
+        except BufferError:
+            pass  # 仍有数组视图引用映射，视图释放或进程退出时再解除
+
+    def release_all(self):
+        """注销本进程使用的所有共享段"""
+        for name in list(self.segments):
+            self.release_segment(name)
+
+
+class DatasetWorkspace:
+    """同时保存多个数据集：数组按文件指纹共享，在全局内存预算下按LRU释放非活动数组"""
+
+    def __init__(self, budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.arrays = OrderedDict()  # (fingerprint, member) -> 数组，按最近使用排序
+        self.datasets = OrderedDict()  # 名称 -> {'npz', 'npy', 'heatmap', 'attention'}路径
+        self.active_paths = {}
+        self.shared = SharedArrayHost() if SHARED_MEMORY_ENABLED and os.name == "posix" else None
+
+    def fetch(self, path, member, loader):
+        """返回指定文件成员的数组，未驻留时调用loader()加载（启用共享内存时从共享段附加）"""
+        key = (file_fingerprint(path), member)
+        if key in self.arrays:
+            self.arrays.move_to_end(key)
+            return self.arrays[key]
+
+        if self.shared is not None and member in SHARED_MEMORY_MEMBERS:
+            value = self.shared.fetch(path, member, loader)
+        else:
+            value = loader()
+        self.arrays[key] = value
+        self.enforce_budget(keep=key)
+        return value
+
+    def resident_bytes(self):
+        return sum(array_nbytes(value) for value in self.arrays.values())
+
+    def enforce_budget(self, keep=None):
+        """超出预算时从最久未使用的非活动数组开始释放"""
+        pinned = set()
+        for path in self.active_paths.values():
+            try:
+                pinned.add(file_fingerprint(path))
+            except OSError:
+                pass
+
+        resident = self.resident_bytes()
+        for key in list(self.arrays):
+            if resident <= self.budget_bytes:
+                break
+            if key[0] in pinned or key == keep:
+                continue
+            resident -= array_nbytes(self.arrays.pop(key))
+            if self.shared is not None:
+                self.shared.release(*key)  # 共享段由SharedArrayHost持有，需同时解除才真正释放
+
+    def add_dataset(self, name, paths):
+        """登记一个数据集，重名时自动添加序号"""
+        base_name, suffix = name, 2
+        while name in self.datasets and self.datasets[name] != paths:
+            name = f"{base_name} ({suffix})"
+            suffix += 1
+        self.datasets[name] = dict(paths)
+        return name
+
+    def remove_dataset(self, name):
+        """关闭数据集并释放只被它使用的数组"""
+        paths = self.datasets.pop(name, None)
+        if not paths:
+            return
+        still_used = set(self.active_paths.values())
+        for other in self.datasets.values():
+            still_used.update(other.values())
+        for path in paths.values():
+            if path in still_used or not os.path.exists(path):
+                continue
+            fingerprint = file_fingerprint(path)
+            for key in [key for key in self.arrays if key[0] == fingerprint]:
+                del self.arrays[key]
+                if self.shared is not None:
+                    self.shared.release(*key)
+
+    def set_active(self, paths):
+        self.active_paths = {key: path for key, path in paths.items() if path}
+        self.enforce_budget()
+
+    def close(self):
+        """关闭工作区并释放本进程持有的共享内存段"""
+        self.arrays.clear()
+        if self.shared is not None:
+            self.shared.release_all()
+
+
+def motif_density(arr_1, sorted_indices, top_k, series_length, variable_count, valid_mask=None, weights=None):
+    """用差分数组累计每个instance的top-k shape在(variable, time)上的覆盖次数（或attention加权）"""
+    sample_count = min(arr_1.shape[0], sorted_indices.shape[0])
+    top = np.asarray(sorted_indices[:sample_count, :top_k])
+    in_range = top < arr_1.shape[1]
+    top = np.where(in_range, top, 0)
+    rows = np.arange(sample_count)[:, None]
+    vp = np.asarray(arr_1[:sample_count][rows, top, :4], dtype=np.float64)
+    start, end, label = vp[..., 1], vp[..., 2], vp[..., 3]
+
+    # 只累计范围有效的记录
+    keep = (np.isfinite(vp[..., 1:4]).all(axis=2) & (label == np.floor(label)) & (label >= 0) &
+            (label < variable_count) & (start >= 0) & (start < end) & (end <= series_length) & in_range)
+    if valid_mask is not None:
+        keep &= np.asarray(valid_mask)[rows, top]
+    label, start, end = label[keep].astype(np.int64), start[keep].astype(np.int64), end[keep].astype(np.int64)
+    values = np.ones(len(label)) if weights is None else np.asarray(weights[:sample_count])[rows, top][keep]
+
+    # 起点+w、终点-w，再沿时间累加
+    width = series_length + 1
+    diff = np.bincount(label * width + start, values, minlength=variable_count * width)
+    diff -= np.bincount(label * width + end, values, minlength=variable_count * width)
+    density = np.cumsum(diff.reshape(variable_count, width), axis=1)[:, :series_length]
+    return density, len(label)
+
+
+def attention_saliency(arr_1, attention_means, x_shape, valid_mask=None, chunk_size=256):
+    """把每个shape的平均attention按arr_1的[start, end)区间累加到原始时间轴上，
+    所有instance一起用差分数组计算，返回与x_train同形的 (sample, length, dimension) 数组"""
+    sample_count, series_length, variable_count = x_shape
+    saliency = np.zeros(x_shape, dtype=np.float32)
+    shape_count = min(arr_1.shape[1], attention_means.shape[1])
+    width = series_length + 1
+    for block_start in range(0, min(sample_count, arr_1.shape[0], attention_means.shape[0]), chunk_size):
+        block_end = min(block_start + chunk_size, sample_count, arr_1.shape[0], attention_means.shape[0])
+        vp = np.asarray(arr_1[block_start:block_end, :shape_count, :4], dtype=np.float64)
+        weights = np.asarray(attention_means[block_start:block_end, :shape_count], dtype=np.float64)
+        start, end, label = vp[..., 1], vp[..., 2], vp[..., 3]
+
+        keep = (np.isfinite(vp[..., 1:4]).all(axis=2) & np.isfinite(weights) & (label == np.floor(label)) &
+                (label >= 0) & (label < variable_count) & (start >= 0) & (start < end) & (end <= series_length))
+        if valid_mask is not None:
+            keep &= np.asarray(valid_mask[block_start:block_end, :shape_count])
+        rows = np.broadcast_to(np.arange(block_end - block_start)[:, None], keep.shape)[keep]
+        base = (rows * variable_count + label[keep].astype(np.int64)) * width
+
+        # 每个(instance, variable)一行：起点+w、终点-w，再沿时间累加
+        size = (block_end - block_start) * variable_count * width
+        diff = np.bincount(base + start[keep].astype(np.int64), weights[keep], minlength=size)
+        diff -= np.bincount(base + end[keep].astype(np.int64), weights[keep], minlength=size)
+        block = np.cumsum(diff.reshape(block_end - block_start, variable_count, width), axis=2)
+        saliency[block_start:block_end] = block[:, :, :series_length].transpose(0, 2, 1)
+    return saliency
+
+
+# 查询字段（instance、shape、variable编号均从1开始，与界面一致）
+QUERY_FIELDS = {
+    'rank': "rank[k]: attention rank of shape k",
+    'top_shape': "shape number of the top-ranked shape",
+    'top_weight': "mean attention of the top-ranked shape",
+    'top_var': "variable of the top-ranked shape",
+    'top_start': "start time of the top-ranked shape",
+    'top_end': "end time of the top-ranked shape",
+    'max_pair': "largest off-diagonal heatmap weight",
+    'instance': "instance number",
+}
+QUERY_OPERATORS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+                   '==': np.equal, '!=': np.not_equal}
+QUERY_CLAUSE = re.compile(r'^\s*(\w+)\s*(?:\[\s*(\d+)\s*\])?'  # 字段名和可选的[shape编号]
+                          r'\s*(<=|>=|==|!=|<|>)\s*([-+]?[\d.]+(?:[eE][-+]?\d+)?)\s*$')
+
+
+def heatmap_max_pair(heatmap, chunk_size=64):
+    """每个instance中heatmap非对角元素的最大值"""
+    sample_count, shape_count = heatmap.shape[:2]
+    if isinstance(heatmap, SparseHeatmap):
+        rows = np.repeat(np.arange(sample_count * shape_count), np.diff(heatmap.indptr))
+        values = np.where(heatmap.indices != rows % shape_count, heatmap.data, -np.inf)
+        result = np.full(sample_count, -np.inf)
+        np.maximum.at(result, rows // shape_count, values)
+        return result
+    off_diagonal = ~np.eye(shape_count, dtype=bool)
+    result = np.empty(sample_count)
+    for start in range(0, sample_count, chunk_size):
+        block = np.asarray(heatmap[start:start + chunk_size])
+        result[start:start + chunk_size] = np.where(off_diagonal, block, -np.inf).max(axis=(1, 2))
+    return result
+
+
+def build_query_index(sorted_indices=None, attention_means=None, arr_1=None, heatmap=None):
+    """由attention排序、VP记录和heatmap摘要建立按instance的列式索引"""
+    index = {}
+    if sorted_indices is not None:
+        sample_count, shape_count = sorted_indices.shape
+        ranks = np.empty((sample_count, shape_count), dtype=np.int32)
+        np.put_along_axis(ranks, np.asarray(sorted_indices), np.arange(1, shape_count + 1, dtype=np.int32), axis=1)
+        top = np.asarray(sorted_indices[:, 0])
+        index['rank'] = ranks
+        index['top_shape'] = top + 1
+        if attention_means is not None:
+            index['top_weight'] = np.asarray(attention_means)[np.arange(sample_count), top]
+        if arr_1 is not None:
+            count = min(sample_count, arr_1.shape[0])
+            vp = np.full((sample_count, 4), np.nan)
+            in_range = top[:count] < arr_1.shape[1]
+            vp[:count][in_range] = arr_1[np.arange(count)[in_range], top[:count][in_range], :4]
+            index['top_var'] = vp[:, 3] + 1
+            index['top_start'] = vp[:, 1]
+            index['top_end'] = vp[:, 2]
+    if heatmap is not None:
+        index['max_pair'] = heatmap_max_pair(heatmap)
+    if index:
+        index['instance'] = np.arange(1, min(len(column) for column in index.values()) + 1)
+    return index
+
+
+def run_instance_query(index, query):
+    """执行如 "rank[12] <= 5 and top_var == 3 or max_pair > 0.8" 的查询，返回匹配的instance（0索引）"""
+    if not index:
+        raise ValueError("Please load attention or heatmap data first!")
+    sample_count = len(index['instance'])
+    result = np.zeros(sample_count, dtype=bool)
+    # and优先于or
+    for alternative in re.split(r'\s+or\s+', query.strip(), flags=re.IGNORECASE):
+        mask = np.ones(sample_count, dtype=bool)
+        for clause in re.split(r'\s+and\s+', alternative, flags=re.IGNORECASE):
+            match = QUERY_CLAUSE.match(clause)
+            if match is None:
+                raise ValueError(f"Cannot parse clause: {clause.strip()!r}")
+            field, shape_number, operator, value = match.groups()
+            field = field.lower()
+            if field not in index:
+                raise ValueError(f"Unknown field or data not loaded: {field}")
+            column = index[field]
+            if field == 'rank':
+                if shape_number is None or not 1 <= int(shape_number) <= column.shape[1]:
+                    raise ValueError(f"rank needs a shape number between 1 and {column.shape[1]}, e.g. rank[12]")
+                column = column[:, int(shape_number) - 1]
+            elif shape_number is not None:
+                raise ValueError(f"Field {field} does not take a shape number")
+            mask &= QUERY_OPERATORS[operator](column[:sample_count], float(value))
+        result |= mask
+    return np.flatnonzero(result)
+
+
+def randomized_pca(data, components=2, oversample=10, power_iterations=2, chunk_size=4096, seed=0):
+    """分块随机化PCA：只需按instance分块计算A@M和A.T@M，返回(投影坐标, 各成分方差占比)"""
+    sample_count, feature_count = data.shape
+    blocks = [(start, min(start + chunk_size, sample_count)) for start in range(0, sample_count, chunk_size)]
+    center = sum(np.asarray(data[start:end], dtype=np.float64).sum(axis=0) for start, end in blocks) / sample_count
+
+    def times(matrix):  # (A - center) @ matrix
+        return np.concatenate([(np.asarray(data[start:end], dtype=np.float64) - center) @ matrix
+                               for start, end in blocks])
+
+    def transposed_times(matrix):  # (A - center).T @ matrix
+        return sum((np.asarray(data[start:end], dtype=np.float64) - center).T @ matrix[start:end]
+                   for start, end in blocks)
+
+    rank = min(components + oversample, sample_count, feature_count)
+    basis = np.linalg.qr(times(np.random.default_rng(seed).standard_normal((feature_count, rank))))[0]
+    for _ in range(power_iterations):
+        basis = np.linalg.qr(times(np.linalg.qr(transposed_times(basis))[0]))[0]
+    _, singular_values, vt = np.linalg.svd(transposed_times(basis).T, full_matrices=False)
+
+    total_variance = sum(np.square(np.asarray(data[start:end], dtype=np.float64) - center).sum()
+                         for start, end in blocks)
+    explained = singular_values[:components] ** 2 / total_variance if total_variance > 0 else np.zeros(components)
+    return times(vt[:components].T), explained
+
+
+class KDTree2D:
+    """二维KD树，用于散点图的最近邻拾取"""
+
+    def __init__(self, points, leaf_size=16):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.order = np.arange(len(self.points))
+        self.leaf_size = leaf_size
+        self.nodes = []  # (start, end, axis, split, left, right)，叶节点left为-1
+        if len(self.points):
+            self.build(0, len(self.points))
+
+    def build(self, start, end):
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+        if end - start <= self.leaf_size:
+            self.nodes[node_id] = (start, end, 0, 0.0, -1, -1)
+            return node_id
+        points = self.points[self.order[start:end]]
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        middle = (end - start) // 2
+        part = np.argpartition(points[:, axis], middle)
+        self.order[start:end] = self.order[start:end][part]
+        split = self.points[self.order[start + middle], axis]
+        left = self.build(start, start + middle)
+        right = self.build(start + middle, end)
+        self.nodes[node_id] = (start, end, axis, split, left, right)
+        return node_id
+
+    def nearest(self, point):
+        """返回(最近点的索引, 距离)，树为空时返回(-1, inf)"""
+        point = np.asarray(point, dtype=np.float64)
+        best_index, best_distance = -1, np.inf
+        stack = [(0, 0.0)] if self.nodes else []
+        while stack:
+            node_id, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            start, end, axis, split, left, right = self.nodes[node_id]
+            if left < 0:
+                indices = self.order[start:end]
+                distances = np.square(self.points[indices] - point).sum(axis=1)
+                i = int(np.argmin(distances))
+                if distances[i] < best_distance:
+                    best_index, best_distance = int(indices[i]), float(distances[i])
+                continue
+            diff = point[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, diff * diff))
+            stack.append((near, 0.0))
+        return best_index, np.sqrt(best_distance)
+
+
+def clamp_heatmap_view(heatmap_shape, sample_idx, start_shape, end_shape):
+    """校正heatmap视图参数（0索引），起止范围无效时抛出ValueError"""
+    if sample_idx >= heatmap_shape[0] or sample_idx < 0:
+        sample_idx = 0
+    if start_shape < 0:
+        start_shape = 0
+    if end_shape > heatmap_shape[1]:
+        end_shape = heatmap_shape[1]
+    if start_shape >= end_shape:
+        raise ValueError("Start shape must be less than end shape!")
+    return sample_idx, start_shape, end_shape
+
+
+class SparseHeatmap:
+    """按行保留top-k（或超过阈值）元素的CSR格式heatmap，第 instance * shape_number + shape 行对应一行"""
+
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = tuple(int(size) for size in shape)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    def dense_block(self, sample_idx, start_shape, end_shape):
+        """还原一个instance的[start, end)方块，未保留的元素为0"""
+        size = end_shape - start_shape
+        row_base = sample_idx * self.shape[1]
+        ptr = self.indptr[row_base + start_shape:row_base + end_shape + 1]
+        low, high = int(ptr[0]), int(ptr[-1])
+        rows = np.repeat(np.arange(size), np.diff(ptr))
+        cols = self.indices[low:high].astype(np.int64) - start_shape
+        keep = (cols >= 0) & (cols < size)
+        block = np.zeros((size, size), dtype=self.data.dtype)
+        block[rows[keep], cols[keep]] = self.data[low:high][keep]
+        return block
+
+    def block_marginals(self, sample_idx, start_shape, end_shape):
+        """直接由CSR行计算[start, end)方块内每行、每列的和，返回(行和, 列和)"""
+        size = end_shape - start_shape
+        row_base = sample_idx * self.shape[1]
+        ptr = self.indptr[row_base + start_shape:row_base + end_shape + 1]
+        low, high = int(ptr[0]), int(ptr[-1])
+        rows = np.repeat(np.arange(size), np.diff(ptr))
+        cols = self.indices[low:high].astype(np.int64) - start_shape
+        keep = (cols >= 0) & (cols < size)
+        values = self.data[low:high][keep].astype(np.float64)
+        return (np.bincount(rows[keep], values, minlength=size),
+                np.bincount(cols[keep], values, minlength=size))
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices, data=self.data, shape=np.asarray(self.shape))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['indptr'], f['indices'], f['data'], f['shape'])
+
+
+def sparsify_heatmap(heatmap, top_k=None, threshold=None, chunk_size=64):
+    """把稠密heatmap按行保留top-k和/或大于阈值的元素，按instance分块转换为SparseHeatmap"""
+    if not top_k and threshold is None:
+        raise ValueError("Specify a top-k value and/or a threshold")
+    sample_count, shape_count = heatmap.shape[:2]
+    k = min(int(top_k), shape_count) if top_k else shape_count
+    counts, indices, data = [], [], []
+    for start in range(0, sample_count, chunk_size):
+        block = np.asarray(heatmap[start:start + chunk_size]).reshape(-1, shape_count)
+        if k < shape_count:
+            cols = np.sort(np.argpartition(block, -k, axis=1)[:, -k:], axis=1)
+        else:
+            cols = np.broadcast_to(np.arange(shape_count), block.shape)
+        values = np.take_along_axis(block, cols, axis=1)
+        keep = np.ones(values.shape, dtype=bool) if threshold is None else values > threshold
+        counts.append(keep.sum(axis=1))
+        indices.append(cols[keep].astype(np.int32))
+        data.append(values[keep])
+
+    indptr = np.zeros(sample_count * shape_count + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=indptr[1:])
+    return SparseHeatmap(indptr, np.concatenate(indices), np.concatenate(data), heatmap.shape)
+
+
+def load_heatmap_array(path, mmap_mode=None):
+    """加载heatmap：.npz为稀疏格式，其余按稠密.npy加载"""
+    if path.lower().endswith('.npz'):
+        return SparseHeatmap.load(path)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def prefix_sums_2d(blocks):
+    """沿最后两个轴计算二维前缀和（summed-area table），首行首列补0，(..., R, C) -> (..., R+1, C+1)"""
+    blocks = np.asarray(blocks, dtype=np.float64)
+    table = np.zeros(blocks.shape[:-2] + (blocks.shape[-2] + 1, blocks.shape[-1] + 1))
+    np.cumsum(blocks, axis=-2, out=table[..., 1:, 1:])
+    np.cumsum(table[..., 1:, 1:], axis=-1, out=table[..., 1:, 1:])
+    return table
+
+
+def build_summed_area_tables(heatmap, path, chunk_size=16):
+    """按instance分块计算所有稠密heatmap的二维前缀和，写入 (sample, S+1, S+1) 的内存映射旁路文件"""
+    sample_count, shape_count = heatmap.shape[:2]
+    prepare_artifact_dir(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    tables = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                       shape=(sample_count, shape_count + 1, shape_count + 1))
+    for start in range(0, sample_count, chunk_size):
+        end = min(start + chunk_size, sample_count)
+        tables[start:end] = prefix_sums_2d(heatmap[start:end])
+    tables.flush()
+    del tables
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def block_sum(table, row_start, row_end, col_start, col_end):
+    """用二维前缀和在O(1)内求矩形块[row_start, row_end) x [col_start, col_end)之和，参数可为数组"""
+    return (table[row_end, col_end] - table[row_start, col_end]
+            - table[row_end, col_start] + table[row_start, col_start])
+
+
+def block_marginals(table, start, end):
+    """方形范围[start, end)内每行、每列的和，返回(行和, 列和)"""
+    positions = np.arange(start, end)
+    return (block_sum(table, positions, positions + 1, start, end),
+            block_sum(table, start, end, positions, positions + 1))
+
+
+def average_linkage_order(features):
+    """平均连接层次聚类（最近邻链算法）的叶节点顺序，features为(item, feature)"""
+    features = np.asarray(features, dtype=np.float64)
+    item_count = len(features)
+    squared = np.square(features).sum(axis=1)
+    distances = np.sqrt(np.maximum(squared[:, None] + squared[None, :] - 2 * features @ features.T, 0.0))
+    np.fill_diagonal(distances, np.inf)
+    sizes = np.ones(item_count)
+    leaves = [[item] for item in range(item_count)]
+    chain = []
+    for _ in range(item_count - 1):
+        while True:
+            if not chain:
+                chain.append(next(item for item in range(item_count) if leaves[item] is not None))
+            current = chain[-1]
+            nearest = int(np.argmin(distances[current]))
+            if len(chain) > 1 and distances[current, chain[-2]] <= distances[current, nearest]:
+                nearest = chain[-2]
+            if len(chain) > 1 and nearest == chain[-2]:
+                break
+            chain.append(nearest)
+
+        # 合并链尾的一对互为最近邻的类，按Lance-Williams公式更新平均距离
+        second, first = chain.pop(), chain.pop()
+        keep, drop = min(first, second), max(first, second)
+        merged = (sizes[keep] * distances[keep] + sizes[drop] * distances[drop]) / (sizes[keep] + sizes[drop])
+        distances[keep] = distances[:, keep] = merged
+        distances[drop] = distances[:, drop] = np.inf
+        distances[keep, keep] = np.inf
+        sizes[keep] += sizes[drop]
+        leaves[keep] = leaves[keep] + leaves[drop]
+        leaves[drop] = None
+    return np.array(next(leaf for leaf in leaves if leaf is not None) if item_count else [], dtype=np.int64)
+
+
+def heatmap_block(heatmap, sample_idx, start_shape, end_shape):
+    """取出一个instance的方块切片，稠密数组和SparseHeatmap都适用"""
+    if isinstance(heatmap, SparseHeatmap):
+        return heatmap.dense_block(sample_idx, start_shape, end_shape)
+    return heatmap[sample_idx, start_shape:end_shape, start_shape:end_shape]
+
+
+def parse_vp(arr_1, sample_idx, shape_idx):
+    """解析VP记录，返回(length, start, end, label)"""
+    vp_data = arr_1[sample_idx, shape_idx, :]
+    if len(vp_data) < 4:
+        raise ValueError("VP data format is incorrect.")
+    return int(vp_data[0]), int(vp_data[1]), int(vp_data[2]), vp_data[3]
+
+
+VP_CHECKS = [
+    ('non_finite', "non-finite VP values"),
+    ('variable_out_of_range', "variable label out of range"),
+    ('start_out_of_range', "start out of range"),
+    ('end_out_of_range', "end beyond series length"),
+    ('inverted_span', "start >= end"),
+    ('length_mismatch', "length field differs from series length"),
+    ('span_exceeds_shape', "span longer than arr_0 shape length"),
+]
+
+
+def vp_problem_block(arr_1, series_length, variable_count, shape_length):
+    """向量化检查一块sample的VP记录，返回各类问题掩码"""
+    vp = np.asarray(arr_1[:, :, :4], dtype=np.float64)
+    length, start, end, label = vp[..., 0], vp[..., 1], vp[..., 2], vp[..., 3]
+
+    finite = np.isfinite(vp).all(axis=2)
+    problems = {
+        'non_finite': ~finite,
+        'variable_out_of_range': finite & ((label != np.floor(label)) | (label < 0) | (label >= variable_count)),
+        'start_out_of_range': finite & ((start < 0) | (start >= series_length)),
+        'end_out_of_range': finite & (end > series_length),
+        'inverted_span': finite & (start >= end),
+        'length_mismatch': finite & (length != series_length),
+        'span_exceeds_shape': finite & (end - start > shape_length),
+    }
+    return problems
+
+
+def validate_vp_records(arr_0, arr_1, x_train_shape):
+    """按instance分块并行检查所有VP记录，返回(有效掩码 (sample, shape_number), 各类问题掩码)"""
+    if arr_1.shape[2] < 4:
+        raise ValueError("VP data format is incorrect.")
+    _, series_length, variable_count = x_train_shape
+    problems = PREPROCESS_EXECUTOR.map_rows(vp_problem_block, [arr_1],
+                                            (series_length, variable_count, arr_0.shape[2]))
+    invalid = np.zeros(arr_1.shape[:2], dtype=bool)
+    for mask in problems.values():
+        invalid |= mask
+    return ~invalid, problems
+
+
+def vp_validation_report(arr_0, arr_1, x_train_shape, problems, max_examples=5):
+    """生成VP检查结果的文字报告"""
+    lines = []
+    if arr_0.shape[:2] != arr_1.shape[:2]:
+        lines.append(f"arr_0 {arr_0.shape[:2]} and arr_1 {arr_1.shape[:2]} instance/shape counts differ")
+    if arr_1.shape[0] != x_train_shape[0]:
+        lines.append(f"arr_1 has {arr_1.shape[0]} instances but x_train has {x_train_shape[0]}")
+
+    for key, description in VP_CHECKS:
+        count = int(np.count_nonzero(problems[key]))
+        if count:
+            examples = np.argwhere(problems[key])[:max_examples] + 1
+            example_text = ", ".join(f"({sample}, {shape})" for sample, shape in examples)
+            lines.append(f"  {description}: {count}  e.g. (instance, shape) {example_text}")
+
+    total = sum(int(np.count_nonzero(problems[key])) for key, _ in VP_CHECKS)
+    if len(lines) == 0 and total == 0:
+        return "VP check: all records valid"
+    return "VP check found problems:\n" + "\n".join(lines)
+
+
+def tk_figure_classes():
+    """延迟导入matplotlib的Figure和Tk后端（首次创建图形时才加载）"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    return Figure, FigureCanvasTkAgg, NavigationToolbar2Tk
+
+
+def gallery_segments(shapes, lengths, columns, pad=0.08):
+    """把n个shape排成网格，生成单个LineCollection使用的线段数组 (n, shape_length, 2)
+
+    每个shape在自己的单元格内做min-max缩放，填充部分置为nan，第row行占据y∈[-row-1, -row]。
+    """
+    shape_count, shape_length = shapes.shape
+    lengths = np.clip(lengths, 1, shape_length)
+    positions = np.arange(shape_length)
+    valid = positions[None, :] < lengths[:, None]
+
+    # 只在有效部分内缩放
+    values = np.where(valid, shapes, np.nan)
+    low = np.nanmin(values, axis=1, keepdims=True)
+    high = np.nanmax(values, axis=1, keepdims=True)
+    span = np.where(high > low, high - low, 1.0)
+    scaled = (values - low) / span
+
+    cell = np.arange(shape_count)
+    row, col = np.divmod(cell, columns)
+    x = col[:, None] + pad + positions[None, :] / np.maximum(lengths[:, None] - 1, 1) * (1 - 2 * pad)
+    y = -row[:, None] - 1 + pad + scaled * (1 - 2 * pad)
+    return np.stack([np.where(valid, x, np.nan), y], axis=2)
+
+
+def shape_lengths(arr_1, shape_length):
+    """由VP记录得到每个shape的有效长度，无效记录按完整长度处理"""
+    span = np.asarray(arr_1[..., 2], dtype=np.float64) - np.asarray(arr_1[..., 1], dtype=np.float64)
+    return np.clip(np.nan_to_num(span, nan=shape_length), 1, shape_length).astype(np.int64)
+
+
+def resample_shapes(shapes, lengths, target_length):
+    """把每个shape的有效部分线性插值到相同长度，shapes为(n, shape_length)"""
+    shapes = np.asarray(shapes, dtype=np.float64)
+    positions = (lengths[:, None] - 1) * np.linspace(0.0, 1.0, target_length)[None, :]
+    low = np.floor(positions).astype(np.int64)
+    high = np.minimum(low + 1, lengths[:, None] - 1)
+    fraction = positions - low
+    return (np.take_along_axis(shapes, low, axis=1) * (1 - fraction) +
+            np.take_along_axis(shapes, high, axis=1) * fraction)
+
+
+def znormalize(rows):
+    """按行z归一化，常数行置为0"""
+    mean = rows.mean(axis=1, keepdims=True)
+    std = rows.std(axis=1, keepdims=True)
+    return (rows - mean) / np.where(std > 1e-8, std, 1.0)
+
+
+def minibatch_kmeans_shapes(arr_0, arr_1, clusters, valid_mask=None, batch_size=1024, epochs=3,
+                            chunk_shapes=65536, seed=0):
+    """对重采样并z归一化的shape做mini-batch k-means，按instance分块读取，返回(labels (sample, shape_number), 中心)"""
+    sample_count, shape_count, shape_length = arr_0.shape
+    rows_per_chunk = max(1, chunk_shapes // shape_count)
+    rng = np.random.default_rng(seed)
+
+    def chunks():
+        for start in range(0, sample_count, rows_per_chunk):
+            end = min(start + rows_per_chunk, sample_count)
+            block = np.asarray(arr_0[start:end], dtype=np.float64).reshape(-1, shape_length)
+            lengths = shape_lengths(arr_1[start:end], shape_length).reshape(-1)
+            keep = (np.ones(len(block), dtype=bool) if valid_mask is None
+                    else np.asarray(valid_mask[start:end]).reshape(-1))
+            yield start, end, znormalize(resample_shapes(block, lengths, shape_length)), keep
+
+    def assign(rows, centroids):
+        distances = np.square(centroids).sum(axis=1)[None, :] - 2 * rows @ centroids.T
+        return np.argmin(distances, axis=1)
+
+    centroids = None
+    counts = np.zeros(clusters)
+    for _ in range(epochs):
+        for _, _, rows, keep in chunks():
+            rows = rows[keep]
+            rows = rows[rng.permutation(len(rows))]
+            if centroids is None:
+                if len(rows) < clusters:
+                    raise ValueError(f"Need at least {clusters} valid shapes in the first chunk to start clustering")
+                # 在第一个块的样本上做k-means++初始化
+                sample = rows[:4096]
+                centroids = [sample[0]]
+                nearest = np.square(sample - sample[0]).sum(axis=1)
+                for _ in range(1, clusters):
+                    probabilities = nearest / nearest.sum() if nearest.sum() > 0 else None
+                    centroids.append(sample[rng.choice(len(sample), p=probabilities)])
+                    nearest = np.minimum(nearest, np.square(sample - centroids[-1]).sum(axis=1))
+                centroids = np.array(centroids)
+
+            for batch_start in range(0, len(rows), batch_size):
+                batch = rows[batch_start:batch_start + batch_size]
+                labels = assign(batch, centroids)
+                batch_counts = np.bincount(labels, minlength=clusters)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, labels, batch)
+                # 每个中心的学习率为1/累计样本数
+                counts += batch_counts
+                moved = batch_counts > 0
+                centroids[moved] += (sums[moved] - batch_counts[moved, None] * centroids[moved]) / counts[moved, None]
+
+    if centroids is None:
+        raise ValueError("No valid shapes to cluster")
+    labels = np.full((sample_count, shape_count), -1, dtype=np.int32)
+    for start, end, rows, keep in chunks():
+        labels[start:end] = np.where(keep, assign(rows, centroids), -1).reshape(end - start, shape_count)
+    return labels, centroids.astype(np.float32)
+
+
+def prepare_dtw_shapes(arr_0, arr_1, samples, shapes):
+    """取出指定shape，把有效部分重采样到相同长度并z归一化"""
+    shape_length = arr_0.shape[2]
+    lengths = shape_lengths(np.asarray(arr_1[samples, shapes]), shape_length)
+    return znormalize(resample_shapes(np.asarray(arr_0[samples, shapes]), lengths, shape_length))
+
+
+def dtw_band(a, b, window):
+    """同时计算多对等长序列在Sakoe-Chiba带内的DTW距离，a、b为(pair, length)"""
+    pair_count, length = a.shape
+    previous = np.full((pair_count, length + 1), np.inf)
+    previous[:, 0] = 0.0
+    for i in range(length):
+        current = np.full((pair_count, length + 1), np.inf)
+        low, high = max(0, i - window), min(length, i + window + 1)
+        cost = np.square(a[:, i:i + 1] - b[:, low:high])
+        for offset, j in enumerate(range(low, high)):
+            current[:, j + 1] = cost[:, offset] + np.minimum(np.minimum(previous[:, j + 1], previous[:, j]),
+                                                             current[:, j])
+        previous = current
+    return np.sqrt(previous[:, length])
+
+
+def lb_keogh(a, b, window):
+    """LB_Keogh下界：a落在b的带宽包络之外的部分，a、b为(pair, length)"""
+    padded = np.pad(b, ((0, 0), (window, window)), mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1, axis=1)
+    upper, lower = windows.max(axis=2), windows.min(axis=2)
+    excess = np.where(a > upper, a - upper, np.where(a < lower, a - lower, 0.0))
+    return np.sqrt(np.square(excess).sum(axis=1))
+
+
+def dtw_matrix(series, window, neighbors=0):
+    """计算成对DTW距离矩阵；neighbors>0时只保证每行最近的neighbors个距离，
+    LB_Keogh超过欧氏距离上界的组合不计算（置为nan），返回(矩阵, 实际计算的组合数)"""
+    count = len(series)
+    rows, cols = np.triu_indices(count, k=1)
+    a, b = series[rows], series[cols]
+    matrix = np.zeros((count, count))
+    candidates = np.ones(len(rows), dtype=bool)
+
+    if 0 < neighbors < count - 1:
+        # 欧氏距离是DTW的上界：第neighbors近的欧氏距离之外的组合不可能成为最近邻
+        euclidean = np.zeros((count, count))
+        euclidean[rows, cols] = euclidean[cols, rows] = np.sqrt(np.square(a - b).sum(axis=1))
+        np.fill_diagonal(euclidean, np.inf)
+        threshold = np.partition(euclidean, neighbors - 1, axis=1)[:, neighbors - 1]
+        bound = np.maximum(lb_keogh(a, b, window), lb_keogh(b, a, window))
+        candidates = (bound <= threshold[rows]) | (bound <= threshold[cols])
+        matrix[rows[~candidates], cols[~candidates]] = np.nan
+        matrix[cols[~candidates], rows[~candidates]] = np.nan
+
+    distances = dtw_band(a[candidates], b[candidates], window)
+    matrix[rows[candidates], cols[candidates]] = distances
+    matrix[cols[candidates], rows[candidates]] = distances
+    return matrix, int(np.count_nonzero(candidates))
+
+
+def decimate_min_max(data_slice, start_time, columns):
+    """按输出分辨率抽稀：每个像素列只保留最小值和最大值，返回(时间轴, 数据)"""
+    seq_length = data_slice.shape[0]
+    if seq_length <= 2 * columns:
+        return np.arange(start_time, start_time + seq_length, dtype=np.float64), data_slice
+
+    data = np.asarray(data_slice, dtype=np.float64)
+    edges = np.linspace(0, seq_length, columns + 1).astype(np.int64)
+    low = np.minimum.reduceat(data, edges[:-1], axis=0)
+    high = np.maximum.reduceat(data, edges[:-1], axis=0)
+    decimated = np.stack([low, high], axis=1).reshape((2 * columns,) + data.shape[1:])
+    centers = start_time + (edges[:-1] + edges[1:] - 1) / 2.0
+    return np.repeat(centers, 2), decimated
+
+
+def draw_all_variables(ax, data_slice, start_time, stacked, time_axis=None):
+    """用单个LineCollection绘制同一时间段内的所有variable，data_slice为(length, dimension_number)"""
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    seq_length, variable_count = data_slice.shape
+    values = np.asarray(data_slice, dtype=np.float64).T  # (dimension_number, length)
+    if time_axis is None:
+        time_axis = np.arange(start_time, start_time + seq_length, dtype=np.float64)
+
+    if stacked:
+        # 每个variable缩放到[0, 0.9]后按行堆叠，Variable 1在最上方
+        low = np.nanmin(values, axis=1, keepdims=True)
+        high = np.nanmax(values, axis=1, keepdims=True)
+        span = np.where(high > low, high - low, 1.0)
+        offsets = np.arange(variable_count - 1, -1, -1, dtype=np.float64)[:, None]
+        values = (values - low) / span * 0.9 + offsets
+
+    segments = np.stack([np.broadcast_to(time_axis, values.shape), values], axis=2)
+    colors = [f'C{i % 10}' for i in range(variable_count)]
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=1.5))
+
+    ax.set_xlim(time_axis[0], time_axis[-1] if seq_length > 1 else time_axis[0] + 1)
+    if stacked:
+        ax.set_ylim(-0.1, variable_count)
+        tick_step = max(1, variable_count // 20)
+        ticks = np.arange(0, variable_count, tick_step)
+        ax.set_yticks(variable_count - 1 - ticks + 0.45)
+        ax.set_yticklabels([f'Var {i + 1}' for i in ticks])
+    else:
+        low, high = np.nanmin(values), np.nanmax(values)
+        margin = (high - low) * 0.05 or 1.0
+        ax.set_ylim(low - margin, high + margin)
+        ax.set_ylabel('Value')
+        if variable_count <= 10:
+            # 图例使用代理对象，不增加额外线条
+            handles = [Line2D([], [], color=colors[i]) for i in range(variable_count)]
+            ax.legend(handles, [f'Var {i + 1}' for i in range(variable_count)], fontsize=8, loc='upper right')
+    ax.set_xlabel('Time Index')
+    ax.grid(True, alpha=0.3)
+
+
+def draw_saliency_band(ax, saliency, start_time, limit, y_extent=None):
+    """在曲线下方用单个imshow绘制saliency色带，saliency为(行数, length)，默认铺满纵轴；
+    attention可能为负，颜色以0为中心在[-limit, limit]内发散"""
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    low, high = y_extent if y_extent is not None else ylim
+    ax.imshow(saliency, aspect='auto', cmap='coolwarm', vmin=-(limit or 1.0), vmax=limit or 1.0, alpha=0.35,
+              interpolation='nearest', origin='upper', zorder=0,
+              extent=(start_time - 0.5, start_time + saliency.shape[1] - 0.5, low, high))
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+
+
+def draw_heatmap(ax, data_slice, sample_idx, start_shape, end_shape):
+    """在给定Axes上绘制heatmap切片，返回图像对象"""
+    # 使用学术界专用的颜色（viridis或plasma）
+    im = ax.imshow(data_slice, cmap='viridis', aspect='auto', interpolation='nearest')
+
+    # 设置标题
+    ax.set_title(f'Heatmap: Instance {sample_idx + 1}, Shapes {start_shape + 1}-{end_shape}')
+
+    # 隐藏坐标轴数字
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_xlabel('Shape Index')
+    ax.set_ylabel('Shape Index')
+    return im
+
+
+def draw_attention_bars(ax, mean_values, sample_idx):
+    """在给定Axes上绘制排序后的attention柱状图，返回柱子对象"""
+    shape_count = len(mean_values)
+    bars = ax.bar(range(shape_count), mean_values, color='steelblue', alpha=0.7)
+
+    # 设置标题和标签
+    ax.set_title(f'Attention Values: Instance {sample_idx + 1}, Top {shape_count} Shapes (High to Low)')
+    ax.set_xlabel('Rank (High to Low)')
+    ax.set_ylabel('Attention Value')
+    ax.grid(True, alpha=0.3)
+
+    # 隐藏x轴标签
+    ax.set_xticks([])
+    return bars
+
+
+def draw_shape_panel(ax, x_train, sample_idx, shape_idx, start, end, label, panel_number, valid=None,
+                     saliency=None):
+    """绘制一条时间序列并高亮对应shape的位置，valid为加载时VP检查的结果（None表示未检查），
+    saliency为与x_train同形的attention saliency，给出时作为背景色带"""
+    if valid is False:
+        # 加载时已判定为无效记录，不再逐项校正
+        ax.text(0.5, 0.5, f'Invalid VP record\nTime: {start}-{end}, Variable label: {label}',
+                ha='center', va='center', transform=ax.transAxes, fontsize=12, color='red')
+        ax.set_title(f'Instance {sample_idx + 1}, Shape {shape_idx + 1}')
+        ax.set_xticks([])
+        ax.set_yticks([])
+        return
+
+    # 验证variable索引范围并转换为整数
+    var_idx = int(label)
+
+    # 确保variable索引在有效范围内
+    if valid is None and (var_idx >= x_train.shape[2] or var_idx < 0):
+        var_idx = 0
+
+    # 使用正确的variable绘制时间序列数据
+    if valid or (start < x_train.shape[1] and end <= x_train.shape[1]):
+        ts = x_train[sample_idx, :, var_idx]  # 使用正确的variable索引
+        ax.plot(ts, linewidth=2, color='green', label=f'Time Series {panel_number}')
+        if valid or start < end:
+            ax.axvspan(start, end, alpha=0.3, color='red',
+                       label=f'Corresponding Shape')
+            highlight_ts = ts[start:end]
+            ax.plot(range(start, end), highlight_ts, linewidth=3, color='red', alpha=0.8)
+        if saliency is not None and sample_idx < saliency.shape[0]:
+            draw_saliency_band(ax, saliency[sample_idx, :, var_idx][None, :], 0,
+                               np.abs(saliency[sample_idx]).max())
+    ax.set_title(
+        f'Instance {sample_idx + 1}, Shape {shape_idx + 1}\nTime: {start}-{end}, Variable: {var_idx + 1}')
+    ax.set_xlabel('Time Index')
+    ax.set_ylabel('Value')
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+
+
+def draw_shape_comparison(fig, x_train, shape1, shape2, saliency=None):
+    """在Figure上并排绘制两个shape位置，shape为(sample, shape, start, end, label[, valid])"""
+    # 创建2个子图 (1行2列)
+    ax1 = fig.add_subplot(1, 2, 1)
+    ax2 = fig.add_subplot(1, 2, 2)
+    for panel_number, (ax, shape) in enumerate([(ax1, shape1), (ax2, shape2)], start=1):
+        valid = shape[5] if len(shape) > 5 else None
+        draw_shape_panel(ax, x_train, *shape[:5], panel_number=panel_number, valid=valid, saliency=saliency)
+
+    # 添加总标题
+    fig.suptitle('Heatmap-Based Shape Comparison Analysis', fontsize=14)
+    return ax1, ax2
+
+
+HEATMAP_ORDER_CACHE_SIZE = 256  # 每种排序方式缓存的instance数
+
+DTW_BAND_FRACTION = 0.1  # Sakoe-Chiba带宽占shape长度的比例
+
+QUERY_LIST_LIMIT = 1000  # 查询结果列表最多显示的条数
+
+# 键盘切换instance后等待的时间（毫秒），按住按键时只渲染最后一个instance
+NAV_DEBOUNCE_MS = 120
+
+# 批量导出：A4横向页面，栅格化元素的分辨率
+EXPORT_PAGE_SIZE = (11.69, 8.27)
+EXPORT_DPI = 300
+EXPORT_DENSE_BARS = 50  # 超过该数量的柱子栅格化
+
+
+def export_instance_pages(pdf_path, sources, first_instance, last_instance, attention_count=15):
+    """在工作进程中把一段instance（0索引，含两端）写成多页PDF，sources为成员名到文件路径的映射"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    x_train = np.load(sources['x_train'], mmap_mode="r") if 'x_train' in sources else None
+    heatmap = load_heatmap_array(sources['heatmap'], mmap_mode="r") if 'heatmap' in sources else None
+    attention = np.load(sources['attention'], mmap_mode="r") if 'attention' in sources else None
+
+    with PdfPages(pdf_path) as pdf:
+        for sample_idx in range(first_instance, last_instance + 1):
+            fig = Figure(figsize=EXPORT_PAGE_SIZE)
+            grid = fig.add_gridspec(2, 2) if x_train is not None else fig.add_gridspec(1, 2)
+            lower = 1 if x_train is not None else 0
+
+            if x_train is not None and sample_idx < x_train.shape[0]:
+                ax = fig.add_subplot(grid[0, :])
+                # 线条按页面宽度的像素列数抽稀
+                columns = int(EXPORT_PAGE_SIZE[0] * EXPORT_DPI)
+                data_slice = x_train[sample_idx]
+                time_axis, decimated = decimate_min_max(data_slice, 0, columns)
+                draw_all_variables(ax, decimated, 0, data_slice.shape[1] > 10, time_axis=time_axis)
+                ax.set_title(f'Instance {sample_idx + 1}, All Variables')
+
+            if heatmap is not None and sample_idx < heatmap.shape[0]:
+                ax = fig.add_subplot(grid[lower, 0])
+                im = draw_heatmap(ax, heatmap_block(heatmap, sample_idx, 0, heatmap.shape[1]),
+                                  sample_idx, 0, heatmap.shape[1])
+                im.set_rasterized(True)
+                fig.colorbar(im, ax=ax).set_label('Value')
+
+            if attention is not None and sample_idx < attention.shape[0]:
+                ax = fig.add_subplot(grid[lower, 1])
+                mean_values, sorted_indices = rank_attention(attention[sample_idx:sample_idx + 1])
+                top = sorted_indices[0, :attention_count]
+                bars = draw_attention_bars(ax, mean_values[0, top], sample_idx)
+                if len(bars) > EXPORT_DENSE_BARS:
+                    for bar in bars:
+                        bar.set_rasterized(True)
+
+            fig.tight_layout()
+            pdf.savefig(fig, dpi=EXPORT_DPI)
+    return pdf_path
 
 
 class MergedVisualizationApp:
@@ -36,6 +1799,7 @@ class MergedVisualizationApp:
         self.arr_0 = None  # (sample, shape_number, shape_length)
         self.arr_1 = None  # (sample, shape_number, VP)
         self.x_train = None  # (sample, length, dimension_number)
+        self.vp_valid_mask = None  # (sample, shape_number) 加载时VP检查结果
 
         # 高级可视化数据
         self.heatmap_data = None  # (sample, shape_number, shape_number)
@@ -43,6 +1807,18 @@ class MergedVisualizationApp:
         self.sorted_attention_data = None  # 排序后的数据
         self.original_indices = None  # 原始索引
         self.all_samples_indices = []  # 所有sample的排序索引
+        self.attention_means = None  # 每个shape的平均attention (sample, shape_number)
+        self.reindex_order = None  # 重排数据中每个位置对应的原始shape索引
+        self.reindexed_dir = None
+
+        # 跟随模式（持续追加的数据）
+        self.follow_sources = None
+        self.follow_rankings = None  # 排序结果的可增长缓冲区
+        self.follow_job = None
+
+        # 已加载文件路径（用于会话保存与恢复）
+        self.heatmap_path = None
+        self.attention_path = None
 
         # 可视化相关变量
         self.current_zoom = 1.0
@@ -51,6 +1827,18 @@ class MergedVisualizationApp:
         # Heatmap相关变量
         self.heatmap_colorbar = None
         self.current_heatmap_ax = None
+        self.current_heatmap_order = None  # 重排显示时每个位置对应的原始shape索引
+        self.heatmap_orders = OrderedDict()  # (排序方式, instance) -> shape顺序
+        self.heatmap_orders_source = None  # 缓存对应的(heatmap, attention排序)
+
+        # heatmap二维前缀和：按文件指纹缓存的旁路文件，以及当前视图的(表, 偏移)
+        self.heatmap_sat = None
+        self.heatmap_sat_key = None
+        self.heatmap_sat_thread = None
+        self.heatmap_view_sat = None
+        self.heatmap_cax = self.heatmap_marginal_axes = None
+        self.heatmap_drag = None
+        self.heatmap_selection_artists = []
 
         # 当前选中的shape信息
         self.selected_shapes = {'shape1': None, 'shape2': None}
@@ -62,9 +1850,34 @@ class MergedVisualizationApp:
         # 序列控制变量
         self.sequence_controls = []
 
+        # 多数据集工作区
+        self.workspace = DatasetWorkspace()
+
+        # 图形对象（延迟创建）
+        self.upper_fig = self.shape_comparison_fig = None
+        self.heatmap_fig = self.attention_fig = None
+
         # 创建主要布局
         self.create_main_layout()
 
+        # Instance查询的列式索引（数据变化时重建）
+        self.query_index = None
+        self.query_index_key = None
+
+        # attention saliency（与x_train同形，数据变化时重新计算）
+        self.saliency = None
+        self.saliency_key = None
+        self.query_results = np.empty(0, dtype=np.int64)
+
+        # 键盘切换instance（防抖渲染）
+        self.nav_job = None
+        self.nav_generation = 0
+        for sequence, step in [("<Prior>", -1), ("<Next>", 1), ("<Control-Left>", -1), ("<Control-Right>", 1)]:
+            self.root.bind_all(sequence, lambda event, step=step: self.on_navigation_key(event, step))
+
+        # 窗口显示后再加载matplotlib并创建基础图形
+        self.root.after_idle(self.ensure_basic_visualization)
+
     def create_main_layout(self):
         """创建主要布局"""
         # 创建主要的分割布局
@@ -117,6 +1930,9 @@ class MergedVisualizationApp:
         # 文件加载部分
         self.create_file_loading_section(parent)
 
+        # 多数据集工作区
+        self.create_workspace_controls(parent)
+
         # 上半部分可视化控制
         self.create_upper_viz_controls(parent)
 
@@ -137,6 +1953,9 @@ class MergedVisualizationApp:
         # Attention控制
         self.create_attention_controls(parent)
 
+        # Instance查询
+        self.create_query_controls(parent)
+
     def create_file_loading_section(self, parent):
         """创建文件加载部分"""
         section1 = ttk.LabelFrame(parent, text="Data File Loading", padding=10)
@@ -162,6 +1981,14 @@ class MergedVisualizationApp:
         self.npy_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
         ttk.Button(npy_frame, text="Browse", command=self.browse_npy_file).pack(side=tk.RIGHT, padx=(5, 0))
 
+        # 选择文件后立即显示的形状与兼容性信息
+        self.file_info_label = ttk.Label(section1, text="", font=("TkDefaultFont", 9), wraplength=350)
+        self.file_info_label.pack(anchor=tk.W, pady=(2, 0))
+        self.warmup_generation = 0
+
+        ttk.Button(section1, text="Import UEA/UCR File (.ts/.arff)", command=self.import_series_file,
+                   style="Accent.TButton").pack(fill=tk.X, pady=(5, 0))
+
         # 加载按钮
         ttk.Button(section1, text="Update Plots", command=self.load_data,
                    style="Large.TButton").pack(fill=tk.X, pady=(5, 0))
@@ -172,6 +1999,65 @@ class MergedVisualizationApp:
         # self.data_info_text.insert(tk.END, "No dataset loaded")
         # self.data_info_text.config(state=tk.DISABLED)
 
+    def create_workspace_controls(self, parent):
+        """创建多数据集工作区控制"""
+        section = ttk.LabelFrame(parent, text="Dataset Workspace", padding=10)
+        section.pack(fill=tk.X, padx=5, pady=5)
+
+        # 数据集选择
+        select_frame = ttk.Frame(section)
+        select_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(select_frame, text="Dataset:").pack(side=tk.LEFT)
+        self.workspace_dataset_var = tk.StringVar()
+        self.workspace_combobox = ttk.Combobox(select_frame, textvariable=self.workspace_dataset_var,
+                                               state="readonly", width=25)
+        self.workspace_combobox.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+
+        button_frame = ttk.Frame(section)
+        button_frame.pack(fill=tk.X, pady=2)
+        ttk.Button(button_frame, text="Add Current", command=self.add_to_workspace,
+                   style="Accent.TButton").pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+        ttk.Button(button_frame, text="Switch", command=self.switch_dataset,
+                   style="Accent.TButton").pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+        ttk.Button(button_frame, text="Close", command=self.close_dataset,
+                   style="Accent.TButton").pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+
+        # 内存预算
+        budget_frame = ttk.Frame(section)
+        budget_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(budget_frame, text="Memory Budget (MB):").pack(side=tk.LEFT)
+        self.memory_budget_var = tk.IntVar(value=DEFAULT_MEMORY_BUDGET_MB)
+        ttk.Spinbox(budget_frame, from_=64, to=1048576, increment=256, textvariable=self.memory_budget_var,
+                    width=10, command=self.update_memory_budget).pack(side=tk.RIGHT)
+        self.workspace_info_label = ttk.Label(section, text="Resident: 0.0 MB", font=("TkDefaultFont", 9))
+        self.workspace_info_label.pack(anchor=tk.W)
+
+        # 并排对比两个数据集
+        compare_frame = ttk.Frame(section)
+        compare_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(compare_frame, text="Run A:").pack(side=tk.LEFT)
+        self.workspace_run_a_var = tk.StringVar()
+        self.workspace_run_a_combobox = ttk.Combobox(compare_frame, textvariable=self.workspace_run_a_var,
+                                                     state="readonly", width=12)
+        self.workspace_run_a_combobox.pack(side=tk.LEFT, padx=2)
+        ttk.Label(compare_frame, text="Run B:").pack(side=tk.LEFT)
+        self.workspace_run_b_var = tk.StringVar()
+        self.workspace_run_b_combobox = ttk.Combobox(compare_frame, textvariable=self.workspace_run_b_var,
+                                                     state="readonly", width=12)
+        self.workspace_run_b_combobox.pack(side=tk.LEFT, padx=2)
+        ttk.Button(section, text="Compare Side by Side", command=self.show_run_comparison,
+                   style="Accent.TButton").pack(fill=tk.X, pady=2)
+
+        # 跟随训练过程中持续写入的数据
+        follow_frame = ttk.Frame(section)
+        follow_frame.pack(fill=tk.X, pady=2)
+        ttk.Button(follow_frame, text="Follow Live Folder", command=self.start_follow,
+                   style="Accent.TButton").pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+        ttk.Button(follow_frame, text="Stop Following", command=self.stop_follow,
+                   style="Accent.TButton").pack(side=tk.LEFT, fill=tk.X, expand=True, padx=1)
+        self.follow_info_label = ttk.Label(section, text="Not following", font=("TkDefaultFont", 9))
+        self.follow_info_label.pack(anchor=tk.W)
+
     def create_upper_viz_controls(self, parent):
         """创建上半部分可视化控制"""
         section2 = ttk.LabelFrame(parent, text="Time Series Visualization Controls", padding=10)
@@ -186,6 +2072,20 @@ class MergedVisualizationApp:
             ttk.Radiobutton(plot_count_frame, text=str(i), variable=self.plot_count_var,
                             value=i, command=self.update_sequence_controls).pack(side=tk.LEFT, padx=5)
 
+        # 显示模式：单个variable或同时显示所有variable
+        ttk.Label(section2, text="Variables per Plot:").pack(anchor=tk.W)
+        self.upper_mode_var = tk.StringVar(value="single")
+        mode_frame = ttk.Frame(section2)
+        mode_frame.pack(fill=tk.X, pady=2)
+        for text, value in [("Selected", "single"), ("All Stacked", "stacked"), ("All Overlaid", "overlay")]:
+            ttk.Radiobutton(mode_frame, text=text, variable=self.upper_mode_var,
+                            value=value).pack(side=tk.LEFT, padx=5)
+
+        # 背景色带：shape平均attention投影到原始时间轴
+        self.saliency_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(section2, text="Attention Saliency Background",
+                        variable=self.saliency_var).pack(anchor=tk.W, pady=2)
+
         # 创建可滚动的序列参数控制区域
         # self.sequence_control_canvas = tk.Canvas(section2, height=200)  # 重命名变量
         self.sequence_frame = ttk.Frame(section2)
@@ -235,6 +2135,31 @@ class MergedVisualizationApp:
         ttk.Button(control_frame, text="Pan Mode", command=self.enable_pan_mode,
                    style="Accent.TButton").pack(side=tk.TOP, fill=tk.X, pady=1)
 
+        self.nav_info_label = ttk.Label(control_frame, text="PageUp/PageDown or Ctrl+Left/Right: previous/next instance",
+                                        font=("TkDefaultFont", 9))
+        self.nav_info_label.pack(anchor=tk.W, pady=1)
+
+        ttk.Button(control_frame, text="Clear Session Cache", command=self.clear_session_cache,
+                   style="Accent.TButton").pack(side=tk.TOP, fill=tk.X, pady=1)
+
+        # 批量导出多页PDF
+        export_frame = ttk.Frame(control_frame)
+        export_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(export_frame, text="Instances:").pack(side=tk.LEFT)
+        self.export_first_var = tk.IntVar(value=1)
+        ttk.Spinbox(export_frame, from_=1, to=1000000, textvariable=self.export_first_var,
+                    width=6).pack(side=tk.LEFT)
+        ttk.Label(export_frame, text="-").pack(side=tk.LEFT)
+        self.export_last_var = tk.IntVar(value=10)
+        ttk.Spinbox(export_frame, from_=1, to=1000000, textvariable=self.export_last_var,
+                    width=6).pack(side=tk.LEFT)
+        ttk.Label(export_frame, text="Per PDF:").pack(side=tk.LEFT, padx=(5, 0))
+        self.export_per_file_var = tk.IntVar(value=50)
+        ttk.Spinbox(export_frame, from_=1, to=10000, textvariable=self.export_per_file_var,
+                    width=5).pack(side=tk.LEFT)
+        ttk.Button(control_frame, text="Export PDF Batch", command=self.export_pdf_batch,
+                   style="Accent.TButton").pack(side=tk.TOP, fill=tk.X, pady=1)
+
     def create_shape_position_controls(self, parent):
         """创建Shape位置查看控制"""
         section4 = ttk.LabelFrame(parent, text="Shape Position Comparison", padding=10)
@@ -282,6 +2207,14 @@ class MergedVisualizationApp:
         # ttk.Button(section4, text="Compare Two Positions", command=self.compare_shape_positions).pack(fill=tk.X,
         #                                                                                               pady=10)
 
+        # Shape画廊
+        ttk.Button(section4, text="Open Shape Gallery", command=self.show_shape_gallery,
+                   style="Accent.TButton").pack(fill=tk.X, pady=(5, 0))
+
+        # Shape聚类原型
+        ttk.Button(section4, text="Cluster Shapes into Prototypes", command=self.show_shape_clusters,
+                   style="Accent.TButton").pack(fill=tk.X, pady=(5, 0))
+
     def create_data_info_text(self, parent):
         """创建数据信息显示"""
         section5 = ttk.LabelFrame(parent, text="Log", padding=10)
@@ -298,9 +2231,21 @@ class MergedVisualizationApp:
         heatmap_frame.pack(fill=tk.X, padx=5, pady=5)
 
         # 加载Heatmap NPY文件
-        ttk.Button(heatmap_frame, text="Load Heatmap Data (.npy)",
+        ttk.Button(heatmap_frame, text="Load Heatmap Data (.npy/.npz)",
                    command=self.load_heatmap_data, style="Accent.TButton").pack(fill=tk.X, pady=2)
 
+        # 稠密heatmap转换为稀疏格式
+        sparse_frame = ttk.Frame(heatmap_frame)
+        sparse_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(sparse_frame, text="Top-K:").pack(side=tk.LEFT)
+        self.sparse_topk_var = tk.IntVar(value=8)
+        ttk.Spinbox(sparse_frame, from_=0, to=1000, textvariable=self.sparse_topk_var, width=5).pack(side=tk.LEFT)
+        ttk.Label(sparse_frame, text="Min:").pack(side=tk.LEFT, padx=(5, 0))
+        self.sparse_threshold_var = tk.StringVar(value="")
+        ttk.Entry(sparse_frame, textvariable=self.sparse_threshold_var, width=7).pack(side=tk.LEFT)
+        ttk.Button(sparse_frame, text="Convert to Sparse",
+                   command=self.convert_heatmap_to_sparse).pack(side=tk.RIGHT)
+
         # Heatmap数据信息显示
         self.heatmap_info_label = ttk.Label(heatmap_frame, text="No heatmap data loaded",
                                             foreground="red", font=("TkDefaultFont", 10))
@@ -335,10 +2280,28 @@ class MergedVisualizationApp:
                                                textvariable=self.heatmap_end_var, width=15)
         self.heatmap_end_spinbox.pack(side=tk.RIGHT)
 
+        # Shape显示顺序
+        order_frame = ttk.Frame(heatmap_frame)
+        order_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(order_frame, text="Shape Order:").pack(side=tk.LEFT)
+        self.heatmap_order_var = tk.StringVar(value="original")
+        for text, value in [("Original", "original"), ("Attention", "attention"), ("Clustered", "clustered")]:
+            ttk.Radiobutton(order_frame, text=text, variable=self.heatmap_order_var, value=value,
+                            command=self.on_heatmap_order_changed).pack(side=tk.LEFT, padx=3)
+
+        # 行/列边缘和
+        self.heatmap_marginals_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(heatmap_frame, text="Row/Column Marginals", variable=self.heatmap_marginals_var,
+                        command=self.on_heatmap_marginals_changed).pack(anchor=tk.W, pady=2)
+
         # 更新按钮
         ttk.Button(heatmap_frame, text="Update Heatmap",
                    command=self.update_heatmap, style="Large.TButton").pack(fill=tk.X, pady=10)
 
+        # top-k shape的DTW距离矩阵
+        ttk.Button(heatmap_frame, text="Pairwise DTW of Top Shapes",
+                   command=self.show_dtw_matrix, style="Accent.TButton").pack(fill=tk.X, pady=2)
+
         # 功能说明
         info_frame = ttk.LabelFrame(heatmap_frame, text="Interactive Comparison", padding=5)
         info_frame.pack(fill=tk.X, pady=5)
@@ -347,6 +2310,8 @@ class MergedVisualizationApp:
                   font=("TkDefaultFont", 9)).pack(anchor=tk.W)
         ttk.Label(info_frame, text="• X-axis = Shape 1, Y-axis = Shape 2",
                   font=("TkDefaultFont", 9)).pack(anchor=tk.W)
+        ttk.Label(info_frame, text="• Right-drag to show block sum and mean",
+                  font=("TkDefaultFont", 9)).pack(anchor=tk.W)
         ttk.Label(info_frame, text="• Uses current Instance Number for comparison",
                   font=("TkDefaultFont", 9)).pack(anchor=tk.W)
         ttk.Label(info_frame, text="• Results display in Basic Visualization tab",
@@ -357,6 +2322,34 @@ class MergedVisualizationApp:
                                           foreground="blue", font=("TkDefaultFont", 10))
         self.click_info_label.pack(pady=2)
 
+    def create_query_controls(self, parent):
+        """创建instance查询区域"""
+        query_frame = ttk.LabelFrame(parent, text="Instance Query", padding=10)
+        query_frame.pack(fill=tk.X, padx=5, pady=5)
+
+        entry_frame = ttk.Frame(query_frame)
+        entry_frame.pack(fill=tk.X, pady=2)
+        self.query_var = tk.StringVar(value="rank[1] <= 5")
+        query_entry = ttk.Entry(entry_frame, textvariable=self.query_var)
+        query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        query_entry.bind("<Return>", lambda event: self.run_query())
+        ttk.Button(entry_frame, text="Run", command=self.run_query).pack(side=tk.RIGHT, padx=(5, 0))
+
+        ttk.Label(query_frame, text="Fields: " + ", ".join(QUERY_FIELDS) + "\n"
+                                    "e.g. rank[12] <= 5 and top_var == 3 or max_pair > 0.8",
+                  font=("TkDefaultFont", 9)).pack(anchor=tk.W)
+        self.query_info_label = ttk.Label(query_frame, text="", font=("TkDefaultFont", 9))
+        self.query_info_label.pack(anchor=tk.W)
+
+        list_frame = ttk.Frame(query_frame)
+        list_frame.pack(fill=tk.X, pady=2)
+        self.query_listbox = tk.Listbox(list_frame, height=6, font=("TkDefaultFont", 10))
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.query_listbox.yview)
+        self.query_listbox.configure(yscrollcommand=scrollbar.set)
+        self.query_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.query_listbox.bind('<<ListboxSelect>>', self.on_query_select)
+
     def create_attention_controls(self, parent):
         """创建Attention控制区域"""
         attention_frame = ttk.LabelFrame(parent, text="Attention Controls", padding=10)
@@ -397,6 +2390,24 @@ class MergedVisualizationApp:
         ttk.Button(attention_frame, text="Export Top Shapes Indices",
                    command=self.download_indices, style="Accent.TButton").pack(fill=tk.X, pady=2)
 
+        # 与另一次运行的attention比较
+        ttk.Button(attention_frame, text="Compare With Another Run (.npy)",
+                   command=self.compare_attention_runs, style="Accent.TButton").pack(fill=tk.X, pady=2)
+
+        # instance按attention分布的二维投影
+        ttk.Button(attention_frame, text="Instance Embedding",
+                   command=self.show_instance_embedding, style="Accent.TButton").pack(fill=tk.X, pady=2)
+
+        # 重要shape在时间上的分布
+        ttk.Button(attention_frame, text="Motif Density Over Time",
+                   command=self.show_motif_density, style="Accent.TButton").pack(fill=tk.X, pady=2)
+
+        # 按attention排序重排数据（重要shape在前）
+        ttk.Button(attention_frame, text="Build Reindexed Views",
+                   command=self.build_reindexed_data, style="Accent.TButton").pack(fill=tk.X, pady=2)
+        ttk.Button(attention_frame, text="Load Reindexed Views",
+                   command=self.load_reindexed_data, style="Accent.TButton").pack(fill=tk.X, pady=2)
+
     def create_right_visualization(self, parent):
         """创建右侧可视化区域"""
         viz_frame = ttk.Frame(parent)
@@ -406,15 +2417,33 @@ class MergedVisualizationApp:
         viz_notebook = ttk.Notebook(viz_frame)
         viz_notebook.pack(fill=tk.BOTH, expand=True)
 
-        # 基础可视化标签页
-        basic_viz_frame = ttk.Frame(viz_notebook)
-        viz_notebook.add(basic_viz_frame, text="Basic Visualization")
-        self.create_basic_visualization(basic_viz_frame)
+        # 基础可视化标签页（图形在窗口显示后创建）
+        self.basic_viz_frame = ttk.Frame(viz_notebook)
+        viz_notebook.add(self.basic_viz_frame, text="Basic Visualization")
 
-        # 高级可视化标签页
-        advanced_viz_frame = ttk.Frame(viz_notebook)
-        viz_notebook.add(advanced_viz_frame, text="Advanced Analysis")
-        self.create_advanced_visualization(advanced_viz_frame)
+        # 高级可视化标签页（图形在首次切换到该标签页时创建）
+        self.advanced_viz_frame = ttk.Frame(viz_notebook)
+        viz_notebook.add(self.advanced_viz_frame, text="Advanced Analysis")
+
+        self.lazy_viz_tabs = {str(self.basic_viz_frame): self.ensure_basic_visualization,
+                              str(self.advanced_viz_frame): self.ensure_advanced_visualization}
+        viz_notebook.bind("<<NotebookTabChanged>>", self.on_viz_tab_changed)
+
+    def on_viz_tab_changed(self, event):
+        """切换标签页时创建尚未创建的图形"""
+        builder = self.lazy_viz_tabs.get(event.widget.select())
+        if builder is not None:
+            builder()
+
+    def ensure_basic_visualization(self):
+        """首次使用时创建基础可视化图形"""
+        if self.upper_fig is None:
+            self.create_basic_visualization(self.basic_viz_frame)
+
+    def ensure_advanced_visualization(self):
+        """首次使用时创建高级可视化图形"""
+        if self.heatmap_fig is None:
+            self.create_advanced_visualization(self.advanced_viz_frame)
 
     def create_basic_visualization(self, parent):
         """创建基础可视化区域"""
@@ -452,48 +2481,40 @@ class MergedVisualizationApp:
         self.create_heatmap_plot(heatmap_frame)
         self.create_attention_plot(lower_frame)
 
-    def create_upper_plots(self, parent):
-        """创建上半部分的图形"""
-        self.upper_fig = Figure(figsize=(14, 8), dpi=100)
-        self.upper_canvas = FigureCanvasTkAgg(self.upper_fig, parent)
-        self.upper_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+    def create_embedded_figure(self, parent, figsize):
+        """在父容器中创建Figure、画布和工具栏"""
+        Figure, FigureCanvasTkAgg, NavigationToolbar2Tk = tk_figure_classes()
+        fig = Figure(figsize=figsize, dpi=100)
+        canvas = FigureCanvasTkAgg(fig, parent)
+        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
         # 添加工具栏
-        self.upper_toolbar = NavigationToolbar2Tk(self.upper_canvas, parent)
-        self.upper_toolbar.update()
+        toolbar = NavigationToolbar2Tk(canvas, parent)
+        toolbar.update()
+        return fig, canvas, toolbar
+
+    def create_upper_plots(self, parent):
+        """创建上半部分的图形"""
+        self.upper_fig, self.upper_canvas, self.upper_toolbar = self.create_embedded_figure(parent, (14, 8))
 
     def create_shape_comparison_plot(self, parent):
         """创建Shape位置比较图形"""
-        self.shape_comparison_fig = Figure(figsize=(14, 6), dpi=100)
-        self.shape_comparison_canvas = FigureCanvasTkAgg(self.shape_comparison_fig, parent)
-        self.shape_comparison_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # 添加工具栏
-        self.shape_comparison_toolbar = NavigationToolbar2Tk(self.shape_comparison_canvas, parent)
-        self.shape_comparison_toolbar.update()
+        (self.shape_comparison_fig, self.shape_comparison_canvas,
+         self.shape_comparison_toolbar) = self.create_embedded_figure(parent, (14, 6))
 
     def create_heatmap_plot(self, parent):
         """创建Heatmap图形"""
-        self.heatmap_fig = Figure(figsize=(8, 6), dpi=100)
-        self.heatmap_canvas = FigureCanvasTkAgg(self.heatmap_fig, parent)
-        self.heatmap_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.heatmap_fig, self.heatmap_canvas, self.heatmap_toolbar = self.create_embedded_figure(parent, (8, 6))
 
-        # 添加工具栏
-        self.heatmap_toolbar = NavigationToolbar2Tk(self.heatmap_canvas, parent)
-        self.heatmap_toolbar.update()
-
-        # 绑定点击事件
+        # 绑定点击事件，右键拖动选择矩形块
         self.heatmap_canvas.mpl_connect('button_press_event', self.on_heatmap_click)
+        self.heatmap_canvas.mpl_connect('motion_notify_event', self.on_heatmap_drag)
+        self.heatmap_canvas.mpl_connect('button_release_event', self.on_heatmap_release)
 
     def create_attention_plot(self, parent):
         """创建Attention图形"""
-        self.attention_fig = Figure(figsize=(14, 6), dpi=100)
-        self.attention_canvas = FigureCanvasTkAgg(self.attention_fig, parent)
-        self.attention_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-
-        # 添加工具栏
-        self.attention_toolbar = NavigationToolbar2Tk(self.attention_canvas, parent)
-        self.attention_toolbar.update()
+        self.attention_fig, self.attention_canvas, self.attention_toolbar = self.create_embedded_figure(
+            parent, (14, 6))
 
         # 绑定鼠标事件
         self.attention_canvas.mpl_connect('motion_notify_event', self.on_attention_hover)
@@ -508,6 +2529,7 @@ class MergedVisualizationApp:
         )
         if filename:
             self.npz_path_var.set(filename)
+            self.start_file_warmup()
 
     def browse_npy_file(self):
         """浏览NPY文件"""
@@ -517,8 +2539,93 @@ class MergedVisualizationApp:
         )
         if filename:
             self.npy_path_var.set(filename)
+            self.start_file_warmup()
+
+    def start_file_warmup(self):
+        """后台读取所选文件的头信息并预读数据，完成后在界面显示形状与兼容性检查结果"""
+        self.warmup_generation += 1
+        generation = self.warmup_generation
+        npz_path, npy_path = self.npz_path_var.get(), self.npy_path_var.get()
+        self.file_info_label.config(text="Inspecting files...", foreground="gray")
+        result = {}
+
+        def work():
+            start = time.perf_counter()
+            try:
+                result['value'] = warm_up_files(npz_path, npy_path)
+                result['elapsed'] = time.perf_counter() - start
+            except Exception as e:
+                result['error'] = e
 
-    def load_data(self):
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+
+        def poll():
+            if generation != self.warmup_generation:
+                return  # 已选择其他文件，丢弃旧结果
+            if thread.is_alive():
+                self.root.after(100, poll)
+                return
+            if 'error' in result:
+                self.file_info_label.config(text=f"Cannot read file: {str(result['error'])}", foreground="red")
+                return
+
+            info = result['value']
+            parts = []
+            if info['shapes'] is not None:
+                parts += [f"{name} {shape} {dtype}" for name, (shape, dtype) in info['shapes'].items()]
+            if info['raw'] is not None:
+                parts.append(f"raw {info['raw'][0]} {info['raw'][1]}")
+            if info['problems']:
+                self.file_info_label.config(text="; ".join(parts + info['problems']), foreground="red")
+            else:
+                self.file_info_label.config(text="; ".join(parts), foreground="green")
+            self.append_log(f"Prefetched {info['prefetched'] / 1048576:.1f} MB in {result['elapsed']:.2f} s")
+
+        poll()
+
+    def import_series_file(self):
+        """把.ts/.arff文件转换为VISA的 (sample, length, dimension) 格式，完成后设为原始数据路径"""
+        filename = filedialog.askopenfilename(
+            title="Choose UEA/UCR Time Series File",
+            filetypes=[("UEA/UCR files", "*.ts *.arff"), ("All files", "*.*")]
+        )
+        if not filename:
+            return
+        out_dir = filedialog.askdirectory(title="Choose Output Folder", initialdir=os.path.dirname(filename))
+        if not out_dir:
+            return
+
+        result = {}
+
+        def work():
+            start = time.perf_counter()
+            try:
+                result['value'] = import_time_series(filename, out_dir) + (time.perf_counter() - start,)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        self.append_log(f"Importing {os.path.basename(filename)}...")
+
+        def poll():
+            if thread.is_alive():
+                self.root.after(200, poll)
+            elif 'error' in result:
+                messagebox.showerror("Error", f"Error importing file: {str(result['error'])}")
+            else:
+                outputs, shape, elapsed = result['value']
+                self.npy_path_var.set(outputs['X'])
+                self.start_file_warmup()
+                self.append_log(f"Imported {shape} in {elapsed:.2f} s: "
+                                f"{', '.join(os.path.basename(path) for path in outputs.values())}")
+                messagebox.showinfo("Success", f"Imported data {shape} saved to {out_dir}\n\n"
+                                               f"It is now set as the raw data path.")
+
+        poll()
+
+    def load_data(self, restoring=False):
         """加载数据文件"""
         try:
             npz_path = self.npz_path_var.get()
@@ -528,13 +2635,13 @@ class MergedVisualizationApp:
                 messagebox.showerror("Error", "Please choose both NPZ and NPY files first")
                 return
 
-            # 加载NPZ文件
-            self.npz_data = np.load(npz_path)
-            self.arr_0 = self.npz_data['arr_0']  # (sample, shape_number, shape_length)
-            self.arr_1 = self.npz_data['arr_1']  # (sample, shape_number, VP)
+            # 加载NPZ文件（工作区中已有时直接复用）
+            self.npz_data, self.arr_0, self.arr_1 = self.workspace.fetch(
+                npz_path, 'shapes', lambda: load_shapes_npz(npz_path))
 
             # 加载NPY文件
-            self.x_train = np.load(npy_path)  # (sample, length, dimension_number)
+            self.x_train = self.workspace.fetch(  # (sample, length, dimension_number)
+                npy_path, 'x_train', lambda: np.load(npy_path, mmap_mode="r" if restoring else None))
 
             # 验证数据格式
             if len(self.arr_0.shape) != 3 or len(self.arr_1.shape) != 3:
@@ -562,54 +2669,116 @@ class MergedVisualizationApp:
             self.data_info_text.delete(1.0, tk.END)
             self.data_info_text.insert(tk.END, info_text)
             self.data_info_text.config(state=tk.DISABLED)
+            self.workspace.set_active(self.current_paths())
+            self.update_workspace_info()
+
+            # 加载时一次性检查所有VP记录
+            self.validate_vp_data()
+
+            if restoring:
+                return True
 
             # 初始化图形
             self.update_plots()
             self.compare_shape_positions()
+            self.save_session()
 
             # messagebox.showinfo("Success", "Data loaded successfully!")
 
         except Exception as e:
-            messagebox.showerror("Error", f"Error loading data: {str(e)}")
+            if not restoring:
+                messagebox.showerror("Error", f"Error loading data: {str(e)}")
             self.data_info_text.config(state=tk.NORMAL)
             self.data_info_text.delete(1.0, tk.END)
             self.data_info_text.insert(tk.END, f"Loading failed: {str(e)}")
             self.data_info_text.config(state=tk.DISABLED)
+        return False
 
     def load_heatmap_data(self):
         """加载Heatmap数据"""
         filename = filedialog.askopenfilename(
             title="Select Heatmap Data File",
-            filetypes=[("NPY files", "*.npy"), ("All files", "*.*")]
+            filetypes=[("NPY files", "*.npy"), ("Sparse heatmap", "*.npz"), ("All files", "*.*")]
         )
         if filename:
-            try:
-                self.heatmap_data = np.load(filename)
+            self.load_heatmap_file(filename)
 
-                # 验证数据格式
-                if len(self.heatmap_data.shape) != 3:
-                    raise ValueError("Data should be 3D (instance, shape_number, shape_number)")
-                if self.heatmap_data.shape[1] != self.heatmap_data.shape[2]:
-                    raise ValueError("Second and third variables should be equal")
+    def load_heatmap_file(self, filename, restoring=False):
+        """从指定路径加载Heatmap数据"""
+        try:
+            self.heatmap_data = self.workspace.fetch(
+                filename, 'heatmap', lambda: load_heatmap_array(filename, mmap_mode="r" if restoring else None))
 
-                # 更新控件范围
-                sample_count = self.heatmap_data.shape[0]
-                shape_count = self.heatmap_data.shape[1]
+            # 验证数据格式
+            if len(self.heatmap_data.shape) != 3:
+                raise ValueError("Data should be 3D (instance, shape_number, shape_number)")
+            if self.heatmap_data.shape[1] != self.heatmap_data.shape[2]:
+                raise ValueError("Second and third variables should be equal")
 
-                self.heatmap_sample_spinbox.config(to=sample_count)
-                self.heatmap_start_spinbox.config(to=shape_count)
-                self.heatmap_end_spinbox.config(to=shape_count)
-                self.heatmap_end_var.set(min(20, shape_count))
+            self.heatmap_path = filename
 
-                # 更新信息显示
-                info_text = f"Heatmap loaded: {self.heatmap_data.shape}"
-                self.heatmap_info_label.config(text=info_text, foreground="green")
+            # 更新控件范围
+            sample_count = self.heatmap_data.shape[0]
+            shape_count = self.heatmap_data.shape[1]
 
-                messagebox.showinfo("Success", "Heatmap data loaded successfully!")
+            self.heatmap_sample_spinbox.config(to=sample_count)
+            self.heatmap_start_spinbox.config(to=shape_count)
+            self.heatmap_end_spinbox.config(to=shape_count)
+            self.heatmap_end_var.set(min(20, shape_count))
 
-            except Exception as e:
+            # 更新信息显示
+            info_text = f"Heatmap loaded: {self.heatmap_data.shape}"
+            if isinstance(self.heatmap_data, SparseHeatmap):
+                info_text += f" (sparse, {self.heatmap_data.nnz} entries)"
+            self.heatmap_info_label.config(text=info_text, foreground="green")
+            self.workspace.set_active(self.current_paths())
+            self.update_workspace_info()
+
+            if restoring:
+                return True
+
+            self.save_session()
+            messagebox.showinfo("Success", "Heatmap data loaded successfully!")
+
+        except Exception as e:
+            if not restoring:
                 messagebox.showerror("Error", f"Error loading heatmap data: {str(e)}")
-                self.heatmap_info_label.config(text="Load failed", foreground="red")
+            self.heatmap_info_label.config(text="Load failed", foreground="red")
+        return False
+
+    def convert_heatmap_to_sparse(self):
+        """把稠密heatmap按行保留top-k/阈值以上的元素，保存为稀疏.npz并切换到稀疏数据"""
+        source = self.heatmap_path if isinstance(self.heatmap_data, np.ndarray) else None
+        if source is None:
+            source = filedialog.askopenfilename(title="Select Dense Heatmap File",
+                                                filetypes=[("NPY files", "*.npy"), ("All files", "*.*")])
+            if not source:
+                return
+
+        try:
+            top_k = self.sparse_topk_var.get()
+            threshold_text = self.sparse_threshold_var.get().strip()
+            threshold = float(threshold_text) if threshold_text else None
+
+            filename = filedialog.asksaveasfilename(
+                title="Save Sparse Heatmap", defaultextension=".npz",
+                initialfile=os.path.splitext(os.path.basename(source))[0] + "_sparse.npz",
+                filetypes=[("Sparse heatmap", "*.npz"), ("All files", "*.*")])
+            if not filename:
+                return
+
+            start = time.perf_counter()
+            dense = np.load(source, mmap_mode="r")
+            if len(dense.shape) != 3 or dense.shape[1] != dense.shape[2]:
+                raise ValueError("Data should be 3D (instance, shape_number, shape_number)")
+            sparse = sparsify_heatmap(dense, top_k, threshold)
+            sparse.save(filename)
+            self.append_log(f"Sparse heatmap written in {time.perf_counter() - start:.2f} s: "
+                            f"{sparse.nnz} of {dense.size} entries kept, "
+                            f"{dense.nbytes / 1048576:.1f} MB -> {os.path.getsize(filename) / 1048576:.1f} MB")
+            self.load_heatmap_file(filename)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error converting heatmap: {str(e)}")
 
     def load_attention_data(self):
         """加载Attention数据"""
@@ -618,59 +2787,301 @@ class MergedVisualizationApp:
             filetypes=[("NPY files", "*.npy"), ("All files", "*.*")]
         )
         if filename:
-            try:
-                self.attention_data = np.load(filename)
+            self.load_attention_file(filename)
 
-                # 验证数据格式
-                if len(self.attention_data.shape) != 3:
-                    raise ValueError("Data should be 3D (instance_number, shape_number, value_number)")
+    def load_attention_file(self, filename, restoring=False):
+        """从指定路径加载Attention数据"""
+        try:
+            self.attention_data = self.workspace.fetch(
+                filename, 'attention', lambda: np.load(filename, mmap_mode="r" if restoring else None))
 
-                # 对每个sample进行排序并保留原始索引
-                self.process_attention_data()
+            # 验证数据格式
+            if len(self.attention_data.shape) != 3:
+                raise ValueError("Data should be 3D (instance_number, shape_number, value_number)")
 
-                # 更新控件范围
-                sample_count = self.attention_data.shape[0]
-                shape_count = self.attention_data.shape[1]
+            self.attention_path = filename
+            if not restoring:
+                # 新的attention排序替换重排数据的排名空间
+                self.reindex_order = self.reindexed_dir = None
 
-                self.attention_sample_spinbox.config(to=sample_count)
-                self.attention_count_spinbox.config(to=shape_count)
-                self.attention_count_var.set(min(15, shape_count))
+            # 对每个sample进行排序并保留原始索引
+            self.process_attention_data()
 
-                # 更新信息显示
-                info_text = f"Attention loaded: {self.attention_data.shape}"
-                self.attention_info_label.config(text=info_text, foreground="green")
+            # 更新控件范围
+            sample_count = self.attention_data.shape[0]
+            shape_count = self.attention_data.shape[1]
 
-                messagebox.showinfo("Success", "Attention data loaded successfully!")
+            self.attention_sample_spinbox.config(to=sample_count)
+            self.attention_count_spinbox.config(to=shape_count)
+            self.attention_count_var.set(min(15, shape_count))
 
-            except Exception as e:
+            # 更新信息显示
+            info_text = f"Attention loaded: {self.attention_data.shape}"
+            self.attention_info_label.config(text=info_text, foreground="green")
+            self.workspace.set_active(self.current_paths())
+            self.update_workspace_info()
+
+            if restoring:
+                return True
+
+            self.save_session()
+            messagebox.showinfo("Success", "Attention data loaded successfully!")
+
+        except Exception as e:
+            if not restoring:
                 messagebox.showerror("Error", f"Error loading attention data: {str(e)}")
-                self.attention_info_label.config(text="Load failed", foreground="red")
+            self.attention_info_label.config(text="Load failed", foreground="red")
+        return False
 
-    def process_attention_data(self):
-        """处理attention数据，按sample排序并保留原始索引"""
+    def process_attention_data(self, start_row=None):
+        """处理attention数据，按sample排序并保留原始索引；跟随模式下只计算start_row之后新增的instance"""
         if self.attention_data is None:
             return
 
-        sample_count, shape_count, value_count = self.attention_data.shape
+        if start_row is not None:
+            rankings = attention_ranking(np.asarray(self.attention_data[start_row:]))
+            self.attention_means, self.original_indices, self.sorted_attention_data = [
+                buffer.extend(rows) for buffer, rows in zip(self.follow_rankings, rankings)]
+            self.all_samples_indices += [[start_row + offset + 1, sorted_indices.tolist()]
+                                         for offset, sorted_indices in enumerate(rankings[1])]
+            return
 
-        # 为每个sample创建排序数据和索引
-        self.sorted_attention_data = np.zeros_like(self.attention_data)
-        self.original_indices = np.zeros((sample_count, shape_count), dtype=int)
-        self.all_samples_indices = []  # 存储所有sample的索引列表
+        # 排序结果按attention文件指纹缓存，下次启动直接内存映射
+        self.attention_means, self.original_indices, self.sorted_attention_data = attention_ranking(
+            self.attention_data, self.attention_path)
 
-        for sample_idx in range(sample_count):
-            # 计算每个shape的平均attention值
-            mean_values = np.mean(self.attention_data[sample_idx], axis=1)
+        # 存储所有sample的索引列表
+        self.all_samples_indices = [[sample_idx + 1, sorted_indices.tolist()]
+                                    for sample_idx, sorted_indices in enumerate(self.original_indices)]
 
-            # 获取从大到小的排序索引
-            sorted_indices = np.argsort(mean_values)[::-1]
+    def validate_vp_data(self):
+        """检查arr_1中所有VP记录并在Log中报告，保存有效掩码"""
+        self.vp_valid_mask = None
+        try:
+            valid_mask, problems = validate_vp_records(self.arr_0, self.arr_1, self.x_train.shape)
+        except ValueError as e:
+            self.append_log(f"VP check failed: {str(e)}")
+            return
+
+        # 实例数与x_train不一致时，超出部分的记录无法绘制
+        if valid_mask.shape[0] > self.x_train.shape[0]:
+            valid_mask[self.x_train.shape[0]:] = False
+        self.vp_valid_mask = valid_mask
+        self.append_log(vp_validation_report(self.arr_0, self.arr_1, self.x_train.shape, problems))
+
+    # 跟随模式
+    def start_follow(self):
+        """选择训练过程写入的文件夹，定时映射新追加的instance"""
+        folder = filedialog.askdirectory(title="Choose Folder Being Written by the Training Job")
+        if not folder:
+            return
+
+        try:
+            sources = {name: FollowSource.find(folder, name) for name in FOLLOW_MEMBERS}
+            sources = {name: source for name, source in sources.items() if source is not None}
+            if len(sources) == 0:
+                raise ValueError("No attention/heatmap/arr_0/arr_1 members (.bin + .json or chunk folder) found")
+        except Exception as e:
+            messagebox.showerror("Error", f"Error following folder: {str(e)}")
+            return
+
+        self.stop_follow()
+        self.follow_sources = sources
+        self.follow_rankings = [GrowableArray(), GrowableArray(), GrowableArray()]
+        if 'attention' in sources:
+            self.attention_data = self.attention_path = None
+            self.all_samples_indices = []
+            self.reindex_order = self.reindexed_dir = None
+        if 'heatmap' in sources:
+            self.heatmap_data = self.heatmap_path = None
+        if 'arr_0' in sources and 'arr_1' in sources:
+            self.arr_0 = self.arr_1 = self.vp_valid_mask = None
+        self.append_log(f"Following {folder}: {', '.join(sources)}")
+        self.poll_follow()
+
+    def stop_follow(self):
+        """停止跟随"""
+        if self.follow_job is not None:
+            self.root.after_cancel(self.follow_job)
+        self.follow_job = self.follow_sources = self.follow_rankings = None
+        self.follow_info_label.config(text="Not following")
+
+    def poll_follow(self):
+        """读取各成员新追加的instance，只处理新增部分并扩展控件范围"""
+        sources = self.follow_sources
+        try:
+            added = {name: source.poll() for name, source in sources.items()}
+
+            attention = sources.get('attention')
+            if attention is not None and added['attention']:
+                start_row = 0 if self.attention_data is None else self.attention_data.shape[0]
+                self.attention_data = attention.data
+                self.process_attention_data(start_row)
+                self.attention_sample_spinbox.config(to=attention.count)
+                self.attention_count_spinbox.config(to=self.attention_data.shape[1])
+                if start_row == 0:
+                    self.attention_count_var.set(min(15, self.attention_data.shape[1]))
+                self.attention_info_label.config(text=f"Live attention: {self.attention_data.shape}",
+                                                 foreground="green")
+
+            heatmap = sources.get('heatmap')
+            if heatmap is not None and added['heatmap']:
+                self.heatmap_data = heatmap.data
+                if len(self.heatmap_data.shape) != 3 or self.heatmap_data.shape[1] != self.heatmap_data.shape[2]:
+                    raise ValueError("Heatmap should be (instance, shape_number, shape_number)")
+                shape_count = self.heatmap_data.shape[1]
+                self.heatmap_sample_spinbox.config(to=heatmap.count)
+                self.heatmap_start_spinbox.config(to=shape_count)
+                self.heatmap_end_spinbox.config(to=shape_count)
+                self.heatmap_info_label.config(text=f"Live heatmap: {self.heatmap_data.shape}", foreground="green")
+
+            if 'arr_0' in sources and 'arr_1' in sources and (added['arr_0'] or added['arr_1']):
+                # 只使用两个成员都已写入的instance
+                count = min(sources['arr_0'].count, sources['arr_1'].count)
+                start_row = 0 if self.arr_1 is None else self.arr_1.shape[0]
+                if count > start_row:
+                    self.arr_0 = sources['arr_0'].data[:count]
+                    self.arr_1 = sources['arr_1'].data[:count]
+                    if self.x_train is not None:
+                        # 只检查新增instance的VP记录
+                        valid_mask, _ = validate_vp_records(self.arr_0[start_row:], self.arr_1[start_row:],
+                                                            self.x_train.shape)
+                        valid_mask[max(self.x_train.shape[0] - start_row, 0):] = False
+                        self.vp_valid_mask = (valid_mask if start_row == 0 or self.vp_valid_mask is None
+                                              else np.concatenate([self.vp_valid_mask, valid_mask]))
+                    self.update_control_ranges()
+
+            new_rows = {name: count for name, count in added.items() if count}
+            if new_rows:
+                self.append_log("Follow: " + ", ".join(f"+{count} {name}" for name, count in new_rows.items()))
+            self.follow_info_label.config(
+                text="Following: " + ", ".join(f"{name} {source.count}" for name, source in sources.items()))
+        except Exception as e:
+            self.append_log(f"Follow error: {str(e)}")
+
+        if self.follow_sources is sources:
+            self.follow_job = self.root.after(FOLLOW_INTERVAL_MS, self.poll_follow)
+
+    # Attention saliency
+    def get_attention_saliency(self):
+        """返回与x_train同形的attention saliency，未开启或缺少attention时返回None；结果按文件指纹缓存"""
+        if not self.saliency_var.get() or self.attention_means is None or self.arr_1 is None:
+            return None
+        key = (self.attention_means, self.arr_1, self.vp_valid_mask, self.x_train)
+        if self.saliency_key is not None and all(a is b for a, b in zip(key, self.saliency_key)):
+            return self.saliency
+
+        start = time.perf_counter()
+        compute = lambda: [attention_saliency(self.arr_1, self.attention_means, self.x_train.shape,
+                                              self.vp_valid_mask)]
+        sources = [self.attention_path, getattr(self.arr_0, 'filename', None) or self.npz_path_var.get(),
+                   self.npy_path_var.get()]
+        cached = False
+        if self.follow_sources is None and all(path and os.path.exists(path) for path in sources):
+            (self.saliency,), cached = cached_arrays(
+                artifact_dir(*sources), ["saliency"], compute)
+        else:
+            self.saliency = compute()[0]
+        self.saliency_key = key
+        self.append_log(f"Attention saliency {'loaded from cache' if cached else 'computed'} "
+                        f"in {time.perf_counter() - start:.3f} s")
+        return self.saliency
+
+    # Instance查询
+    def get_query_index(self):
+        """返回当前数据的列式索引，数据变化后重新建立"""
+        key = (self.original_indices, self.attention_means, self.arr_1, self.heatmap_data)
+        if self.query_index_key is None or any(a is not b for a, b in zip(key, self.query_index_key)):
+            start = time.perf_counter()
+            self.query_index = build_query_index(self.original_indices, self.attention_means,
+                                                 self.arr_1, self.heatmap_data)
+            self.query_index_key = key
+            self.append_log(f"Query index built in {time.perf_counter() - start:.3f} s: "
+                            f"{', '.join(self.query_index)}")
+        return self.query_index
+
+    def run_query(self):
+        """执行查询并在列表中显示匹配的instance"""
+        try:
+            index = self.get_query_index()
+            start = time.perf_counter()
+            self.query_results = run_instance_query(index, self.query_var.get())
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            messagebox.showerror("Error", f"Error running query: {str(e)}")
+            return
 
-            # 存储排序后的数据和原始索引
-            self.sorted_attention_data[sample_idx] = self.attention_data[sample_idx][sorted_indices]
-            self.original_indices[sample_idx] = sorted_indices
+        self.query_listbox.delete(0, tk.END)
+        for sample_idx in self.query_results[:QUERY_LIST_LIMIT]:
+            description = f"Instance {sample_idx + 1}"
+            if 'top_shape' in index:
+                description += f":  top shape {index['top_shape'][sample_idx]}"
+            if 'top_var' in index and np.isfinite(index['top_var'][sample_idx]):
+                description += (f" (Var {int(index['top_var'][sample_idx])}, "
+                                f"t {index['top_start'][sample_idx]:g}-{index['top_end'][sample_idx]:g})")
+            self.query_listbox.insert(tk.END, description)
+        shown = "" if len(self.query_results) <= QUERY_LIST_LIMIT else f", first {QUERY_LIST_LIMIT} shown"
+        self.query_info_label.config(text=f"{len(self.query_results)} of {len(index['instance'])} instances match "
+                                          f"({elapsed * 1000:.1f} ms{shown})")
+
+    def on_query_select(self, event):
+        """点击查询结果后所有视图切换到该instance"""
+        selection = self.query_listbox.curselection()
+        if selection:
+            self.go_to_instance(int(self.query_results[selection[0]]) + 1)
+
+    # 键盘导航
+    def navigation_instance_count(self):
+        """所有已加载视图共有的instance数"""
+        counts = [data.shape[0] for data in (self.x_train, self.heatmap_data, self.attention_data) if data is not None]
+        return min(counts) if counts else 0
+
+    def on_navigation_key(self, event, step):
+        """翻页键/Ctrl+方向键切换instance；焦点在文本输入控件中时保留其原有的光标移动"""
+        if isinstance(event.widget, (tk.Entry, ttk.Entry, tk.Spinbox, tk.Listbox, tk.Text)):
+            return
+        self.step_instance(step)
 
-            # 添加到所有sample的索引列表
-            self.all_samples_indices.append([sample_idx + 1, sorted_indices.tolist()])
+    def step_instance(self, step):
+        """所有关联视图同时切换到上一个/下一个instance，渲染延迟到按键停止后"""
+        instance_count = self.navigation_instance_count()
+        if instance_count == 0:
+            return
+        try:
+            current = self.attention_sample_var.get() if self.attention_data is not None else (
+                self.heatmap_sample_var.get() if self.heatmap_data is not None
+                else self.sequence_controls[0]['instance'].get())
+        except (tk.TclError, IndexError):
+            current = 1
+        self.go_to_instance(min(max(current + step, 1), instance_count))
+
+    def go_to_instance(self, instance):
+        """把所有关联视图切换到指定instance（从1开始），渲染延迟到NAV_DEBOUNCE_MS之后"""
+        instance_count = self.navigation_instance_count()
+        self.heatmap_sample_var.set(instance)
+        self.attention_sample_var.set(instance)
+        for controls in self.sequence_controls:
+            controls['instance'].set(instance)
+        self.nav_info_label.config(text=f"Instance {instance} / {instance_count}")
+
+        # 取消尚未执行的渲染，只保留最后一次
+        if self.nav_job is not None:
+            self.root.after_cancel(self.nav_job)
+        self.nav_generation += 1
+        self.nav_job = self.root.after(NAV_DEBOUNCE_MS, self.render_navigation, self.nav_generation, 0)
+
+    def render_navigation(self, generation, step):
+        """依次渲染各视图，每个视图单独排队，期间有新按键时放弃剩余视图"""
+        if generation != self.nav_generation:
+            return
+        self.nav_job = None
+        renderers = [renderer for data, renderer in [(self.x_train, self.update_upper_plots),
+                                                     (self.heatmap_data, self.update_heatmap),
+                                                     (self.attention_data, self.update_attention_plot)]
+                     if data is not None]
+        if step < len(renderers):
+            renderers[step]()
+            self.root.after_idle(self.render_navigation, generation, step + 1)
 
     def update_control_ranges(self):
         """更新控件的范围"""
@@ -759,9 +3170,11 @@ class MergedVisualizationApp:
 
     def update_upper_plots(self):
         """更新上半部分图形"""
+        self.ensure_basic_visualization()
         self.upper_fig.clear()
 
         plot_count = self.plot_count_var.get()
+        saliency = self.get_attention_saliency()
 
         # 根据图片数量确定子图布局
         if plot_count == 1:
@@ -801,6 +3214,29 @@ class MergedVisualizationApp:
 
                 # 提取数据
                 seq_length = end_time - start_time
+                mode = self.upper_mode_var.get()
+                band = None
+                if saliency is not None and sample_idx < saliency.shape[0]:
+                    band = np.asarray(saliency[sample_idx, start_time:end_time]).T  # (dimension_number, length)
+                    band_limit = np.abs(saliency[sample_idx]).max()
+                if mode != "single":
+                    # 一次切片取出所有variable，单个LineCollection绘制
+                    ax = self.upper_fig.add_subplot(subplot_layout[0], subplot_layout[1], i + 1)
+                    draw_all_variables(ax, self.x_train[sample_idx, start_time:end_time, :], start_time,
+                                       stacked=(mode == "stacked"))
+                    if band is not None and mode == "stacked":
+                        # 每个variable一行色带，与堆叠的曲线对齐
+                        draw_saliency_band(ax, band, start_time, band_limit,
+                                           (-0.05, self.x_train.shape[2] - 0.05))
+                    elif band is not None:
+                        # 叠加显示时每个时刻取绝对值最大的variable
+                        strongest = np.abs(band).argmax(axis=0)
+                        draw_saliency_band(ax, band[strongest, np.arange(band.shape[1])][None, :],
+                                           start_time, band_limit)
+                    ax.set_title(
+                        f'Sequence {i + 1}: Instance {sample_idx + 1}, All {self.x_train.shape[2]} Variables\nTime {start_time}-{end_time - 1} (Length: {seq_length})')
+                    continue
+
                 data_to_plot = self.x_train[sample_idx, start_time:end_time, dimension_idx]
 
                 # 创建实际的时间轴（从start_time到end_time）
@@ -815,12 +3251,15 @@ class MergedVisualizationApp:
                 ax.set_ylabel('Value')
                 ax.grid(True, alpha=0.3)
                 ax.legend()
+                if band is not None:
+                    draw_saliency_band(ax, band[dimension_idx:dimension_idx + 1], start_time, band_limit)
 
         self.upper_fig.tight_layout()
         self.upper_canvas.draw()
 
     def update_shape_comparison_plot(self):
         """更新Shape位置比较图形"""
+        self.ensure_basic_visualization()
         self.shape_comparison_fig.clear()
 
         ax = self.shape_comparison_fig.add_subplot(1, 1, 1)
@@ -840,20 +3279,18 @@ class MergedVisualizationApp:
             messagebox.showwarning("Warning", "Please load heatmap data first!")
             return
 
+        self.ensure_advanced_visualization()
         try:
             sample_idx = self.heatmap_sample_var.get() - 1  # 转换为0索引
             start_shape = self.heatmap_start_var.get() - 1  # 转换为0索引
             end_shape = self.heatmap_end_var.get()  # 保持为结束位置
 
             # 验证参数
-            if sample_idx >= self.heatmap_data.shape[0] or sample_idx < 0:
-                sample_idx = 0
-            if start_shape < 0:
-                start_shape = 0
-            if end_shape > self.heatmap_data.shape[1]:
-                end_shape = self.heatmap_data.shape[1]
-            if start_shape >= end_shape:
-                messagebox.showerror("Error", "Start shape must be less than end shape!")
+            try:
+                sample_idx, start_shape, end_shape = clamp_heatmap_view(
+                    self.heatmap_data.shape, sample_idx, start_shape, end_shape)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
                 return
 
             # 清除之前的图形，但保留colorbar
@@ -862,25 +3299,43 @@ class MergedVisualizationApp:
             else:
                 self.heatmap_fig.clear()
 
-            # 提取数据切片
-            data_slice = self.heatmap_data[sample_idx, start_shape:end_shape, start_shape:end_shape]
+            # 提取数据切片（重排时从该instance的完整矩阵中按顺序取出）
+            order = self.heatmap_order(sample_idx)
+            if order is None:
+                data_slice = heatmap_block(self.heatmap_data, sample_idx, start_shape, end_shape)
+                self.current_heatmap_order = None
+            else:
+                positions = order[start_shape:end_shape]
+                full = heatmap_block(self.heatmap_data, sample_idx, 0, self.heatmap_data.shape[1])
+                data_slice = np.asarray(full)[np.ix_(positions, positions)]
+                self.current_heatmap_order = positions
+
+            # 块统计使用的前缀和：原始顺序用旁路文件，重排或尚未建立时用当前切片现算
+            sat = self.get_heatmap_sat() if order is None else None
+            if sat is not None:
+                self.heatmap_view_sat = (sat[sample_idx], start_shape)
+            else:
+                self.heatmap_view_sat = (prefix_sums_2d(data_slice), 0)
+            self.heatmap_selection_artists = []
 
             # 创建或更新heatmap
             if self.current_heatmap_ax is None:
-                self.current_heatmap_ax = self.heatmap_fig.add_subplot(1, 1, 1)
-
-            # 使用学术界专用的颜色（viridis或plasma）
-            im = self.current_heatmap_ax.imshow(data_slice, cmap='viridis', aspect='auto', interpolation='nearest')
-
-            # 设置标题
-            self.current_heatmap_ax.set_title(
-                f'Heatmap: Instance {sample_idx + 1}, Shapes {start_shape + 1}-{end_shape}')
-
-            # 隐藏坐标轴数字
-            self.current_heatmap_ax.set_xticks([])
-            self.current_heatmap_ax.set_yticks([])
-            self.current_heatmap_ax.set_xlabel('Shape Index')
-            self.current_heatmap_ax.set_ylabel('Shape Index')
+                self.create_heatmap_axes()
+
+            im = draw_heatmap(self.current_heatmap_ax, data_slice, sample_idx, start_shape, end_shape)
+            if self.current_heatmap_order is not None:
+                self.current_heatmap_ax.set_title(
+                    f'Heatmap: Instance {sample_idx + 1}, Positions {start_shape + 1}-{end_shape} '
+                    f'({self.heatmap_order_var.get()} order)')
+                if len(positions) <= 40:
+                    # 坐标轴标注原始shape编号
+                    labels = [str(shape + 1) for shape in positions]
+                    self.current_heatmap_ax.set_xticks(range(len(positions)))
+                    self.current_heatmap_ax.set_yticks(range(len(positions)))
+                    self.current_heatmap_ax.set_xticklabels(labels, rotation=90, fontsize=7)
+                    self.current_heatmap_ax.set_yticklabels(labels, fontsize=7)
+            if self.heatmap_marginal_axes is not None:
+                self.draw_heatmap_marginals(sample_idx, start_shape, len(data_slice))
 
             # 存储当前显示的信息，用于点击事件
             self.current_start_shape = start_shape
@@ -889,25 +3344,199 @@ class MergedVisualizationApp:
 
             # 只在第一次或colorbar不存在时添加colorbar
             if self.heatmap_colorbar is None:
-                self.heatmap_colorbar = self.heatmap_fig.colorbar(im, ax=self.current_heatmap_ax)
+                if self.heatmap_cax is not None:
+                    self.heatmap_colorbar = self.heatmap_fig.colorbar(im, cax=self.heatmap_cax)
+                else:
+                    self.heatmap_colorbar = self.heatmap_fig.colorbar(im, ax=self.current_heatmap_ax)
                 self.heatmap_colorbar.set_label('Value')
             else:
                 # 更新现有colorbar的映射
                 self.heatmap_colorbar.mappable.set_array(data_slice)
                 self.heatmap_colorbar.mappable.set_clim(vmin=data_slice.min(), vmax=data_slice.max())
 
-            self.heatmap_fig.tight_layout()
+            if self.heatmap_marginal_axes is None:
+                self.heatmap_fig.tight_layout()  # 边缘和布局由gridspec确定
             self.heatmap_canvas.draw()
 
         except Exception as e:
             messagebox.showerror("Error", f"Error updating heatmap: {str(e)}")
 
+    def create_heatmap_axes(self):
+        """创建heatmap坐标轴；显示边缘和时上方为列和、右侧为行和"""
+        if not self.heatmap_marginals_var.get():
+            self.current_heatmap_ax = self.heatmap_fig.add_subplot(1, 1, 1)
+            self.heatmap_cax = self.heatmap_marginal_axes = None
+            return
+
+        grid = self.heatmap_fig.add_gridspec(2, 3, width_ratios=[6, 1, 0.25], height_ratios=[1, 6],
+                                             wspace=0.05, hspace=0.05)
+        self.current_heatmap_ax = self.heatmap_fig.add_subplot(grid[1, 0])
+        self.heatmap_marginal_axes = (self.heatmap_fig.add_subplot(grid[0, 0], sharex=self.current_heatmap_ax),
+                                      self.heatmap_fig.add_subplot(grid[1, 1], sharey=self.current_heatmap_ax))
+        self.heatmap_cax = self.heatmap_fig.add_subplot(grid[1, 2])
+
+    def draw_heatmap_marginals(self, sample_idx, start_shape, size):
+        """用前缀和（稀疏heatmap直接用CSR行）绘制当前视图的列和（上方）与行和（右侧）"""
+        if isinstance(self.heatmap_data, SparseHeatmap) and self.current_heatmap_order is None:
+            row_sums, col_sums = self.heatmap_data.block_marginals(sample_idx, start_shape, start_shape + size)
+        else:
+            table, offset = self.heatmap_view_sat
+            row_sums, col_sums = block_marginals(table, offset, offset + size)
+        top_ax, right_ax = self.heatmap_marginal_axes
+        top_ax.clear()
+        right_ax.clear()
+        top_ax.bar(np.arange(size), col_sums, width=1.0, color='gray')
+        right_ax.barh(np.arange(size), row_sums, height=1.0, color='gray')
+        top_ax.set_ylabel('Col Sum', fontsize=8)
+        right_ax.set_xlabel('Row Sum', fontsize=8)
+        top_ax.tick_params(labelbottom=False, labelsize=7)
+        right_ax.tick_params(labelleft=False, labelsize=7)
+        # 标题移到列和上方，避免与其重叠
+        top_ax.set_title(self.current_heatmap_ax.get_title())
+        self.current_heatmap_ax.set_title('')
+
+    def on_heatmap_marginals_changed(self):
+        """切换边缘和显示后重建heatmap布局"""
+        if self.heatmap_fig is None:
+            return
+        self.heatmap_fig.clear()
+        self.current_heatmap_ax = self.heatmap_colorbar = None
+        self.heatmap_cax = self.heatmap_marginal_axes = None
+        if self.heatmap_data is not None:
+            self.update_heatmap()
+
+    def get_heatmap_sat(self):
+        """返回当前稠密heatmap文件的二维前缀和旁路文件（内存映射），尚未建立时在后台生成并返回None；
+        稀疏heatmap不建立（会把所有instance还原为稠密），由当前视图的切片计算"""
+        if (self.follow_sources is not None or not isinstance(self.heatmap_data, np.ndarray)
+                or not self.heatmap_path or not os.path.exists(self.heatmap_path)):
+            return None
+        key = file_fingerprint(self.heatmap_path)
+        if self.heatmap_sat_key == key:
+            return self.heatmap_sat
+
+        sample_count, shape_count = self.heatmap_data.shape[:2]
+        directory = artifact_dir(self.heatmap_path)
+        sat = load_artifact(directory, "summed_area")
+        if sat is not None and sat.shape == (sample_count, shape_count + 1, shape_count + 1):
+            self.heatmap_sat, self.heatmap_sat_key = sat, key
+            return sat
+        if self.heatmap_sat_thread is not None and self.heatmap_sat_thread.is_alive():
+            return None
+
+        heatmap, result = self.heatmap_data, {}
+
+        def work():
+            start = time.perf_counter()
+            try:
+                result['sat'] = build_summed_area_tables(heatmap, os.path.join(directory, "summed_area.npy"))
+                result['elapsed'] = time.perf_counter() - start
+            except Exception as e:
+                result['error'] = e
+
+        def poll():
+            if self.heatmap_sat_thread.is_alive():
+                self.root.after(200, poll)
+            elif 'error' in result:
+                self.append_log(f"Summed-area tables failed: {str(result['error'])}")
+            else:
+                if self.heatmap_path and os.path.exists(self.heatmap_path) and file_fingerprint(self.heatmap_path) == key:
+                    self.heatmap_sat, self.heatmap_sat_key = result['sat'], key
+                self.append_log(f"Summed-area tables built in {result['elapsed']:.2f} s")
+
+        self.heatmap_sat_thread = threading.Thread(target=work, daemon=True)
+        self.heatmap_sat_thread.start()
+        poll()
+        return None
+
+    def heatmap_cell(self, event):
+        """把鼠标位置转换为当前视图中的(行, 列)，超出范围时截断"""
+        size = self.current_end_shape - self.current_start_shape
+        col = min(max(int(np.floor(event.xdata + 0.5)), 0), size - 1)
+        row = min(max(int(np.floor(event.ydata + 0.5)), 0), size - 1)
+        return row, col
+
+    def on_heatmap_drag(self, event):
+        """右键拖动时显示所选矩形块的和与均值"""
+        if self.heatmap_drag is None or event.inaxes != self.current_heatmap_ax or event.xdata is None:
+            return
+        from matplotlib.patches import Rectangle
+
+        row0, col0 = self.heatmap_drag
+        row1, col1 = self.heatmap_cell(event)
+        row_start, row_end = min(row0, row1), max(row0, row1) + 1
+        col_start, col_end = min(col0, col1), max(col0, col1) + 1
+        table, offset = self.heatmap_view_sat
+        total = block_sum(table, row_start + offset, row_end + offset, col_start + offset, col_end + offset)
+        mean = total / ((row_end - row_start) * (col_end - col_start))
+
+        # 原始顺序下显示shape编号，重排时显示位置
+        first = self.current_start_shape + 1 if self.current_heatmap_order is None else 1
+        name = "Shapes" if self.current_heatmap_order is None else "Positions"
+        text = (f"{name} rows {row_start + first}-{row_end + first - 1} x "
+                f"cols {col_start + first}-{col_end + first - 1}\nSum: {total:.4g}  Mean: {mean:.4g}")
+
+        for artist in self.heatmap_selection_artists:
+            artist.remove()
+        ax = self.current_heatmap_ax
+        self.heatmap_selection_artists = [
+            ax.add_patch(Rectangle((col_start - 0.5, row_start - 0.5), col_end - col_start, row_end - row_start,
+                                   fill=False, edgecolor='white', linewidth=1.5)),
+            ax.annotate(text, xy=(event.xdata, event.ydata), textcoords='offset points',
+                        xytext=(-10, 10) if col1 > (col_end + col_start) // 2 else (10, 10),
+                        ha='right' if col1 > (col_end + col_start) // 2 else 'left',
+                        bbox=dict(boxstyle='round,pad=0.3', facecolor='yellow', alpha=0.7), fontsize=9)]
+        self.click_info_label.config(text=text.replace("\n", ", "), foreground="blue")
+        self.heatmap_canvas.draw_idle()
+
+    def on_heatmap_release(self, event):
+        """结束右键拖动，保留选框与统计结果"""
+        if event.button == 3:
+            self.heatmap_drag = None
+
+    def on_heatmap_order_changed(self):
+        """切换shape显示顺序后重绘heatmap"""
+        if self.heatmap_data is not None:
+            self.update_heatmap()
+
+    def heatmap_order(self, sample_idx):
+        """返回当前排序方式下该instance所有shape的显示顺序，原始顺序返回None；结果按instance缓存"""
+        mode = self.heatmap_order_var.get()
+        if mode == "original":
+            return None
+        # heatmap或attention排序结果变化后缓存的顺序失效
+        source = (self.heatmap_data, self.original_indices)
+        if (self.heatmap_orders_source is None
+                or any(a is not b for a, b in zip(source, self.heatmap_orders_source))):
+            self.heatmap_orders.clear()
+            self.heatmap_orders_source = source
+        key = (mode, sample_idx)
+        if key in self.heatmap_orders:
+            self.heatmap_orders.move_to_end(key)
+            return self.heatmap_orders[key]
+
+        shape_count = self.heatmap_data.shape[1]
+        if mode == "attention":
+            if self.original_indices is None or sample_idx >= self.original_indices.shape[0]:
+                raise ValueError("Please load attention data for this instance first!")
+            order = full_shape_order(np.asarray(self.original_indices[sample_idx:sample_idx + 1]), shape_count)[0]
+        else:
+            # 以每个shape与其他shape的（对称化）权重向量为特征做层次聚类
+            weights = np.asarray(heatmap_block(self.heatmap_data, sample_idx, 0, shape_count), dtype=np.float64)
+            order = average_linkage_order(np.hstack([weights, weights.T]))
+
+        self.heatmap_orders[key] = order
+        if len(self.heatmap_orders) > HEATMAP_ORDER_CACHE_SIZE:
+            self.heatmap_orders.popitem(last=False)
+        return order
+
     def update_attention_plot(self):
         """更新Attention图表显示"""
         if self.attention_data is None or self.sorted_attention_data is None:
             messagebox.showwarning("Warning", "Please load attention data first!")
             return
 
+        self.ensure_advanced_visualization()
         try:
             sample_idx = self.attention_sample_var.get() - 1  # 转换为0索引
             shape_count = self.attention_count_var.get()
@@ -931,22 +3560,11 @@ class MergedVisualizationApp:
 
             # 创建柱状图
             self.attention_ax = self.attention_fig.add_subplot(1, 1, 1)
-
-            self.attention_bars = self.attention_ax.bar(range(shape_count), mean_values,
-                                                        color='steelblue', alpha=0.7)
-
-            # 设置标题和标签
-            self.attention_ax.set_title(
-                f'Attention Values: Instance {sample_idx + 1}, Top {shape_count} Shapes (High to Low)')
-            self.attention_ax.set_xlabel('Rank (High to Low)')
-            self.attention_ax.set_ylabel('Attention Value')
-            self.attention_ax.grid(True, alpha=0.3)
-
-            # 隐藏x轴标签
-            self.attention_ax.set_xticks([])
+            self.attention_bars = draw_attention_bars(self.attention_ax, mean_values, sample_idx)
 
             # 存储原始索引用于hover显示
             self.current_attention_indices = original_idx
+            self.current_sample_attention_idx = sample_idx
 
             self.attention_fig.tight_layout()
             self.attention_canvas.draw()
@@ -963,13 +3581,24 @@ class MergedVisualizationApp:
         if self.heatmap_data is None or self.current_heatmap_ax is None:
             return
 
+        if event.button == 3:
+            # 右键拖动选择矩形块
+            if event.xdata is not None and self.heatmap_view_sat is not None:
+                self.heatmap_drag = self.heatmap_cell(event)
+                self.on_heatmap_drag(event)
+            return
+
         try:
             # 获取点击的像素坐标
             x, y = int(event.xdata), int(event.ydata)
 
-            # 转换为实际的shape坐标
-            actual_x = x + self.current_start_shape  # 第一个shape number
-            actual_y = y + self.current_start_shape  # 第二个shape number
+            # 转换为实际的shape坐标（重排显示时映射回原始shape索引）
+            if self.current_heatmap_order is not None:
+                actual_x = int(self.current_heatmap_order[x])
+                actual_y = int(self.current_heatmap_order[y])
+            else:
+                actual_x = x + self.current_start_shape  # 第一个shape number
+                actual_y = y + self.current_start_shape  # 第二个shape number
 
             # 显示点击信息
             info_text = f"Clicked: Shape {actual_x + 1} vs Shape {actual_y + 1}. Generating comparison..."
@@ -998,26 +3627,28 @@ class MergedVisualizationApp:
                 messagebox.showerror("Error", "Selected shapes are out of data range")
                 return
 
-            # 获取VP数据
-            vp1_data = self.arr_1[current_sample_idx, shape1_idx, :]
-            vp2_data = self.arr_1[current_sample_idx, shape2_idx, :]
-
-            if len(vp1_data) < 4 or len(vp2_data) < 4:
-                messagebox.showerror("Error", "VP data format is incorrect.")
+            # 获取并解析VP数据
+            try:
+                length1, start1, end1, label1 = parse_vp(self.arr_1, current_sample_idx, shape1_idx)
+                length2, start2, end2, label2 = parse_vp(self.arr_1, current_sample_idx, shape2_idx)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
                 return
 
-            # 解析VP数据
-            length1, start1, end1, label1 = int(vp1_data[0]), int(vp1_data[1]), int(vp1_data[2]), vp1_data[3]
-            length2, start2, end2, label2 = int(vp2_data[0]), int(vp2_data[1]), int(vp2_data[2]), vp2_data[3]
-
             # 调用现有的comparison显示方法
             self.show_comparison_window(
                 current_sample_idx, shape1_idx, length1, start1, end1, label1,
                 current_sample_idx, shape2_idx, length2, start2, end2, label2
             )
 
-            # 更新信息显示
+            # 更新信息显示（附带两个shape的DTW距离）
             info_text = f"Comparison generated: Instance {current_sample_idx + 1}, Shapes {shape1_idx + 1} vs {shape2_idx + 1}"
+            if self.arr_0 is not None:
+                series = prepare_dtw_shapes(self.arr_0, self.arr_1, np.array([current_sample_idx] * 2),
+                                            np.array([shape1_idx, shape2_idx]))
+                window = max(1, int(round(series.shape[1] * DTW_BAND_FRACTION)))
+                distance = dtw_band(series[:1], series[1:], window)[0]
+                info_text += f", DTW {distance:.3f}"
             self.click_info_label.config(text=info_text, foreground="green")
 
         except Exception as e:
@@ -1043,6 +3674,9 @@ class MergedVisualizationApp:
                 if bar.contains(event)[0]:
                     # 显示原始索引
                     original_idx = self.current_attention_indices[i]
+                    if self.reindex_order is not None:
+                        # 重排数据中的位置映射回原始shape索引
+                        original_idx = self.reindex_order[self.current_sample_attention_idx, original_idx]
                     height = bar.get_height()
 
                     annotation = self.attention_ax.annotate(
@@ -1100,18 +3734,14 @@ class MergedVisualizationApp:
                     messagebox.showerror("Error", f"{name} number is out of range")
                     return
 
-            # 获取VP数据
-            vp1_data = self.arr_1[sample1_idx, shape1_idx, :]
-            vp2_data = self.arr_1[sample2_idx, shape2_idx, :]
-
-            if len(vp1_data) < 4 or len(vp2_data) < 4:
-                messagebox.showerror("Error", "VP data format is incorrect.")
+            # 获取并解析VP数据
+            try:
+                length1, start1, end1, label1 = parse_vp(self.arr_1, sample1_idx, shape1_idx)
+                length2, start2, end2, label2 = parse_vp(self.arr_1, sample2_idx, shape2_idx)
+            except ValueError as e:
+                messagebox.showerror("Error", str(e))
                 return
 
-            # 解析VP数据
-            length1, start1, end1, label1 = int(vp1_data[0]), int(vp1_data[1]), int(vp1_data[2]), vp1_data[3]
-            length2, start2, end2, label2 = int(vp2_data[0]), int(vp2_data[1]), int(vp2_data[2]), vp2_data[3]
-
             # 创建对比窗口
             self.show_comparison_window(
                 sample1_idx, shape1_idx, length1, start1, end1, label1,
@@ -1124,61 +3754,748 @@ class MergedVisualizationApp:
     def show_comparison_window(self, sample1_idx, shape1_idx, length1, start1, end1, label1,
                                sample2_idx, shape2_idx, length2, start2, end2, label2):
         """在主窗口的下方区域显示比较结果"""
+        self.ensure_basic_visualization()
         # 清除之前的图形
         self.shape_comparison_fig.clear()
 
-        # 创建2个子图 (1行2列)
-        ax1 = self.shape_comparison_fig.add_subplot(1, 2, 1)
-        ax2 = self.shape_comparison_fig.add_subplot(1, 2, 2)
-
-        # 验证variable索引范围并转换为整数
-        var1_idx = int(label1)
-        var2_idx = int(label2)
-
-        # 确保variable索引在有效范围内
-        if var1_idx >= self.x_train.shape[2] or var1_idx < 0:
-            var1_idx = 0
-        if var2_idx >= self.x_train.shape[2] or var2_idx < 0:
-            var2_idx = 0
-
-        # 绘制第一组时间序列数据 - 使用正确的variable
-        if start1 < self.x_train.shape[1] and end1 <= self.x_train.shape[1]:
-            ts1 = self.x_train[sample1_idx, :, var1_idx]  # 使用正确的variable索引
-            ax1.plot(ts1, linewidth=2, color='green', label='Time Series 1')
-            if start1 < end1:
-                ax1.axvspan(start1, end1, alpha=0.3, color='red',
-                            label=f'Corresponding Shape')
-                highlight_ts1 = ts1[start1:end1]
-                ax1.plot(range(start1, end1), highlight_ts1, linewidth=3, color='red', alpha=0.8)
-        ax1.set_title(
-            f'Instance {sample1_idx + 1}, Shape {shape1_idx + 1}\nTime: {start1}-{end1}, Variable: {var1_idx + 1}')
-        ax1.set_xlabel('Time Index')
-        ax1.set_ylabel('Value')
-        ax1.legend()
-        ax1.grid(True, alpha=0.3)
-
-        # 绘制第二组时间序列数据 - 使用正确的variable
-        if start2 < self.x_train.shape[1] and end2 <= self.x_train.shape[1]:
-            ts2 = self.x_train[sample2_idx, :, var2_idx]  # 使用正确的variable索引
-            ax2.plot(ts2, linewidth=2, color='green', label='Time Series 2')
-            if start2 < end2:
-                ax2.axvspan(start2, end2, alpha=0.3, color='red',
-                            label=f'Corresponding Shape')
-                highlight_ts2 = ts2[start2:end2]
-                ax2.plot(range(start2, end2), highlight_ts2, linewidth=3, color='red', alpha=0.8)
-        ax2.set_title(
-            f'Instance {sample2_idx + 1}, Shape {shape2_idx + 1}\nTime: {start2}-{end2}, Variable: {var2_idx + 1}')
-        ax2.set_xlabel('Time Index')
-        ax2.set_ylabel('Value')
-        ax2.legend()
-        ax2.grid(True, alpha=0.3)
-
-        # 添加总标题
-        self.shape_comparison_fig.suptitle('Heatmap-Based Shape Comparison Analysis', fontsize=14)
+        # 使用加载时的VP检查结果，无需逐次校正
+        valid1 = valid2 = None
+        if self.vp_valid_mask is not None:
+            valid1 = bool(self.vp_valid_mask[sample1_idx, shape1_idx])
+            valid2 = bool(self.vp_valid_mask[sample2_idx, shape2_idx])
+
+        draw_shape_comparison(self.shape_comparison_fig, self.x_train,
+                              (sample1_idx, shape1_idx, start1, end1, label1, valid1),
+                              (sample2_idx, shape2_idx, start2, end2, label2, valid2),
+                              saliency=self.get_attention_saliency())
 
         self.shape_comparison_fig.tight_layout()
         self.shape_comparison_canvas.draw()
 
+    # Shape画廊方法
+    def gallery_selection(self, across_instances, sample_idx, count):
+        """选择画廊中显示的shape，有attention时按排序取前count个，返回(samples, shapes, scores)"""
+        sample_count, shape_count = self.arr_0.shape[:2]
+        ranked = (self.attention_means is not None and self.attention_means.shape[0] == sample_count
+                  and self.attention_means.shape[1] <= shape_count)
+
+        if not across_instances:
+            if ranked:
+                shapes = np.asarray(self.original_indices[sample_idx, :count])
+                scores = np.asarray(self.attention_means[sample_idx, shapes])
+            else:
+                shapes = np.arange(min(count, shape_count))
+                scores = None
+            return np.full(len(shapes), sample_idx), shapes, scores
+
+        if ranked:
+            # 所有sample的所有shape按平均attention全局排序
+            flat_means = np.asarray(self.attention_means).ravel()
+            count = min(count, flat_means.size)
+            top = np.argpartition(-flat_means, count - 1)[:count]
+            top = top[np.argsort(-flat_means[top], kind='stable')]
+            samples, shapes = np.divmod(top, self.attention_means.shape[1])
+            return samples, shapes, flat_means[top]
+
+        flat = np.arange(min(count, sample_count * shape_count))
+        samples, shapes = np.divmod(flat, shape_count)
+        return samples, shapes, None
+
+    def show_shape_gallery(self):
+        """以单个LineCollection显示大量shape的缩略图"""
+        if self.arr_0 is None or self.arr_1 is None:
+            messagebox.showwarning("Warning", "Please load data files first!")
+            return
+
+        window, fig, canvas = self.create_figure_window("Shape Gallery", (12, 8))
+        controls = window.control_frame
+
+        across_var = tk.BooleanVar(value=False)
+        instance_var = tk.IntVar(value=self.pos_sample1_var.get())
+        count_var = tk.IntVar(value=200)
+        columns_var = tk.IntVar(value=20)
+        rows_visible_var = tk.IntVar(value=10)
+        ttk.Checkbutton(controls, text="Across Instances", variable=across_var).pack(side=tk.LEFT, padx=5)
+        for label, var in [("Instance:", instance_var), ("Number of Shapes:", count_var),
+                           ("Columns:", columns_var), ("Visible Rows:", rows_visible_var)]:
+            ttk.Label(controls, text=label).pack(side=tk.LEFT, padx=(10, 2))
+            ttk.Spinbox(controls, from_=1, to=1000000, textvariable=var, width=8).pack(side=tk.LEFT)
+        status_label = ttk.Label(window, text="Scroll to browse, click a shape to compare it",
+                                 font=("TkDefaultFont", 10))
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+
+        from matplotlib.collections import LineCollection
+        state = {}
+        ax = fig.add_subplot(1, 1, 1)
+
+        def render():
+            try:
+                sample_idx = min(max(instance_var.get() - 1, 0), self.arr_0.shape[0] - 1)
+                count = max(1, count_var.get())
+                columns = max(1, columns_var.get())
+                visible_rows = max(1, rows_visible_var.get())
+            except tk.TclError:
+                return
+
+            start = time.perf_counter()
+            samples, shapes, scores = self.gallery_selection(across_var.get(), sample_idx, count)
+            count = len(shapes)
+            starts = np.asarray(self.arr_1[samples, shapes, 1])
+            ends = np.asarray(self.arr_1[samples, shapes, 2])
+            lengths = np.nan_to_num(ends - starts, nan=self.arr_0.shape[2]).astype(int)
+            segments = gallery_segments(np.asarray(self.arr_0[samples, shapes], dtype=np.float64),
+                                        lengths, columns)
+
+            ax.clear()
+            collection = LineCollection(segments, linewidths=1.0)
+            if scores is not None:
+                collection.set_array(scores)
+                collection.set_cmap('viridis')
+            else:
+                collection.set_color('steelblue')
+            ax.add_collection(collection)
+
+            rows = int(np.ceil(count / columns))
+            ax.set_xlim(0, columns)
+            ax.set_ylim(-min(rows, visible_rows), 0)
+            ax.set_xticks(np.arange(columns + 1))
+            ax.set_yticks(-np.arange(rows + 1))
+            ax.set_xticklabels([])
+            ax.set_yticklabels([])
+            ax.grid(True, alpha=0.3)
+            title = ("Top shapes across all instances" if across_var.get()
+                     else f"Instance {sample_idx + 1}")
+            ax.set_title(f"{title}: {count} shapes" + (" (ranked by attention)" if scores is not None else ""))
+
+            state.update(samples=samples, shapes=shapes, columns=columns, rows=rows)
+            fig.tight_layout()
+            canvas.draw()
+            status_label.config(text=f"{count} shapes rendered in {time.perf_counter() - start:.3f} s. "
+                                     f"Scroll to browse, click a shape to compare it")
+
+        def cell_at(event):
+            if event.inaxes != ax or not state or event.xdata is None:
+                return None
+            col, row = int(np.floor(event.xdata)), int(np.floor(-event.ydata))
+            cell = row * state['columns'] + col
+            if 0 <= col < state['columns'] and 0 <= cell < len(state['shapes']):
+                return cell
+            return None
+
+        def on_scroll(event):
+            if event.inaxes != ax or not state:
+                return
+            low, high = ax.get_ylim()
+            step = 1 if event.button == 'up' else -1
+            low, high = low + step, high + step
+            # 限制在网格范围内
+            if high > 0:
+                low, high = low - high, 0
+            if low < -state['rows']:
+                low, high = -state['rows'], -state['rows'] + (high - low)
+            ax.set_ylim(low, high)
+            canvas.draw_idle()
+
+        def on_motion(event):
+            cell = cell_at(event)
+            if cell is not None:
+                status_label.config(text=f"Instance {state['samples'][cell] + 1}, Shape {state['shapes'][cell] + 1}"
+                                         f" (rank {cell + 1})")
+
+        def on_click(event):
+            cell = cell_at(event)
+            if cell is None:
+                return
+            # 上一次选择移到Comparison 2，新选择放入Comparison 1
+            self.pos_sample2_var.set(self.pos_sample1_var.get())
+            self.pos_shape2_var.set(self.pos_shape1_var.get())
+            self.pos_sample1_var.set(int(state['samples'][cell]) + 1)
+            self.pos_shape1_var.set(int(state['shapes'][cell]) + 1)
+            self.compare_shape_positions()
+
+        canvas.mpl_connect('scroll_event', on_scroll)
+        canvas.mpl_connect('motion_notify_event', on_motion)
+        canvas.mpl_connect('button_press_event', on_click)
+        ttk.Button(controls, text="Render", command=render, style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+        render()
+
+    def show_motif_density(self):
+        """显示所有instance的top-k shape在(variable, time)上的覆盖密度"""
+        if self.arr_1 is None or self.x_train is None or self.original_indices is None:
+            messagebox.showwarning("Warning", "Please load data files and attention data first!")
+            return
+
+        window, fig, canvas = self.create_figure_window("Shape Motif Density", (14, 8))
+        controls = window.control_frame
+        top_k_var = tk.IntVar(value=min(10, self.original_indices.shape[1]))
+        weighted_var = tk.BooleanVar(value=False)
+        ttk.Label(controls, text="Top-K Shapes:").pack(side=tk.LEFT, padx=(10, 2))
+        ttk.Spinbox(controls, from_=1, to=self.original_indices.shape[1], textvariable=top_k_var,
+                    width=8).pack(side=tk.LEFT)
+        ttk.Checkbutton(controls, text="Weight by Attention", variable=weighted_var).pack(side=tk.LEFT, padx=10)
+        status_label = ttk.Label(window, text="", font=("TkDefaultFont", 10))
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+        state = {}
+
+        def render():
+            try:
+                top_k = max(1, top_k_var.get())
+            except tk.TclError:
+                return
+            _, series_length, variable_count = self.x_train.shape
+            weights = self.attention_means if weighted_var.get() else None
+
+            start = time.perf_counter()
+            density, record_count = motif_density(self.arr_1, self.original_indices, top_k, series_length,
+                                                  variable_count, self.vp_valid_mask, weights)
+            elapsed = time.perf_counter() - start
+
+            fig.clear()
+            grid = fig.add_gridspec(2, 1, height_ratios=[3, 1])
+            ax = fig.add_subplot(grid[0])
+            im = ax.imshow(density, cmap='viridis', aspect='auto', interpolation='nearest',
+                           extent=(-0.5, series_length - 0.5, variable_count + 0.5, 0.5))
+            ax.set_title(f'Top-{top_k} Shape Coverage Over Time ({record_count} VP records)')
+            ax.set_ylabel('Variable')
+            fig.colorbar(im, ax=ax).set_label('Attention-weighted coverage' if weights is not None else 'Coverage')
+
+            # 所有variable合计的时间分布
+            total_ax = fig.add_subplot(grid[1], sharex=ax)
+            total_ax.plot(density.sum(axis=0), color='steelblue')
+            total_ax.set_xlim(-0.5, series_length - 0.5)
+            total_ax.set_xlabel('Time Index')
+            total_ax.set_ylabel('All Variables')
+            total_ax.grid(True, alpha=0.3)
+
+            state.update(ax=ax, density=density)
+            fig.tight_layout()
+            canvas.draw()
+            status_label.config(text=f"Density computed in {elapsed * 1000:.1f} ms")
+
+        def on_motion(event):
+            if not state or event.inaxes != state['ax'] or event.xdata is None:
+                return
+            time_idx, var_idx = int(round(event.xdata)), int(round(event.ydata)) - 1
+            density = state['density']
+            if 0 <= var_idx < density.shape[0] and 0 <= time_idx < density.shape[1]:
+                status_label.config(text=f"Variable {var_idx + 1}, Time {time_idx}: {density[var_idx, time_idx]:.3g}")
+
+        canvas.mpl_connect('motion_notify_event', on_motion)
+        ttk.Button(controls, text="Render", command=render, style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+        render()
+
+    def show_instance_embedding(self):
+        """把每个instance的平均attention向量投影到二维，悬停显示instance，点击切换所有视图"""
+        if self.attention_means is None:
+            messagebox.showwarning("Warning", "Please load attention data first!")
+            return
+
+        means = self.attention_means
+        if self.reindex_order is not None:
+            # 重排数据按排名存储，先还原为按shape编号排列的向量
+            order = np.asarray(self.reindex_order[:, :means.shape[1]])
+            restored = np.empty(means.shape, dtype=np.float64)
+            np.put_along_axis(restored, order, means, axis=1)
+            means = restored
+
+        try:
+            start = time.perf_counter()
+            embedding, explained = randomized_pca(means)
+            if embedding.shape[1] < 2:
+                embedding = np.column_stack([embedding, np.zeros(len(embedding))])
+            elapsed = time.perf_counter() - start
+        except (ValueError, np.linalg.LinAlgError) as e:
+            messagebox.showerror("Error", f"Error computing embedding: {str(e)}")
+            return
+
+        window, fig, canvas = self.create_figure_window("Instance Embedding (Attention Profile PCA)", (10, 8))
+        status_label = ttk.Label(window, text=f"{len(embedding)} instances projected in {elapsed:.3f} s. "
+                                              f"Hover to identify, click to load an instance",
+                                 font=("TkDefaultFont", 10))
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+
+        ax = fig.add_subplot(1, 1, 1)
+        top_weight = np.asarray(means).max(axis=1)
+        scatter = ax.scatter(embedding[:, 0], embedding[:, 1], c=top_weight, cmap='viridis', s=12)
+        fig.colorbar(scatter, ax=ax).set_label('Top Shape Mean Attention')
+        highlight, = ax.plot([], [], 'o', markersize=10, markerfacecolor='none', markeredgecolor='red')
+        ax.set_xlabel(f'PC 1 ({explained[0] * 100:.1f}% variance)')
+        ax.set_ylabel(f'PC 2 ({explained[1] * 100:.1f}% variance)' if len(explained) > 1 else 'PC 2')
+        ax.set_title('Instances by Attention Profile')
+        ax.grid(True, alpha=0.3)
+        fig.tight_layout()
+        canvas.draw()
+
+        # 按坐标轴范围归一化后建树，使拾取距离与屏幕距离一致
+        span = np.ptp(embedding, axis=0)
+        span[span == 0] = 1.0
+        tree = KDTree2D(embedding / span)
+
+        def point_at(event):
+            if event.inaxes != ax or event.xdata is None:
+                return None
+            index, distance = tree.nearest(np.array([event.xdata, event.ydata]) / span)
+            return index if index >= 0 and distance < 0.02 else None
+
+        def on_motion(event):
+            index = point_at(event)
+            if index is None:
+                return
+            highlight.set_data([embedding[index, 0]], [embedding[index, 1]])
+            canvas.draw_idle()
+            status_label.config(text=f"Instance {index + 1}: top shape mean attention {top_weight[index]:.4f}")
+
+        def on_click(event):
+            index = point_at(event)
+            if index is not None:
+                self.go_to_instance(index + 1)
+
+        canvas.mpl_connect('motion_notify_event', on_motion)
+        canvas.mpl_connect('button_press_event', on_click)
+
+    def shape_cluster_cache_dir(self):
+        """聚类结果的缓存目录，由shape文件和原始数据文件的指纹决定，无法确定来源时返回None"""
+        source = getattr(self.arr_0, 'filename', None) or self.npz_path_var.get()
+        if not source or not os.path.exists(source):
+            return None
+        sources = [source]
+        if self.npy_path_var.get() and os.path.exists(self.npy_path_var.get()):
+            sources.append(self.npy_path_var.get())  # 有效掩码依赖原始数据
+        return artifact_dir(*sources)
+
+    def cluster_shapes(self, clusters):
+        """计算或读取缓存的聚类结果，返回(labels, 中心, 是否命中缓存)"""
+        arr_0, arr_1, valid_mask = self.arr_0, self.arr_1, self.vp_valid_mask
+
+        def compute():
+            return list(minibatch_kmeans_shapes(arr_0, arr_1, clusters, valid_mask))
+
+        directory = self.shape_cluster_cache_dir()
+        if directory is not None:
+            (labels, centroids), hit = cached_arrays(
+                directory, [f"kmeans{clusters}_labels", f"kmeans{clusters}_centroids"], compute)
+            if labels.shape == arr_0.shape[:2]:
+                return labels, centroids, hit
+        labels, centroids = compute()
+        return labels, centroids, False
+
+    def show_shape_clusters(self):
+        """显示shape聚类的原型及每类的平均attention，点击原型查看成员并在比较区域显示"""
+        if self.arr_0 is None or self.arr_1 is None:
+            messagebox.showwarning("Warning", "Please load data files first!")
+            return
+
+        window, fig, canvas = self.create_figure_window("Shape Prototypes (Mini-batch K-means)", (12, 8))
+        controls = window.control_frame
+        clusters_var = tk.IntVar(value=16)
+        ttk.Label(controls, text="Clusters:").pack(side=tk.LEFT, padx=(10, 2))
+        ttk.Spinbox(controls, from_=2, to=256, textvariable=clusters_var, width=8).pack(side=tk.LEFT)
+
+        # 成员列表
+        list_frame = ttk.Frame(window)
+        list_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        listbox = tk.Listbox(list_frame, height=8, font=("TkDefaultFont", 10))
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=listbox.yview)
+        listbox.configure(yscrollcommand=scrollbar.set)
+        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        status_label = ttk.Label(window, text="", font=("TkDefaultFont", 10))
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+
+        from matplotlib.collections import LineCollection
+        ax = fig.add_subplot(1, 1, 1)
+        state = {}
+
+        def cluster_attention(labels, clusters):
+            if self.attention_means is None:
+                return None
+            sample_count, shape_count = (min(labels.shape[0], self.attention_means.shape[0]),
+                                         min(labels.shape[1], self.attention_means.shape[1]))
+            sub_labels = labels[:sample_count, :shape_count]
+            keep = sub_labels >= 0
+            totals = np.bincount(sub_labels[keep], np.asarray(self.attention_means)[:sample_count, :shape_count][keep],
+                                 minlength=clusters)
+            counts = np.bincount(sub_labels[keep], minlength=clusters)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return totals / counts
+
+        def draw(labels, centroids, hit, elapsed):
+            clusters = len(centroids)
+            sizes = np.bincount(labels[labels >= 0], minlength=clusters)
+            attention = cluster_attention(labels, clusters)
+            columns = int(np.ceil(np.sqrt(clusters)))
+            segments = gallery_segments(centroids.astype(np.float64), np.full(clusters, centroids.shape[1]), columns)
+
+            ax.clear()
+            collection = LineCollection(segments, linewidths=1.5)
+            if attention is not None:
+                collection.set_array(np.nan_to_num(attention))
+                collection.set_cmap('viridis')
+            else:
+                collection.set_color('steelblue')
+            ax.add_collection(collection)
+            for cluster in range(clusters):
+                row, col = divmod(cluster, columns)
+                text = f"C{cluster + 1} n={sizes[cluster]}"
+                if attention is not None and np.isfinite(attention[cluster]):
+                    text += f" att={attention[cluster]:.3f}"
+                ax.text(col + 0.05, -row - 0.05, text, fontsize=7, va='top')
+            rows = int(np.ceil(clusters / columns))
+            ax.set_xlim(0, columns)
+            ax.set_ylim(-rows, 0)
+            ax.set_xticks(np.arange(columns + 1))
+            ax.set_yticks(-np.arange(rows + 1))
+            ax.set_xticklabels([])
+            ax.set_yticklabels([])
+            ax.grid(True, alpha=0.3)
+            ax.set_title(f"{clusters} shape prototypes (z-normalized)" +
+                         (", colored by mean attention" if attention is not None else ""))
+            state.update(labels=labels, columns=columns, clusters=clusters, members=None)
+            fig.tight_layout()
+            canvas.draw()
+            source = "loaded from cache" if hit else f"computed in {elapsed:.2f} s"
+            status_label.config(text=f"{int(sizes.sum())} shapes clustered ({source}). "
+                                     f"Click a prototype to list its members")
+
+        def run():
+            try:
+                clusters = max(2, clusters_var.get())
+            except tk.TclError:
+                return
+            status_label.config(text="Clustering shapes...")
+            result = {}
+
+            def work():
+                start = time.perf_counter()
+                try:
+                    result['value'] = self.cluster_shapes(clusters) + (time.perf_counter() - start,)
+                except Exception as e:
+                    result['error'] = e
+
+            thread = threading.Thread(target=work, daemon=True)
+            thread.start()
+
+            def poll():
+                if thread.is_alive():
+                    window.after(200, poll)
+                elif 'error' in result:
+                    messagebox.showerror("Error", f"Error clustering shapes: {str(result['error'])}")
+                else:
+                    draw(*result['value'])
+
+            poll()
+
+        def on_click(event):
+            if event.inaxes != ax or not state or event.xdata is None:
+                return
+            col, row = int(np.floor(event.xdata)), int(np.floor(-event.ydata))
+            cluster = row * state['columns'] + col
+            if not (0 <= col < state['columns'] and 0 <= cluster < state['clusters']):
+                return
+
+            members = np.argwhere(state['labels'] == cluster)
+            if self.attention_means is not None:
+                # 按attention从高到低列出成员
+                scores = np.full(len(members), -np.inf)
+                has_attention = ((members[:, 0] < self.attention_means.shape[0]) &
+                                 (members[:, 1] < self.attention_means.shape[1]))
+                scores[has_attention] = np.asarray(self.attention_means)[members[has_attention, 0],
+                                                                         members[has_attention, 1]]
+                members = members[np.argsort(-scores, kind='stable')]
+            state['members'] = members[:QUERY_LIST_LIMIT]
+            listbox.delete(0, tk.END)
+            for sample_idx, shape_idx in state['members']:
+                listbox.insert(tk.END, f"Instance {sample_idx + 1}, Shape {shape_idx + 1}")
+            listed = f" (first {QUERY_LIST_LIMIT} listed)" if len(members) > QUERY_LIST_LIMIT else ""
+            status_label.config(text=f"Cluster {cluster + 1}: {len(members)} members{listed}")
+            if len(members) >= 2:
+                # 比较该类中attention最高的两个成员
+                self.pos_sample1_var.set(int(members[0, 0]) + 1)
+                self.pos_shape1_var.set(int(members[0, 1]) + 1)
+                self.pos_sample2_var.set(int(members[1, 0]) + 1)
+                self.pos_shape2_var.set(int(members[1, 1]) + 1)
+                self.compare_shape_positions()
+
+        def on_select(event):
+            selection = listbox.curselection()
+            if not selection or state.get('members') is None:
+                return
+            sample_idx, shape_idx = state['members'][selection[0]]
+            # 上一次选择移到Comparison 2，新选择放入Comparison 1
+            self.pos_sample2_var.set(self.pos_sample1_var.get())
+            self.pos_shape2_var.set(self.pos_shape1_var.get())
+            self.pos_sample1_var.set(int(sample_idx) + 1)
+            self.pos_shape1_var.set(int(shape_idx) + 1)
+            self.compare_shape_positions()
+
+        canvas.mpl_connect('button_press_event', on_click)
+        listbox.bind('<<ListboxSelect>>', on_select)
+        ttk.Button(controls, text="Cluster", command=run, style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+        run()
+
+    def show_dtw_matrix(self):
+        """计算top-k attention shape之间的DTW距离矩阵，与对应的heatmap并排显示，点击格子比较两个shape"""
+        if self.arr_0 is None or self.arr_1 is None:
+            messagebox.showwarning("Warning", "Please load data files first!")
+            return
+
+        window, fig, canvas = self.create_figure_window("Pairwise DTW of Top Shapes", (14, 7))
+        controls = window.control_frame
+        across_var = tk.BooleanVar(value=False)
+        instance_var = tk.IntVar(value=self.heatmap_sample_var.get())
+        count_var = tk.IntVar(value=20)
+        band_var = tk.IntVar(value=int(DTW_BAND_FRACTION * 100))
+        neighbors_var = tk.IntVar(value=0)
+        ttk.Checkbutton(controls, text="Across Instances", variable=across_var).pack(side=tk.LEFT, padx=5)
+        for label, var in [("Instance:", instance_var), ("Top-K Shapes:", count_var), ("Band (%):", band_var),
+                           ("Nearest Only (0 = all):", neighbors_var)]:
+            ttk.Label(controls, text=label).pack(side=tk.LEFT, padx=(10, 2))
+            ttk.Spinbox(controls, from_=0, to=1000000, textvariable=var, width=6).pack(side=tk.LEFT)
+        status_label = ttk.Label(window, text="", font=("TkDefaultFont", 10))
+        status_label.pack(side=tk.BOTTOM, fill=tk.X)
+        state = {}
+
+        def render():
+            try:
+                sample_idx = min(max(instance_var.get() - 1, 0), self.arr_0.shape[0] - 1)
+                count = max(2, count_var.get())
+                band = max(0, band_var.get())
+                neighbors = max(0, neighbors_var.get())
+            except tk.TclError:
+                return
+
+            start = time.perf_counter()
+            samples, shapes, _ = self.gallery_selection(across_var.get(), sample_idx, count)
+            series = prepare_dtw_shapes(self.arr_0, self.arr_1, samples, shapes)
+            window_size = int(round(series.shape[1] * band / 100))
+            matrix, computed = dtw_matrix(series, window_size, neighbors)
+            elapsed = time.perf_counter() - start
+
+            fig.clear()
+            labels = [f"{sample + 1}:{shape + 1}" if across_var.get() else str(shape + 1)
+                      for sample, shape in zip(samples, shapes)]
+            heatmap = self.heatmap_data
+            show_heatmap = (heatmap is not None and not across_var.get() and sample_idx < heatmap.shape[0]
+                            and shapes.max() < heatmap.shape[1])
+            matrix_axes = []
+            if show_heatmap:
+                # 对应shape之间的attention heatmap
+                heatmap_ax = fig.add_subplot(1, 2, 1)
+                block = np.asarray(heatmap_block(heatmap, sample_idx, 0, heatmap.shape[1]))[np.ix_(shapes, shapes)]
+                im = heatmap_ax.imshow(block, cmap='viridis', interpolation='nearest')
+                fig.colorbar(im, ax=heatmap_ax).set_label('Heatmap Value')
+                heatmap_ax.set_title(f'Heatmap: Instance {sample_idx + 1}, Top {len(shapes)} Shapes')
+                matrix_axes.append(heatmap_ax)
+            dtw_ax = fig.add_subplot(1, 2, 2) if show_heatmap else fig.add_subplot(1, 1, 1)
+            im = dtw_ax.imshow(np.ma.masked_invalid(matrix), cmap='magma_r', interpolation='nearest')
+            fig.colorbar(im, ax=dtw_ax).set_label('DTW Distance (z-normalized)')
+            dtw_ax.set_title(f'DTW: band {band}%' + (f', {neighbors} nearest per shape' if neighbors else ''))
+            matrix_axes.append(dtw_ax)
+            for ax in matrix_axes:
+                tick_step = max(1, len(labels) // 20)
+                ax.set_xticks(range(0, len(labels), tick_step))
+                ax.set_yticks(range(0, len(labels), tick_step))
+                ax.set_xticklabels(labels[::tick_step], rotation=90, fontsize=7)
+                ax.set_yticklabels(labels[::tick_step], fontsize=7)
+
+            state.update(ax=dtw_ax, samples=samples, shapes=shapes, matrix=matrix)
+            fig.tight_layout()
+            canvas.draw()
+            pair_count = len(shapes) * (len(shapes) - 1) // 2
+            status_label.config(text=f"{computed} of {pair_count} pairs computed in {elapsed:.3f} s "
+                                     f"({pair_count - computed} pruned by LB_Keogh). Click a cell to compare")
+
+        def on_click(event):
+            if not state or event.inaxes != state['ax'] or event.xdata is None:
+                return
+            col, row = int(round(event.xdata)), int(round(event.ydata))
+            count = len(state['shapes'])
+            if not (0 <= row < count and 0 <= col < count) or row == col:
+                return
+            self.pos_sample1_var.set(int(state['samples'][row]) + 1)
+            self.pos_shape1_var.set(int(state['shapes'][row]) + 1)
+            self.pos_sample2_var.set(int(state['samples'][col]) + 1)
+            self.pos_shape2_var.set(int(state['shapes'][col]) + 1)
+            self.compare_shape_positions()
+            status_label.config(text=f"DTW distance: {state['matrix'][row, col]:.3f}")
+
+        canvas.mpl_connect('button_press_event', on_click)
+        ttk.Button(controls, text="Render", command=render, style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+        render()
+
+    # 重排数据方法
+    def build_reindexed_data(self):
+        """把当前attention排序应用到所有已加载数据，分块写出重排后的数组"""
+        if self.attention_data is None or self.original_indices is None or self.reindex_order is not None:
+            messagebox.showwarning("Warning", "Please load original (not reindexed) attention data first!")
+            return
+
+        out_dir = filedialog.askdirectory(title="Choose Output Folder for Reindexed Views")
+        if not out_dir:
+            return
+
+        try:
+            start = time.perf_counter()
+            # 稀疏heatmap直接按CSR渲染，不参与重排
+            heatmap = self.heatmap_data if isinstance(self.heatmap_data, np.ndarray) else None
+            written = build_reindexed_views(out_dir, self.original_indices, self.attention_data,
+                                            self.attention_means, self.arr_0, self.arr_1, heatmap)
+            self.append_log(f"Reindexed views written in {time.perf_counter() - start:.2f} s: {', '.join(written)}")
+            messagebox.showinfo("Success", f"Reindexed views saved to {out_dir}\n\nMembers: {', '.join(written)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Error building reindexed views: {str(e)}")
+
+    def load_reindexed_data(self):
+        """加载重排后的数组"""
+        directory = filedialog.askdirectory(title="Choose Folder with Reindexed Views")
+        if directory:
+            self.load_reindexed_dir(directory)
+
+    def load_reindexed_dir(self, directory, restoring=False):
+        """以内存映射方式加载重排数组，shape索引即attention排名，显示时无需再做gather"""
+        loaded = []
+        try:
+            with open(os.path.join(directory, REINDEX_MANIFEST), encoding="utf-8") as f:
+                members = json.load(f)['members']
+
+            def load_member(name):
+                path = os.path.join(directory, REINDEXED_FILES[name])
+                return self.workspace.fetch(path, 'reindexed_' + name, lambda: np.load(path, mmap_mode="r"))
+
+            order = load_member('order')
+            if self.x_train is not None and order.shape[0] != self.x_train.shape[0]:
+                raise ValueError(f"Reindexed views have {order.shape[0]} instances, "
+                                 f"but the raw data has {self.x_train.shape[0]}")
+            self.reindex_order = order
+            self.reindexed_dir = directory
+
+            if 'arr_0' in members and 'arr_1' in members:
+                self.arr_0 = load_member('arr_0')
+                self.arr_1 = load_member('arr_1')
+                # arr_1已重排，需要重新计算有效掩码
+                if self.x_train is not None:
+                    self.validate_vp_data()
+                loaded += ['arr_0', 'arr_1']
+
+            if 'heatmap' in members:
+                self.heatmap_data = load_member('heatmap')
+                self.heatmap_path = None
+                shape_count = self.heatmap_data.shape[1]
+                self.heatmap_sample_spinbox.config(to=self.heatmap_data.shape[0])
+                self.heatmap_start_spinbox.config(to=shape_count)
+                self.heatmap_end_spinbox.config(to=shape_count)
+                self.heatmap_info_label.config(text=f"Reindexed heatmap: {self.heatmap_data.shape}",
+                                               foreground="green")
+                loaded.append('heatmap')
+
+            # attention已按排名存储，排序结果直接使用，无需重新计算
+            self.attention_data = self.sorted_attention_data = load_member('attention')
+            self.attention_means = load_member('attention_mean')
+            self.attention_path = None
+            sample_count, shape_count = self.attention_means.shape
+            self.original_indices = np.broadcast_to(np.arange(shape_count), (sample_count, shape_count))
+            self.all_samples_indices = [[sample_idx + 1, sorted_indices.tolist()]
+                                        for sample_idx, sorted_indices in enumerate(order)]
+            self.attention_sample_spinbox.config(to=sample_count)
+            self.attention_count_spinbox.config(to=shape_count)
+            self.attention_info_label.config(text=f"Reindexed attention: {self.attention_data.shape}",
+                                             foreground="green")
+            loaded.append('attention')
+
+            self.update_control_ranges()
+            self.append_log(f"Reindexed views loaded (shape index = attention rank): {', '.join(loaded)}")
+            if not restoring:
+                self.save_session()
+                if self.heatmap_data is not None:
+                    self.update_heatmap()
+                self.update_attention_plot()
+
+        except Exception as e:
+            self.reindex_order = self.reindexed_dir = None
+            if not restoring:
+                messagebox.showerror("Error", f"Error loading reindexed views: {str(e)}")
+        return loaded
+
+    def compare_attention_runs(self):
+        """比较当前attention与另一次运行的attention排序变化"""
+        if self.attention_data is None or self.original_indices is None:
+            messagebox.showwarning("Warning", "Please load attention data first!")
+            return
+
+        filename = filedialog.askopenfilename(
+            title="Select Attention Data File of Another Run",
+            filetypes=[("NPY files", "*.npy"), ("All files", "*.*")]
+        )
+        if not filename:
+            return
+
+        try:
+            other = self.workspace.fetch(filename, 'attention', lambda: np.load(filename))
+            if other.shape != self.attention_data.shape:
+                raise ValueError(f"Shape {other.shape} does not match current attention {self.attention_data.shape}")
+            other_means, other_indices, _ = attention_ranking(other, filename)
+            top_k = min(self.attention_count_var.get(), self.attention_data.shape[1])
+            stats = attention_run_diff(self.attention_means, other_means,
+                                       self.original_indices, other_indices, top_k)
+        except Exception as e:
+            messagebox.showerror("Error", f"Error comparing attention runs: {str(e)}")
+            return
+
+        self.show_run_diff_window(os.path.basename(filename), stats, top_k)
+
+    def show_run_diff_window(self, other_name, stats, top_k):
+        """显示排序相关性分布，并列出变化最大的sample"""
+        window, fig, canvas = self.create_figure_window(f"Attention Run Diff: current vs {other_name}", (14, 5))
+
+        # 按Spearman从低到高排列（变化最大的在前）
+        spearman = stats['spearman']
+        changed_order = np.argsort(np.where(np.isnan(spearman), np.inf, spearman), kind='stable')
+
+        list_frame = ttk.LabelFrame(window, text="Most Changed Instances (click to view)", padding=5)
+        list_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        listbox = tk.Listbox(list_frame, height=8, font=("TkDefaultFont", 10))
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=listbox.yview)
+        listbox.configure(yscrollcommand=scrollbar.set)
+        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        for sample_idx in changed_order:
+            listbox.insert(tk.END, f"Instance {sample_idx + 1}:  Spearman {spearman[sample_idx]:.3f}   "
+                                   f"Kendall {stats['kendall'][sample_idx]:.3f}   "
+                                   f"Top-{top_k} Jaccard {stats['jaccard'][sample_idx]:.3f}")
+
+        metrics = [('spearman', 'Spearman Rank Correlation'), ('kendall', 'Kendall Tau-b'),
+                   ('jaccard', f'Top-{top_k} Jaccard Overlap')]
+        axes = [fig.add_subplot(1, 3, i + 1) for i in range(3)]
+
+        def draw_distributions(selected=None):
+            for ax, (key, title) in zip(axes, metrics):
+                ax.clear()
+                values = stats[key][~np.isnan(stats[key])]
+                ax.hist(values, bins=min(30, max(5, len(values) // 2)), color='steelblue', alpha=0.7)
+                if selected is not None:
+                    ax.axvline(stats[key][selected], color='red', linewidth=2,
+                               label=f'Instance {selected + 1}')
+                    ax.legend()
+                ax.set_title(f'{title}\nmedian {np.median(values):.3f}' if values.size else title)
+                ax.set_xlabel('Value')
+                ax.set_ylabel('Instance Count')
+                ax.grid(True, alpha=0.3)
+            fig.tight_layout()
+            canvas.draw()
+
+        def on_select(event):
+            selection = listbox.curselection()
+            if not selection:
+                return
+            sample_idx = int(changed_order[selection[0]])
+            draw_distributions(sample_idx)
+            # 在现有attention视图中显示该sample
+            self.attention_sample_var.set(sample_idx + 1)
+            self.update_attention_plot()
+
+        listbox.bind('<<ListboxSelect>>', on_select)
+        draw_distributions()
+
     def download_indices(self):
         """下载所有sample的排序索引为NPY文件"""
         if not self.all_samples_indices:
@@ -1211,6 +4528,426 @@ class MergedVisualizationApp:
         except Exception as e:
             messagebox.showerror("Success", f"Successful saving indices")
 
+    # 多数据集工作区方法
+    def current_paths(self):
+        """返回当前活动数据集的文件路径"""
+        return {'npz': self.npz_path_var.get() or None, 'npy': self.npy_path_var.get() or None,
+                'heatmap': self.heatmap_path, 'attention': self.attention_path}
+
+    def add_to_workspace(self):
+        """将当前加载的文件登记为工作区中的一个数据集"""
+        paths = {key: path for key, path in self.current_paths().items() if path}
+        if not paths:
+            messagebox.showwarning("Warning", "Please load data files first!")
+            return
+
+        # 以数据文件名和attention文件名组合命名
+        main_path = paths.get('npz') or paths.get('npy') or paths.get('heatmap') or paths.get('attention')
+        name = os.path.splitext(os.path.basename(main_path))[0]
+        if 'attention' in paths:
+            name += " / " + os.path.splitext(os.path.basename(paths['attention']))[0]
+
+        name = self.workspace.add_dataset(name, paths)
+        self.refresh_workspace_list(select=name)
+
+    def switch_dataset(self):
+        """切换到工作区中的另一个数据集，已驻留的数组无需重新加载"""
+        name = self.workspace_dataset_var.get()
+        paths = self.workspace.datasets.get(name)
+        if not paths:
+            messagebox.showwarning("Warning", "Please select a dataset in the workspace first!")
+            return
+
+        missing = [path for path in paths.values() if not os.path.exists(path)]
+        if missing:
+            messagebox.showerror("Error", f"Dataset files are missing: {', '.join(missing)}")
+            return
+
+        # 切换前清除当前数据集的状态
+        self.reindex_order = self.reindexed_dir = None
+        self.heatmap_data = self.heatmap_path = None
+        self.attention_data = self.attention_path = None
+        self.sorted_attention_data = self.original_indices = self.attention_means = None
+        self.all_samples_indices = []
+        self.heatmap_info_label.config(text="No heatmap data loaded", foreground="red")
+        self.attention_info_label.config(text="No attention data loaded", foreground="red")
+
+        self.npz_path_var.set(paths.get('npz', ''))
+        self.npy_path_var.set(paths.get('npy', ''))
+        data_loaded = 'npz' in paths and 'npy' in paths and self.load_data(restoring=True)
+        heatmap_loaded = 'heatmap' in paths and self.load_heatmap_file(paths['heatmap'], restoring=True)
+        attention_loaded = 'attention' in paths and self.load_attention_file(paths['attention'], restoring=True)
+        self.workspace.set_active(paths)
+
+        if data_loaded:
+            self.update_upper_plots()
+            self.compare_shape_positions()
+        if heatmap_loaded:
+            self.update_heatmap()
+        if attention_loaded:
+            self.update_attention_plot()
+        self.update_workspace_info()
+        self.append_log(f"Switched to dataset: {name}")
+
+    def close_dataset(self):
+        """从工作区移除选中的数据集"""
+        name = self.workspace_dataset_var.get()
+        if name not in self.workspace.datasets:
+            return
+        self.workspace.remove_dataset(name)
+        self.refresh_workspace_list()
+
+    def update_memory_budget(self):
+        """应用新的内存预算并立即执行LRU释放"""
+        try:
+            self.workspace.budget_bytes = self.memory_budget_var.get() * 1024 * 1024
+        except tk.TclError:
+            return
+        self.workspace.enforce_budget()
+        self.update_workspace_info()
+
+    def refresh_workspace_list(self, select=None):
+        """刷新工作区数据集列表"""
+        names = list(self.workspace.datasets)
+        for combobox in (self.workspace_combobox, self.workspace_run_a_combobox, self.workspace_run_b_combobox):
+            combobox.config(values=names)
+        for var in (self.workspace_dataset_var, self.workspace_run_a_var, self.workspace_run_b_var):
+            if var.get() not in names:
+                var.set("")
+        if select is not None:
+            self.workspace_dataset_var.set(select)
+        elif names and not self.workspace_dataset_var.get():
+            self.workspace_dataset_var.set(names[-1])
+        self.update_workspace_info()
+
+    def update_workspace_info(self):
+        """显示工作区驻留内存占用"""
+        resident_mb = self.workspace.resident_bytes() / (1024 * 1024)
+        budget_mb = self.workspace.budget_bytes / (1024 * 1024)
+        self.workspace_info_label.config(
+            text=f"Datasets: {len(self.workspace.datasets)}, Resident: {resident_mb:.1f} MB / {budget_mb:.0f} MB")
+
+    def load_workspace_run(self, name):
+        """读取工作区中某个数据集的heatmap和attention排序结果"""
+        paths = self.workspace.datasets[name]
+        heatmap = None
+        ranking = None
+        if 'heatmap' in paths:
+            heatmap = self.workspace.fetch(paths['heatmap'], 'heatmap', lambda: load_heatmap_array(paths['heatmap']))
+        if 'attention' in paths:
+            attention = self.workspace.fetch(paths['attention'], 'attention', lambda: np.load(paths['attention']))
+            ranking = attention_ranking(attention, paths['attention'])
+        return heatmap, ranking
+
+    def create_figure_window(self, title, figsize=(14, 8)):
+        """创建带工具栏的独立图形窗口，返回(窗口, Figure, Canvas)"""
+        window = tk.Toplevel(self.root)
+        window.title(title)
+        control_frame = ttk.Frame(window, padding=5)
+        control_frame.pack(side=tk.TOP, fill=tk.X)
+
+        fig, canvas, _ = self.create_embedded_figure(window, figsize)
+        window.control_frame = control_frame
+        return window, fig, canvas
+
+    def show_run_comparison(self):
+        """并排显示两个数据集（或两次模型运行）的heatmap和attention"""
+        name_a, name_b = self.workspace_run_a_var.get(), self.workspace_run_b_var.get()
+        if name_a not in self.workspace.datasets or name_b not in self.workspace.datasets:
+            messagebox.showwarning("Warning", "Please select Run A and Run B from the workspace first!")
+            return
+
+        try:
+            runs = [(name_a,) + self.load_workspace_run(name_a), (name_b,) + self.load_workspace_run(name_b)]
+        except Exception as e:
+            messagebox.showerror("Error", f"Error loading runs: {str(e)}")
+            return
+        self.update_workspace_info()
+
+        window, fig, canvas = self.create_figure_window(f"Run Comparison: {name_a} vs {name_b}")
+
+        instance_var = tk.IntVar(value=self.heatmap_sample_var.get())
+        start_var = tk.IntVar(value=self.heatmap_start_var.get())
+        end_var = tk.IntVar(value=self.heatmap_end_var.get())
+        count_var = tk.IntVar(value=self.attention_count_var.get())
+        for label, var in [("Instance:", instance_var), ("Start Shape:", start_var),
+                           ("End Shape:", end_var), ("Number of Shapes:", count_var)]:
+            ttk.Label(window.control_frame, text=label).pack(side=tk.LEFT, padx=(10, 2))
+            ttk.Spinbox(window.control_frame, from_=1, to=100000, textvariable=var, width=8).pack(side=tk.LEFT)
+
+        def redraw():
+            try:
+                sample_idx = instance_var.get() - 1
+                start_shape, end_shape = start_var.get() - 1, end_var.get()
+                shape_count = count_var.get()
+            except tk.TclError:
+                return
+
+            # 两次运行共享同一颜色范围，便于直接比较
+            slices = []
+            for _, heatmap, _ in runs:
+                if heatmap is not None and 0 <= sample_idx < heatmap.shape[0]:
+                    try:
+                        _, start, end = clamp_heatmap_view(heatmap.shape, sample_idx, start_shape, end_shape)
+                    except ValueError as e:
+                        messagebox.showerror("Error", str(e))
+                        return
+                    slices.append(np.asarray(heatmap_block(heatmap, sample_idx, start, end)))
+                else:
+                    slices.append(None)
+            fig.clear()
+            valid = [data for data in slices if data is not None and data.size]
+            vmin = min(data.min() for data in valid) if valid else None
+            vmax = max(data.max() for data in valid) if valid else None
+
+            for col, ((name, _, ranking), data_slice) in enumerate(zip(runs, slices)):
+                ax = fig.add_subplot(2, 2, col + 1)
+                if data_slice is not None and data_slice.size:
+                    im = ax.imshow(data_slice, cmap='viridis', aspect='auto', interpolation='nearest',
+                                   vmin=vmin, vmax=vmax)
+                    fig.colorbar(im, ax=ax)
+                else:
+                    ax.text(0.5, 0.5, 'No heatmap for this instance', ha='center', va='center',
+                            transform=ax.transAxes)
+                ax.set_title(f'{name}\nHeatmap: Instance {sample_idx + 1}, Shapes {start_shape + 1}-{end_shape}')
+                ax.set_xticks([])
+                ax.set_yticks([])
+
+                ax = fig.add_subplot(2, 2, col + 3)
+                if ranking is not None and 0 <= sample_idx < ranking[0].shape[0]:
+                    mean_values, sorted_indices, _ = ranking
+                    count = min(shape_count, mean_values.shape[1])
+                    top_indices = sorted_indices[sample_idx, :count]
+                    ax.bar(range(count), mean_values[sample_idx, top_indices], color='steelblue', alpha=0.7)
+                    if count <= 30:
+                        ax.set_xticks(range(count))
+                        ax.set_xticklabels([str(idx) for idx in top_indices], rotation=90, fontsize=8)
+                    else:
+                        ax.set_xticks([])
+                else:
+                    ax.text(0.5, 0.5, 'No attention for this instance', ha='center', va='center',
+                            transform=ax.transAxes)
+                ax.set_title(f'Attention: Top {shape_count} Shapes (High to Low)')
+                ax.set_xlabel('Original Idx (High to Low)')
+                ax.set_ylabel('Attention Value')
+                ax.grid(True, alpha=0.3)
+
+            fig.tight_layout()
+            canvas.draw()
+
+        ttk.Button(window.control_frame, text="Update", command=redraw,
+                   style="Accent.TButton").pack(side=tk.LEFT, padx=10)
+        redraw()
+
+    # 会话保存与恢复方法
+    def session_variables(self):
+        """返回需要随会话保存的标量控件变量"""
+        return {
+            'plot_count': self.plot_count_var,
+            'upper_mode': self.upper_mode_var,
+            'pos_sample1': self.pos_sample1_var,
+            'pos_shape1': self.pos_shape1_var,
+            'pos_sample2': self.pos_sample2_var,
+            'pos_shape2': self.pos_shape2_var,
+            'heatmap_sample': self.heatmap_sample_var,
+            'heatmap_start': self.heatmap_start_var,
+            'heatmap_end': self.heatmap_end_var,
+            'heatmap_order': self.heatmap_order_var,
+            'attention_sample': self.attention_sample_var,
+            'attention_count': self.attention_count_var,
+        }
+
+    def save_session(self):
+        """保存已加载文件路径（含指纹）和控件取值"""
+        files = {}
+        reindex_manifest = os.path.join(self.reindexed_dir, REINDEX_MANIFEST) if self.reindexed_dir else None
+        for key, path in [('npz', self.npz_path_var.get()), ('npy', self.npy_path_var.get()),
+                          ('heatmap', self.heatmap_path), ('attention', self.attention_path),
+                          ('reindexed', reindex_manifest)]:
+            if path and os.path.exists(path):
+                files[key] = {'path': os.path.abspath(path), 'fingerprint': file_fingerprint(path)}
+
+        controls = {}
+        for name, var in self.session_variables().items():
+            try:
+                controls[name] = var.get()
+            except tk.TclError:
+                pass  # 输入框内容无效时跳过
+        sequences = []
+        for seq in self.sequence_controls:
+            try:
+                sequences.append({key: seq[key].get() for key in ('instance', 'variable', 'start_time', 'end_time')})
+            except tk.TclError:
+                sequences.append(None)
+        controls['sequences'] = sequences
+
+        session = {'version': SESSION_VERSION, 'files': files, 'controls': controls}
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = SESSION_FILE + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(session, f, indent=2)
+            os.replace(tmp_path, SESSION_FILE)
+        except OSError:
+            pass
+
+    def restore_session(self):
+        """恢复上次会话：校验文件指纹后以内存映射方式加载数据和缓存的派生结果"""
+        if not os.path.exists(SESSION_FILE):
+            return
+
+        start = time.perf_counter()
+        try:
+            with open(SESSION_FILE, encoding="utf-8") as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return
+        if session.get('version') != SESSION_VERSION:
+            return
+
+        # 只恢复指纹未变化的文件
+        valid_files = {}
+        skipped = []
+        for key, entry in session.get('files', {}).items():
+            path = entry.get('path')
+            try:
+                if path and file_fingerprint(path) == entry.get('fingerprint'):
+                    valid_files[key] = path
+                    continue
+            except OSError:
+                pass
+            skipped.append(key)
+
+        controls = session.get('controls', {})
+        if 'plot_count' in controls:
+            self.plot_count_var.set(controls['plot_count'])
+            self.update_sequence_controls()
+
+        data_loaded = False
+        if 'npz' in valid_files and 'npy' in valid_files:
+            self.npz_path_var.set(valid_files['npz'])
+            self.npy_path_var.set(valid_files['npy'])
+            data_loaded = self.load_data(restoring=True)
+        heatmap_loaded = 'heatmap' in valid_files and self.load_heatmap_file(valid_files['heatmap'], restoring=True)
+        attention_loaded = ('attention' in valid_files and
+                            self.load_attention_file(valid_files['attention'], restoring=True))
+        if 'reindexed' in valid_files:
+            loaded = self.load_reindexed_dir(os.path.dirname(valid_files['reindexed']), restoring=True)
+            heatmap_loaded = heatmap_loaded or 'heatmap' in loaded
+            attention_loaded = attention_loaded or 'attention' in loaded
+
+        # 文件加载后再写回控件取值，避免被加载时的默认值覆盖
+        for name, var in self.session_variables().items():
+            if name in controls and name != 'plot_count':
+                var.set(controls[name])
+        for seq, values in zip(self.sequence_controls, controls.get('sequences', [])):
+            if values:
+                for key, value in values.items():
+                    seq[key].set(value)
+
+        # 重新绘制上次的视图
+        try:
+            if data_loaded:
+                self.update_upper_plots()
+                self.compare_shape_positions()
+            if heatmap_loaded:
+                self.update_heatmap()
+            if attention_loaded:
+                self.update_attention_plot()
+        except Exception as e:
+            self.append_log(f"Session view restore failed: {str(e)}")
+
+        elapsed = time.perf_counter() - start
+        if valid_files:
+            self.append_log(f"Session restored in {elapsed:.2f} s")
+        if skipped:
+            self.append_log(f"Skipped changed or missing files: {', '.join(skipped)}")
+
+    def export_sources(self):
+        """返回当前数据对应的文件路径，供导出工作进程以内存映射方式读取"""
+        sources = {}
+        if self.x_train is not None and self.npy_path_var.get():
+            sources['x_train'] = self.npy_path_var.get()
+        for name, data, path in [('heatmap', self.heatmap_data, self.heatmap_path),
+                                 ('attention', self.attention_data, self.attention_path)]:
+            if data is None:
+                continue
+            if path is None and self.reindexed_dir is not None:
+                path = os.path.join(self.reindexed_dir, REINDEXED_FILES[name])
+            if path is None or not os.path.exists(path):
+                raise ValueError(f"The {name} data has no file on disk (live follow data cannot be exported)")
+            sources[name] = path
+        if len(sources) == 0:
+            raise ValueError("Please load data first!")
+        return sources
+
+    def export_pdf_batch(self):
+        """按instance范围并行写出多页PDF（密集元素栅格化，线条按输出分辨率抽稀）"""
+        try:
+            sources = self.export_sources()
+            first = self.export_first_var.get() - 1
+            last = self.export_last_var.get() - 1
+            per_file = max(1, self.export_per_file_var.get())
+            if first < 0 or first > last:
+                raise ValueError("First instance must not be greater than the last instance!")
+        except (ValueError, tk.TclError) as e:
+            messagebox.showerror("Error", f"Error exporting PDF: {str(e)}")
+            return
+
+        out_dir = filedialog.askdirectory(title="Choose Output Folder for PDF Export")
+        if not out_dir:
+            return
+
+        # 每个工作进程负责一段instance，写出一个PDF
+        ranges = [(start, min(start + per_file, last + 1) - 1) for start in range(first, last + 1, per_file)]
+        executor = ProcessPoolExecutor(max_workers=min(len(ranges), os.cpu_count() or 1),
+                                       mp_context=multiprocessing.get_context("spawn"))
+        futures = [executor.submit(export_instance_pages,
+                                   os.path.join(out_dir, f"VISA_instances_{start + 1}-{end + 1}.pdf"),
+                                   sources, start, end, self.attention_count_var.get())
+                   for start, end in ranges]
+        executor.shutdown(wait=False)
+        self.append_log(f"Exporting instances {first + 1}-{last + 1} to {len(ranges)} PDF file(s)...")
+        self.poll_pdf_export(futures, time.perf_counter())
+
+    def poll_pdf_export(self, futures, start):
+        """等待导出进程完成，不阻塞界面"""
+        if not all(future.done() for future in futures):
+            self.root.after(200, self.poll_pdf_export, futures, start)
+            return
+
+        errors = [str(future.exception()) for future in futures if future.exception() is not None]
+        if errors:
+            messagebox.showerror("Error", f"Error exporting PDF: {errors[0]}")
+            return
+        paths = [future.result() for future in futures]
+        self.append_log(f"PDF export finished in {time.perf_counter() - start:.2f} s: "
+                        f"{', '.join(os.path.basename(path) for path in paths)}")
+        messagebox.showinfo("Success", f"Exported {len(paths)} PDF file(s) to {os.path.dirname(paths[0])}")
+
+    def clear_session_cache(self):
+        """删除会话文件和所有缓存的派生数据"""
+        if not messagebox.askokcancel("Clear Cache", "Delete the saved session and all cached derived data?"):
+            return
+        # 只删除本功能写入的文件；CACHE_DIR可能是用户指定的共享目录，shm下的元数据仍被其他进程使用
+        if os.path.exists(SESSION_FILE):
+            os.remove(SESSION_FILE)
+        shutil.rmtree(os.path.join(CACHE_DIR, "artifacts"), ignore_errors=True)
+        self.append_log("Session cache cleared")
+
+    def report_startup_time(self):
+        """记录从启动到窗口可用的时间"""
+        self.root.update_idletasks()
+        elapsed = time.perf_counter() - STARTUP_T0
+        self.append_log(f"Startup time: {elapsed:.2f} s")
+
+    def append_log(self, message):
+        """在Log区域追加一行信息"""
+        self.data_info_text.config(state=tk.NORMAL)
+        self.data_info_text.insert(tk.END, "\n" + message)
+        self.data_info_text.see(tk.END)
+        self.data_info_text.config(state=tk.DISABLED)
+
     # 视图控制方法
     def reset_view(self):
         """重置视图"""
@@ -1250,7 +4987,293 @@ class MergedVisualizationApp:
         messagebox.showinfo("Pan Mode", "Pan mode enabled! Click and drag to move the plots!")
 
 
+RENDER_MAX_PIXELS = 4000  # 渲染图像每边的最大像素数（尺寸英寸 x dpi）
+
+
+class VISAServer:
+    """无显示环境下的渲染服务：asyncio处理HTTP请求，线程池渲染图像，按视图参数缓存响应"""
+
+    def __init__(self, npz_path=None, npy_path=None, heatmap_path=None, attention_path=None,
+                 workers=4, cache_size=256):
+        self.arr_0 = self.arr_1 = self.x_train = None
+        self.heatmap_data = self.attention_data = None
+        self.paths = {'npz': npz_path, 'npy': npy_path, 'heatmap': heatmap_path, 'attention': attention_path}
+
+        # 所有请求共享同一份内存映射数据
+        if npz_path:
+            _, self.arr_0, self.arr_1 = load_shapes_npz(npz_path)
+        if npy_path:
+            self.x_train = np.load(npy_path, mmap_mode="r")
+        self.vp_valid_mask = None
+        if self.arr_1 is not None and self.x_train is not None:
+            self.vp_valid_mask, problems = validate_vp_records(self.arr_0, self.arr_1, self.x_train.shape)
+            self.vp_valid_mask[self.x_train.shape[0]:] = False
+            print(vp_validation_report(self.arr_0, self.arr_1, self.x_train.shape, problems))
+        if heatmap_path:
+            self.heatmap_data = load_heatmap_array(heatmap_path, mmap_mode="r")
+        if attention_path:
+            self.attention_data = np.load(attention_path, mmap_mode="r")
+            self.attention_means, self.original_indices, self.sorted_attention_data = attention_ranking(
+                self.attention_data, attention_path)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (路由, 参数) -> (content_type, body)
+        self.cache_lock = threading.Lock()
+        self.pending = {}  # 正在渲染的请求，相同参数的并发请求共享结果
+
+        self.routes = {
+            '/api/info': (self.info_json, 'application/json'),
+            '/api/heatmap': (self.heatmap_json, 'application/json'),
+            '/api/attention': (self.attention_json, 'application/json'),
+            '/api/series': (self.series_json, 'application/json'),
+            '/api/vp': (self.vp_json, 'application/json'),
+            '/render/heatmap.png': (self.render_heatmap, 'image/png'),
+            '/render/attention.png': (self.render_attention, 'image/png'),
+            '/render/comparison.png': (self.render_comparison, 'image/png'),
+        }
+
+    # 参数解析
+    @staticmethod
+    def int_param(params, name, default=None):
+        if name not in params:
+            if default is None:
+                raise ValueError(f"Missing parameter: {name}")
+            return default
+        return int(params[name])
+
+    def require(self, array, name):
+        if array is None:
+            raise LookupError(f"No {name} data loaded on this server")
+        return array
+
+    # JSON接口
+    def info_json(self, params):
+        shapes = {name: list(array.shape) for name, array in [
+            ('arr_0', self.arr_0), ('arr_1', self.arr_1), ('x_train', self.x_train),
+            ('heatmap', self.heatmap_data), ('attention', self.attention_data)] if array is not None}
+        return json.dumps({'shapes': shapes, 'files': {k: v for k, v in self.paths.items() if v}})
+
+    def heatmap_json(self, params):
+        heatmap = self.require(self.heatmap_data, 'heatmap')
+        sample_idx, start_shape, end_shape = clamp_heatmap_view(
+            heatmap.shape, self.int_param(params, 'instance', 1) - 1,
+            self.int_param(params, 'start', 1) - 1, self.int_param(params, 'end', min(20, heatmap.shape[1])))
+        data_slice = heatmap_block(heatmap, sample_idx, start_shape, end_shape)
+        return json.dumps({'instance': sample_idx + 1, 'start': start_shape + 1, 'end': end_shape,
+                           'values': np.asarray(data_slice).tolist()})
+
+    def attention_json(self, params):
+        self.require(self.attention_data, 'attention')
+        sample_idx, shape_count = self.attention_view(params)
+        original_idx = self.original_indices[sample_idx, :shape_count]
+        return json.dumps({'instance': sample_idx + 1,
+                           'original_indices': np.asarray(original_idx).tolist(),
+                           'mean_values': np.asarray(self.attention_means[sample_idx, original_idx]).tolist()})
+
+    def series_json(self, params):
+        x_train = self.require(self.x_train, 'raw time series')
+        sample_idx = self.int_param(params, 'instance', 1) - 1
+        var_idx = self.int_param(params, 'variable', 1) - 1
+        start = max(self.int_param(params, 'start', 0), 0)
+        end = min(self.int_param(params, 'end', x_train.shape[1]), x_train.shape[1])
+        if not (0 <= sample_idx < x_train.shape[0] and 0 <= var_idx < x_train.shape[2]) or start >= end:
+            raise ValueError("Instance, variable or time range is out of range")
+        return json.dumps({'instance': sample_idx + 1, 'variable': var_idx + 1, 'start': start, 'end': end,
+                           'values': np.asarray(x_train[sample_idx, start:end, var_idx]).tolist()})
+
+    def vp_json(self, params):
+        arr_1 = self.require(self.arr_1, 'shape')
+        sample_idx, shape_idx = self.shape_param(params, '')
+        length, start, end, label = parse_vp(arr_1, sample_idx, shape_idx)
+        return json.dumps({'instance': sample_idx + 1, 'shape': shape_idx + 1, 'length': length,
+                           'start': start, 'end': end, 'variable': int(label) + 1})
+
+    def attention_view(self, params):
+        sample_idx = self.int_param(params, 'instance', 1) - 1
+        shape_count = self.int_param(params, 'count', min(15, self.attention_data.shape[1]))
+        if sample_idx >= self.attention_data.shape[0] or sample_idx < 0:
+            sample_idx = 0
+        return sample_idx, max(1, min(shape_count, self.attention_data.shape[1]))
+
+    def shape_param(self, params, suffix):
+        sample_idx = self.int_param(params, 'instance' + suffix) - 1
+        shape_idx = self.int_param(params, 'shape' + suffix) - 1
+        if not (0 <= sample_idx < self.arr_1.shape[0] and 0 <= shape_idx < self.arr_1.shape[1]):
+            raise ValueError("Selected shapes are out of data range")
+        return sample_idx, shape_idx
+
+    # PNG渲染（在线程池中执行）
+    @staticmethod
+    def figure_png(params, default_size, draw):
+        width = float(params.get('width', default_size[0]))
+        height = float(params.get('height', default_size[1]))
+        dpi = int(params.get('dpi', 100))
+        if not (width > 0 and height > 0 and dpi > 0):
+            raise ValueError("width, height and dpi must be positive")
+        if not (width * dpi <= RENDER_MAX_PIXELS and height * dpi <= RENDER_MAX_PIXELS):
+            raise ValueError(f"Image too large: at most {RENDER_MAX_PIXELS} pixels per side (size x dpi)")
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        FigureCanvasAgg(fig)
+        draw(fig)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        return buffer.getvalue()
+
+    def render_heatmap(self, params):
+        heatmap = self.require(self.heatmap_data, 'heatmap')
+        sample_idx, start_shape, end_shape = clamp_heatmap_view(
+            heatmap.shape, self.int_param(params, 'instance', 1) - 1,
+            self.int_param(params, 'start', 1) - 1, self.int_param(params, 'end', min(20, heatmap.shape[1])))
+
+        def draw(fig):
+            ax = fig.add_subplot(1, 1, 1)
+            im = draw_heatmap(ax, heatmap_block(heatmap, sample_idx, start_shape, end_shape),
+                              sample_idx, start_shape, end_shape)
+            fig.colorbar(im, ax=ax).set_label('Value')
+
+        return self.figure_png(params, (8, 6), draw)
+
+    def render_attention(self, params):
+        self.require(self.attention_data, 'attention')
+        sample_idx, shape_count = self.attention_view(params)
+        mean_values = np.mean(self.sorted_attention_data[sample_idx, :shape_count], axis=1)
+        return self.figure_png(params, (14, 6),
+                               lambda fig: draw_attention_bars(fig.add_subplot(1, 1, 1), mean_values, sample_idx))
+
+    def render_comparison(self, params):
+        self.require(self.arr_1, 'shape')
+        x_train = self.require(self.x_train, 'raw time series')
+        shapes = []
+        for suffix in ('1', '2'):
+            sample_idx, shape_idx = self.shape_param(params, suffix)
+            _, start, end, label = parse_vp(self.arr_1, sample_idx, shape_idx)
+            valid = bool(self.vp_valid_mask[sample_idx, shape_idx])
+            shapes.append((sample_idx, shape_idx, start, end, label, valid))
+        return self.figure_png(params, (14, 6), lambda fig: draw_shape_comparison(fig, x_train, *shapes))
+
+    # 缓存与HTTP处理
+    @staticmethod
+    def normalize_params(params):
+        """统一图像尺寸参数的写法（如width=8与width=8.0），使相同视图共用一个缓存项"""
+        params = dict(params)
+        for name in ('width', 'height'):
+            if name in params:
+                params[name] = repr(float(params[name]))
+        if 'dpi' in params:
+            params['dpi'] = str(int(params['dpi']))
+        return params
+
+    async def respond(self, path, params):
+        handler, content_type = self.routes[path]
+        params = self.normalize_params(params)
+        key = (path, tuple(sorted(params.items())))
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, handler, params)
+            self.pending[key] = future
+        try:
+            body = await future
+        finally:
+            self.pending.pop(key, None)
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        with self.cache_lock:
+            self.cache[key] = (content_type, body)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return content_type, body
+
+    async def handle_client(self, reader, writer):
+        status, content_type, body = 200, 'application/json', b''
+        method = 'GET'
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # 忽略请求头
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            url = urlsplit(target)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if method not in ('GET', 'HEAD'):
+                status, body = 405, b'{"error": "Method not allowed"}'
+            elif url.path not in self.routes:
+                status, body = 404, b'{"error": "Unknown endpoint"}'
+            else:
+                content_type, body = await self.respond(url.path, params)
+        except LookupError as e:
+            status, body = 404, json.dumps({'error': str(e)}).encode('utf-8')
+        except ValueError as e:
+            status, body = 400, json.dumps({'error': str(e)}).encode('utf-8')
+        except Exception as e:
+            status, body = 500, json.dumps({'error': str(e)}).encode('utf-8')
+
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}.get(status, 'Error')
+        header = (f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+        if method == 'HEAD':
+            body = b''
+        try:
+            writer.write(header.encode('latin-1') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"VISA server listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=8765):
+        try:
+            asyncio.run(self.serve(host, port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="VISA time series shape visualization")
+    parser.add_argument("--serve", action="store_true", help="run the headless HTTP rendering server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=4, help="rendering threads in server mode")
+    parser.add_argument("--npz", help="time series shapes data (.npz)")
+    parser.add_argument("--npy", help="time series raw data (.npy)")
+    parser.add_argument("--heatmap", help="heatmap data (.npy)")
+    parser.add_argument("--attention", help="attention data (.npy)")
+    parser.add_argument("--import-series", metavar="FILE",
+                        help="convert a UEA/UCR .ts/.arff file to (sample, length, dimension) .npy and exit")
+    parser.add_argument("--output", help="output folder for --import-series (default: next to the input file)")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+    if args.import_series:
+        out_dir = args.output or os.path.dirname(os.path.abspath(args.import_series))
+        outputs, shape = import_time_series(
+            args.import_series, out_dir, lambda done, total: print(f"  {done}/{total} instances", flush=True))
+        print(f"Imported {shape}: " + ", ".join(outputs.values()))
+        return
+
+    if args.serve:
+        server = VISAServer(args.npz, args.npy, args.heatmap, args.attention, workers=args.workers)
+        server.run(args.host, args.port)
+        return
+
     root = tk.Tk()
 
     # 设置应用程序图标和样式
@@ -1272,9 +5295,15 @@ def main():
 
     app = MergedVisualizationApp(root)
 
+    # 窗口显示后记录启动时间并恢复上次会话
+    root.after_idle(app.report_startup_time)
+    root.after_idle(app.restore_session)
+
     # 设置窗口关闭事件
     def on_closing():
         if messagebox.askokcancel("Exit", "Are you sure you want to exit the application?"):
+            app.save_session()
+            app.workspace.close()
             root.destroy()
 
     root.protocol("WM_DELETE_WINDOW", on_closing)